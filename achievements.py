@@ -0,0 +1,47 @@
+from typing import Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+# Достижения – правила над счётчиками макаки. Счётчики ведутся в тех же запросах, что меняют макаку:
+#   weight                – macacos (кормление, ежедневка, бои)
+#   wins, best_streak     – fight_stats (бои)
+#   foods_tried, dailies  – macaco_counters (кормление, ежедневка)
+# food_types – не счётчик, а текущее число видов еды; подставляется при проверке.
+# При изменении счётчиков проверяются только правила, которые от них зависят.
+
+
+class Achievement(NamedTuple):
+    code: str
+    title: str
+    depends: Tuple[str, ...]
+    rule: Callable[[Mapping[str, int]], bool]
+
+
+ACHIEVEMENTS: Tuple[Achievement, ...] = (
+    Achievement('first_win', "🥇 Первая победа", ('wins',), lambda c: c['wins'] >= 1),
+    Achievement('weight_100', "🏋️ 100 кг", ('weight',), lambda c: c['weight'] >= 100),
+    Achievement('streak_10', "🔥 10 побед подряд", ('best_streak',), lambda c: c['best_streak'] >= 10),
+    Achievement('all_foods', "🍽 Перепробовала всю еду", ('foods_tried',),
+                lambda c: c['foods_tried'] >= c['food_types']),
+    Achievement('daily_30', "📅 30 ежедневных наград", ('dailies',), lambda c: c['dailies'] >= 30),
+)
+BY_CODE: Dict[str, Achievement] = {a.code: a for a in ACHIEVEMENTS}
+
+_by_counter: Dict[str, List[Achievement]] = {}
+for _achievement in ACHIEVEMENTS:
+    for _counter in _achievement.depends:
+        _by_counter.setdefault(_counter, []).append(_achievement)
+
+
+def evaluate(counters: Mapping[str, int], changed: Optional[Iterable[str]] = None) -> List[str]:
+    """
+    Коды выполненных правил. Проверяются только правила, зависящие от changed (None – все);
+    counters должен содержать все счётчики, от которых эти правила зависят.
+    """
+    if changed is None:
+        rules = ACHIEVEMENTS
+    else:
+        rules = {a.code: a for counter in changed for a in _by_counter.get(counter, ())}.values()
+    return [a.code for a in rules if a.rule(counters)]
+
+
+def titles(codes: Iterable[str]) -> List[str]:
+    return [BY_CODE[code].title for code in codes if code in BY_CODE]
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import os
+import random
+from typing import Dict, List, Tuple
+
+import config as cfg
+import database as db
+import events
+from notifications import send_batch
+
+logger = logging.getLogger(__name__)
+
+ARENA_TICK_SECONDS = int(os.getenv('ARENA_TICK_SECONDS', '60'))
+ARENA_BATCH_LIMIT = int(os.getenv('ARENA_BATCH_LIMIT', '20000'))
+ARENA_MAX_LEVEL_DIFF = 2
+ARENA_MAX_WEIGHT_RATIO = 1.5  # тяжёлая макака не больше чем в 1.5 раза тяжелее лёгкой
+
+
+# ---------- Подбор пар ----------
+def kick_reason(row: Dict) -> str:
+    if row['health'] <= 0:
+        return "💔 здоровье = 0"
+    if 100 - row['hunger'] <= cfg.FIGHT_MIN_SATIETY:
+        return "🍖 макака слишком голодна"
+    if row['weight'] < row['bet']:
+        return "🏋️ вес меньше ставки"
+    return ""
+
+
+def compatible(a: Dict, b: Dict) -> bool:
+    if a['user_id'] == b['user_id']:
+        return False
+    if abs(a['level'] - b['level']) > ARENA_MAX_LEVEL_DIFF:
+        return False
+    light, heavy = sorted((a['weight'], b['weight']))
+    return heavy <= light * ARENA_MAX_WEIGHT_RATIO
+
+
+def match(rows: List[Dict]) -> List[Tuple[Dict, Dict]]:
+    # После сортировки по (уровень, вес) подходящий соперник – ближайший сосед
+    ordered = sorted(rows, key=lambda r: (r['level'], r['weight']))
+    pairs = []
+    i = 0
+    while i < len(ordered) - 1:
+        if compatible(ordered[i], ordered[i + 1]):
+            pairs.append((ordered[i], ordered[i + 1]))
+            i += 2
+        else:
+            i += 1
+    return pairs
+
+
+def plan(rows: List[Dict]) -> Tuple[List[int], List[Tuple[int, int, int]]]:
+    kicked = [r['macaco_id'] for r in rows if kick_reason(r)]
+    eligible = [r for r in rows if not kick_reason(r)]
+    fights = []
+    for a, b in match(eligible):
+        winner, loser = (a, b) if random.random() < 0.5 else (b, a)
+        fights.append((winner['macaco_id'], loser['macaco_id'], min(a['bet'], b['bet'])))
+    return kicked, fights
+
+
+# ---------- Тик ----------
+async def tick(bot) -> int:
+    kicked, fights, updated = await db.arena_tick(plan, ARENA_BATCH_LIMIT)
+    by_id = {m['macaco_id']: m for m in updated}
+    messages = [
+        (row['user_id'], f"🏟 {row['name']} покидает арену: {kick_reason(row)}.")
+        for row in kicked
+    ]
+    for winner_id, loser_id, bet in fights:
+        winner, loser = by_id[winner_id], by_id[loser_id]
+        events.emit('fight', winner['user_id'], winner_id, winner_id=winner_id, loser_id=loser_id, bet=bet, arena=True)
+        messages.append((winner['user_id'],
+                         f"🏟 Арена: 🎉 ПОБЕДА!\n{winner['name']} победил {loser['name']} и забрал {bet} кг!\n"
+                         f"🏋️ Вес: {winner['weight']} кг | ⭐ Ур. {winner['level']}\n"
+                         f"📊 +{cfg.FIGHT_WIN_EXP} опыта"))
+        messages.append((loser['user_id'],
+                         f"🏟 Арена: 😔 ПОРАЖЕНИЕ\n{loser['name']} проиграл {winner['name']} и потерял {bet} кг.\n"
+                         f"🏋️ Вес: {loser['weight']} кг | ⭐ Ур. {loser['level']}\n"
+                         f"📊 +{cfg.FIGHT_LOSE_EXP} опыта, "
+                         f"😊 {loser['happiness']}/100, ❤️ {loser['health']}/100"))
+    if fights:
+        logger.info("🏟 Арена: проведено боёв %s, исключено %s", len(fights), len(kicked))
+    await send_batch(bot, messages)
+    return len(fights)
+
+
+async def run_arena(bot):
+    while True:
+        await asyncio.sleep(ARENA_TICK_SECONDS)
+        try:
+            await tick(bot)
+        except Exception as e:
+            logger.error("Ошибка тика арены: %s", e)
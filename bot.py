@@ -2,42 +2,93 @@ import asyncio
 import logging
 import os
 import random
+import signal
+import time
 import asyncpg
 from datetime import datetime
 from dotenv import load_dotenv
 import html
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
-    Message, CallbackQuery, FSInputFile,
+    Message, CallbackQuery, FSInputFile, Update, Chat, ChatMemberUpdated,
     InlineKeyboardButton,
-    InlineKeyboardMarkup
+    InlineKeyboardMarkup,
+    InlineQuery, InlineQueryResultArticle, InlineQueryResultsButton, InputTextMessageContent
 )
 from aiogram.enums import ParseMode
 from aiogram.exceptions import TelegramBadRequest, TelegramEntityTooLarge
 
+import achievements
+import bot_api
 import database as db
 import keyboards as kb
+import callbacks as cb
 import config as cfg
+import workers
+import arena
+import events
+import notifications
+import logs
+from middlewares import (
+    AdmissionMiddleware, EditDedupMiddleware, LogContextMiddleware, ThrottlingMiddleware, UserOrderMiddleware
+)
+from search_cache import PrefixCache
+from recorder import UpdateRecorder
+from profiler import MODES as PROFILE_MODES, Profiler
 
 load_dotenv()
 TOKEN = os.getenv('BOT_TOKEN')
 GROUP_INVITE_LINK = os.getenv('GROUP_INVITE_LINK')  # ссылка на основную группу
+WORKERS = int(os.getenv('WORKERS', '1'))  # >1 – ingress раздаёт апдейты по воркер-процессам
+MAX_IN_FLIGHT = int(os.getenv('MAX_IN_FLIGHT', '200'))  # апдейтов в обработке на процесс, остальные – «занято»
+RECORD_UPDATES = os.getenv('RECORD_UPDATES')  # gzip-JSONL (recorder.py) для loadtest.py; не задан – запись выключена
+ADMIN_IDS = {int(i) for i in os.getenv('ADMIN_IDS', '').split(',') if i.strip()}  # кому доступны служебные команды
+PROFILE_SIGNAL_SECONDS = 30  # сколько профилировать по SIGUSR1
+
+logs.setup_logging()  # запись в stderr – в отдельном потоке, не в event loop
+logger = logging.getLogger(__name__)
 
 if not TOKEN:
-    print("❌ ОШИБКА: Токен не найден!")
+    logger.critical("❌ ОШИБКА: Токен не найден!")
     exit(1)
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
-
-bot = Bot(token=TOKEN)
+bot = Bot(token=TOKEN, session=bot_api.create_session())
+edit_dedup = EditDedupMiddleware()
+bot.session.middleware(edit_dedup)  # правки без изменений не уходят в Bot API
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
+dp.update.outer_middleware(LogContextMiddleware())  # раньше всех: update_id и пользователь видны во всех логах
+recorder = None
+if RECORD_UPDATES:
+    # У каждого воркера свой файл; loadtest.py сливает их по времени
+    recorder = UpdateRecorder(RECORD_UPDATES if WORKERS == 1 else f"{RECORD_UPDATES}.{os.getpid()}",
+                              salt=os.getenv('RECORD_SALT'))
+    dp.update.outer_middleware(recorder)  # первым: в лог попадает весь поток, включая отброшенное троттлингом
+throttling = ThrottlingMiddleware()
+admission = AdmissionMiddleware(busy_errors=(db.DatabaseBusy,), max_in_flight=MAX_IN_FLIGHT)
+user_order = UserOrderMiddleware()
+dp.update.outer_middleware(throttling)  # до очереди: лишние нажатия не занимают место в очереди пользователя
+dp.update.outer_middleware(admission)  # ждущие в очереди пользователя тоже занимают место
+dp.update.outer_middleware(user_order)
+
+@dp.update.outer_middleware()
+async def track_chat_members(handler, event: Update, data: dict):
+    # Участники групп – для топа чата; запись в базу идёт пачками в фоне
+    chat, user = data.get('event_chat'), data.get('event_from_user')
+    if chat is not None and chat.type in ('group', 'supergroup') and user is not None and not user.is_bot:
+        db.note_chat_member(chat.id, user.id)
+    return await handler(event, data)
+
+# Свой middleware профилировщик регистрирует только на время профилирования – последним, внутри очереди пользователя
+profiler = Profiler(dp, db)
 
 BOT_USERNAME = None
 
@@ -51,16 +102,125 @@ class Challenge(StatesGroup):
 active_challenges = {}
 challenge_counter = 0
 
+# ---------- Фоновые задачи ----------
+# Ссылки держим сами: event loop хранит на задачу только слабую ссылку, и «брошенную» задачу может собрать GC
+_background_tasks: Set[asyncio.Task] = set()
+
+def _background_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Фоновая задача %s упала: %s", task.get_name(), task.exception(), exc_info=task.exception())
+
+def spawn(coro: Awaitable, name: str) -> asyncio.Task:
+    task = asyncio.create_task(coro, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+async def stop_background_tasks():
+    tasks = list(_background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
 # ---------- Отправка гифок ----------
+animation_file_ids = {}  # путь -> file_id: каждый файл загружается в Telegram один раз на процесс
+
 async def send_gif(chat_id, gif_type: str, gif_name: str, caption: str = "", parse_mode=None):
+    if not cfg.check_gif_exists(gif_type, gif_name):
+        return False
     try:
         gif_info = cfg.get_gif_info(gif_type, gif_name)
-        if gif_info and cfg.check_gif_exists(gif_type, gif_name):
-            animation = FSInputFile(gif_info['path'])
-            await bot.send_animation(chat_id, animation, caption=caption or gif_info.get('caption', ''), parse_mode=parse_mode)
-            return True
+        path = gif_info['path']
+        file_id = animation_file_ids.get(path)
+        extra = {}
+        if file_id is None and 'thumbnail' in gif_info:
+            extra = {
+                'thumbnail': FSInputFile(gif_info['thumbnail']),
+                'width': gif_info['width'],
+                'height': gif_info['height'],
+                'duration': gif_info['duration'],
+            }
+        sent = await bot.send_animation(chat_id, file_id or FSInputFile(path),
+                                        caption=caption or gif_info.get('caption', ''), parse_mode=parse_mode, **extra)
+        if file_id is None and sent.animation:
+            animation_file_ids[path] = sent.animation.file_id
+        return True
     except Exception as e:
-        logger.warning(f"Гифка {gif_type}/{gif_name}: {e}")
+        logger.warning("Гифка %s/%s: %s", gif_type, gif_name, e)
+    return False
+
+# ---------- Перегрузка: сохранённые экраны и ответ «занято» ----------
+BUSY_TEXT = "⏳ Бот перегружен, попробуйте ещё раз через минуту"
+SCREEN_CACHE_SIZE = 10000
+# (экран, user_id) -> (текст, parse_mode, когда показан); при перегрузке отдаётся без обращения к базе
+screen_cache: 'OrderedDict[Tuple[str, int], Tuple[str, Optional[str], datetime]]' = OrderedDict()
+# Только чтение: изменения при перегрузке не выполняются и не откладываются
+CALLBACK_SCREENS = {'main_menu': 'menu', 'my_macaco': 'my', 'top_weight': 'top'}
+COMMAND_SCREENS = {'/start': 'menu', '/my': 'my', '/top': 'top'}
+
+def remember_screen(screen: str, user_id: int, text: str, parse_mode: Optional[str] = None):
+    key = (screen, user_id)
+    screen_cache[key] = (text, parse_mode, datetime.now())
+    screen_cache.move_to_end(key)
+    if len(screen_cache) > SCREEN_CACHE_SIZE:
+        screen_cache.popitem(last=False)
+
+def cached_screen(screen: Optional[str], user_id: int, chat: Optional[Chat]) -> Optional[Tuple[str, Optional[str], InlineKeyboardMarkup]]:
+    if screen == 'top' and (chat is None or chat.type != 'private'):
+        return None  # сохраняется только общий топ из лички, у группы он свой
+    entry = screen_cache.get((screen, user_id)) if screen else None
+    if entry is None:
+        return None
+    text, parse_mode, saved_at = entry
+    note = f"⏳ Бот перегружен, показаны данные на {saved_at:%H:%M}\n\n"
+    markup = kb.main_menu_kb(user_id) if screen == 'menu' else kb.back_to_menu_kb(user_id)
+    return note + text, parse_mode, markup
+
+@admission.overload_handler
+async def serve_overloaded(update: Update) -> bool:
+    """True – показан сохранённый экран, False – ответили «занято» (или апдейт отброшен молча)."""
+    if update.callback_query is not None:
+        callback = update.callback_query
+        decoded = cb.decode(callback.data)
+        screen = None
+        if decoded is not None and decoded.owner_id == callback.from_user.id:
+            screen = CALLBACK_SCREENS.get(decoded.action.name)
+        cached = cached_screen(screen, callback.from_user.id, callback.message.chat if callback.message else None)
+        if cached is None or callback.message is None:
+            try:
+                await callback.answer(BUSY_TEXT, show_alert=True)
+            except TelegramBadRequest:
+                # На запрос уже ответили до перегрузки – сообщаем в чат
+                if callback.message is not None:
+                    await callback.message.answer(BUSY_TEXT)
+            return False
+        text, parse_mode, markup = cached
+        if screen == 'menu':
+            await bot.send_message(callback.message.chat.id, text, parse_mode=parse_mode, reply_markup=markup)
+        else:
+            await callback.message.edit_text(text, parse_mode=parse_mode, reply_markup=markup)
+        try:
+            await callback.answer()
+        except TelegramBadRequest:
+            pass
+        return True
+    if update.message is not None and update.message.from_user is not None:
+        message = update.message
+        command = (message.text or '').split(maxsplit=1)[0].split('@')[0] if message.text else None
+        if not (command or '').startswith('/'):
+            # Болтовню в группе и текст вне диалога (ввод имени и т.п.) никто бы не обработал –
+            # ответ «занято» на них только добавил бы исходящих запросов, которых и так слишком много
+            key = StorageKey(bot_id=bot.id, chat_id=message.chat.id, user_id=message.from_user.id)
+            if await storage.get_state(key) is None:
+                return False
+        cached = cached_screen(COMMAND_SCREENS.get(command), message.from_user.id, message.chat)
+        if cached is None:
+            await message.answer(BUSY_TEXT)
+            return False
+        text, parse_mode, markup = cached
+        await message.answer(text, parse_mode=parse_mode, reply_markup=markup)
+        return True
     return False
 
 # ---------- Отправка главного меню ----------
@@ -79,6 +239,7 @@ async def send_main_menu(chat_id: int, user_id: int):
     )
     markup = kb.main_menu_kb(user_id)
     await bot.send_message(chat_id, welcome_text, parse_mode=ParseMode.HTML, reply_markup=markup)
+    remember_screen('menu', user_id, welcome_text, ParseMode.HTML)
 
 # ---------- Показать макаку ----------
 async def show_my_macaco(user_id: int, source):
@@ -93,6 +254,13 @@ async def show_my_macaco(user_id: int, source):
         can_daily, daily_time = await db.can_get_daily(macaco['macaco_id'])
         daily_status = "✅ Доступна" if can_daily else f"⏳ Через: {daily_time}"
         hunger_status = "😋 Сыт" if macaco['hunger'] < 30 else "😐 Голоден" if macaco['hunger'] < 70 else "🆘 Очень голоден"
+        rank = await rank_lines(user_id)
+        rank_block = "━━━━━━━━━━━━━━━━━━━━\n" + "\n".join(rank) + "\n" if rank else ""
+        unlocked = achievements.titles(await db.get_achievements(macaco['macaco_id']))
+        achievements_block = (
+            f"🏆 Достижения ({len(unlocked)}/{len(achievements.ACHIEVEMENTS)}): " + ", ".join(unlocked) + "\n"
+            if unlocked else ""
+        )
         info_text = (
             f"🐒 {macaco['name']}\n"
             f"━━━━━━━━━━━━━━━━━━━━\n"
@@ -104,19 +272,20 @@ async def show_my_macaco(user_id: int, source):
             f"Настроение: {macaco['happiness']}/100\n"
             f"━━━━━━━━━━━━━━━━━━━━\n"
             f"Ежедневная награда: {daily_status}\n"
+            f"{rank_block}"
+            f"{achievements_block}"
             f"✏️ /rename — сменить имя"
         )
         markup = kb.back_to_menu_kb(user_id)
         if isinstance(source, CallbackQuery):
-            try:
-                await source.message.edit_text(info_text, parse_mode=None, reply_markup=markup)
-            except TelegramBadRequest as e:
-                if "message is not modified" not in str(e):
-                    raise e
+            await source.message.edit_text(info_text, parse_mode=None, reply_markup=markup)
         else:
             await source.answer(info_text, parse_mode=None, reply_markup=markup)
+        remember_screen('my', user_id, info_text)
+    except db.DatabaseBusy:
+        raise
     except Exception as e:
-        logger.error(f"Ошибка в show_my_macaco: {e}")
+        logger.error("Ошибка в show_my_macaco: %s", e)
         error_text = "❌ Ошибка при получении данных макаки"
         if isinstance(source, CallbackQuery):
             if source.message:
@@ -124,37 +293,76 @@ async def show_my_macaco(user_id: int, source):
         else:
             await source.answer(error_text)
 
+# ---------- Место в рейтинге ----------
+async def rank_lines(user_id: int) -> List[str]:
+    info = await db.get_rank(user_id)
+    if not info:
+        return []
+    lines = [f"🏅 Ваше место: {info['rank']} из {info['total']}"]
+    for n in info['neighbours']:
+        marker = "👉" if n['me'] else "   "
+        lines.append(f"{marker} {n['rank']}. {n['name']} – {n['weight']} кг, ⭐ {n['level']}")
+    return lines
+
 # ---------- Топ игроков ----------
+async def top_screen(user_id: int, chat: Chat) -> Tuple[str, InlineKeyboardMarkup]:
+    # В группе – только участники этой группы, в личке – общий топ
+    in_group = chat.type != 'private'
+    top = await (db.get_chat_top(chat.id, 10) if in_group else db.get_top_macacos(10))
+    if not top:
+        text = "📊 В этом чате пока нет макак! Напишите /start боту в личку." if in_group else "📊 Топ пуст! Будьте первым!"
+        return text, kb.main_menu_kb(user_id)
+    lines = ["🏆 ТОП-10 МАКАК ЧАТА 🏆\n" if in_group else "🏆 ТОП-10 МАКАК 🏆\n", "────────────────────"]
+    medals = ["🥇", "🥈", "🥉"] + [f"{i}." for i in range(4, 11)]
+    for idx, (name, weight, level, username) in enumerate(top[:10]):
+        medal = medals[idx]
+        user_display = f"@{username}" if username else "Без юзернейма"
+        lines.append(f"{medal} {name}\n   🏋️ {weight} кг | ⭐ Ур. {level}\n   👤 {user_display}\n")
+    lines.append("────────────────────")
+    lines += await rank_lines(user_id)
+    return "\n".join(lines), kb.back_to_menu_kb(user_id)
+
 async def show_top_players(callback: CallbackQuery, user_id: int):
     try:
         if callback.message is None:
             await callback.answer("Сообщение устарело.", show_alert=True)
             return
-        top = await db.get_top_macacos(10)  # ← изменено с 5 на 10
-        if not top:
-            text = "📊 Топ пуст! Будьте первым!"
-            markup = kb.main_menu_kb(user_id)
-        else:
-            lines = ["🏆 ТОП-10 МАКАК 🏆\n", "────────────────────"]
-            medals = ["🥇", "🥈", "🥉"] + [f"{i}." for i in range(4, 11)]
-            for idx, (name, weight, level, username) in enumerate(top[:10]):
-                medal = medals[idx]
-                user_display = f"@{username}" if username else "Без юзернейма"
-                lines.append(f"{medal} {name}\n   🏋️ {weight} кг | ⭐ Ур. {level}\n   👤 {user_display}\n")
-            lines.append("────────────────────")
-            text = "\n".join(lines)
-            markup = kb.back_to_menu_kb(user_id)
+        text, markup = await top_screen(user_id, callback.message.chat)
         await callback.message.edit_text(text, parse_mode=None, reply_markup=markup)
+        if callback.message.chat.type == 'private':
+            remember_screen('top', user_id, text)
         await callback.answer()
+    except db.DatabaseBusy:
+        raise
     except Exception as e:
-        logger.error(f"Ошибка топа: {e}")
+        logger.error("Ошибка топа: %s", e)
         if callback.message:
             await callback.message.edit_text("❌ Ошибка", reply_markup=kb.main_menu_kb(user_id))
         await callback.answer()
 
+# ---------- Арена ----------
+async def show_arena(callback: CallbackQuery, user_id: int, notice: str = ""):
+    macaco = await db.get_or_create_macaco(user_id)
+    bet, queue_size = await db.arena_queue_info(macaco['macaco_id'])
+    status = f"✅ Вы в очереди, ставка {bet} кг" if bet else "Вы не в очереди"
+    text = (
+        f"{notice}"
+        f"🏟 АРЕНА\n"
+        f"────────────────────\n"
+        f"Каждые {arena.ARENA_TICK_SECONDS} сек. макаки в очереди автоматически получают соперника\n"
+        f"близкого веса и уровня. Ставка боя – меньшая из двух.\n"
+        f"────────────────────\n"
+        f"🐒 {macaco['name']} | 🏋️ {macaco['weight']} кг | ⭐ Ур. {macaco['level']}\n"
+        f"👥 В очереди: {queue_size}\n"
+        f"{status}\n\n"
+        f"👇 Выберите ставку:"
+    )
+    await callback.message.edit_text(text, parse_mode=None, reply_markup=kb.arena_kb(user_id, bet is not None))
+    await callback.answer()
+
 # ---------- КОМАНДЫ ----------
 @dp.message(CommandStart())
-async def start_command(message: Message, state: FSMContext):
+async def start_command(message: Message, state: FSMContext, command: CommandObject):
     user = message.from_user
     user_data = {'id': user.id, 'username': user.username, 'first_name': user.first_name, 'last_name': user.last_name}
     await db.get_or_create_user(user_data)
@@ -174,11 +382,21 @@ async def start_command(message: Message, state: FSMContext):
             parse_mode=None
         )
         await state.set_state(Rename.waiting_for_name)
+    elif command.args and command.args.startswith('fight_') and command.args[6:].isdigit():
+        # Кнопка «Вызвать на бой» с карточки из inline-режима
+        opponent_id = int(command.args[6:])
+        text = await opponent_bet_screen(user.id, opponent_id, state)
+        if text is None:
+            await message.answer("❌ Соперник недоступен")
+            await send_main_menu(message.chat.id, user.id)
+            return
+        await message.answer(text, parse_mode=ParseMode.HTML, reply_markup=kb.bet_selection_challenge_kb(user.id, opponent_id))
     else:
         await send_main_menu(message.chat.id, user.id)
 
 @dp.message(Command("help"))
 async def help_command(message: Message):
+    foods = await db.get_foods()
     help_text = (
         "📖 *ПОМОЩЬ: БОЕВЫЕ МАКАКИ PRO*\n"
         "═══════════════════════════════\n\n"
@@ -187,12 +405,15 @@ async def help_command(message: Message):
         "/my    – информация о твоей макаке\n"
         "/rename– сменить имя макаке\n"
         "/top   – топ‑5 самых тяжёлых макак\n"
+        "/stats – статистика боёв и прирост за неделю\n"
+        "/switch – выбрать активную макаку\n"
+        "/notify – вкл/выкл напоминания\n"
         "/help  – эта справка\n\n"
         "🔹 **ЕДА**\n"
-        "🍌 Банан     +1 кг   +30🍖  +10❤️  КД 5ч\n"
-        "🥩 Мясо      +3 кг   +50🍖  +15❤️  КД 8ч\n"
-        "🍰 Торт      +5 кг   +70🍖  +5❤️   КД12ч\n"
-        "🥗 Салат     +2 кг   +40🍖  +12❤️  КД 6ч\n"
+        + "".join(
+            f"{food.name:<10} +{food.weight_gain} кг   +{food.hunger_decrease}🍖  +{food.health_gain}❤️  КД{food.cooldown_hours:>2}ч\n"
+            for food in foods
+        ) +
         "   ❗ При сытости = 0 макака теряет здоровье.\n"
         "   ❗ При настроении = 0 отказывается есть.\n\n"
         "🔹 **ЕЖЕДНЕВНАЯ НАГРАДА** 🎁\n"
@@ -207,6 +428,9 @@ async def help_command(message: Message):
         "   • Результат:\n"
         "     ✅ Победитель: +25 опыта, забирает вес ставки.\n"
         "     ❌ Проигравший: +10 опыта, теряет вес, -20😊, -10❤️.\n\n"
+        "🔹 **АРЕНА** 🏟\n"
+        "   • Встаньте в очередь со ставкой – соперник подберётся автоматически.\n"
+        "   • Пары: уровень ±2, вес отличается не более чем в 1.5 раза.\n\n"
         "🔹 **ХАРАКТЕРИСТИКИ МАКАКИ**\n"
         "   🏋️ Вес       — растёт от еды и побед, падает от поражений.\n"
         "   ⭐ Уровень   — 100 опыта = +1 уровень.\n"
@@ -222,12 +446,12 @@ async def help_command(message: Message):
     try:
         await message.answer(help_text, parse_mode=None, reply_markup=kb.back_to_menu_kb(message.from_user.id))
     except Exception as e:
-        logger.error(f"Ошибка в help_command: {e}", exc_info=True)
+        logger.error("Ошибка в help_command: %s", e, exc_info=True)
         short = (
             "📖 ПОМОЩЬ (кратко)\n"
             "────────────────\n"
-            "/start, /my, /rename, /top, /help\n"
-            "🍌 Еда: +вес, +❤️, +🍖, КД 5-12ч\n"
+            "/start, /my, /rename, /top, /stats, /switch, /help\n"
+            f"🍌 Еда: +вес, +❤️, +🍖, КД {min(f.cooldown_hours for f in foods)}-{max(f.cooldown_hours for f in foods)}ч\n"
             "🎁 Ежедневно: +1 кг, +5❤️, +5😊\n"
             "🚶 Прогулка: 😊=100\n"
             "⚔️ Бой: вызов → ставка → 120сек\n"
@@ -244,25 +468,117 @@ async def my_macaco_command(message: Message):
 async def top_command(message: Message):
     user_id = message.from_user.id
     try:
-        top = await db.get_top_macacos(10)  # ← изменено с 5 на 10
-        if not top:
-            text = "📊 Топ пуст! Будьте первым!"
-            markup = kb.main_menu_kb(user_id)
-        else:
-            lines = ["🏆 ТОП-10 МАКАК 🏆\n", "────────────────────"]
-            medals = ["🥇", "🥈", "🥉"] + [f"{i}." for i in range(4, 11)]
-            for idx, (name, weight, level, username) in enumerate(top[:10]):
-                medal = medals[idx]
-                user_display = f"@{username}" if username else "Без юзернейма"
-                lines.append(f"{medal} {name}\n   🏋️ {weight} кг | ⭐ Ур. {level}\n   👤 {user_display}\n")
-            lines.append("────────────────────")
-            text = "\n".join(lines)
-            markup = kb.back_to_menu_kb(user_id)
+        text, markup = await top_screen(user_id, message.chat)
         await message.answer(text, parse_mode=None, reply_markup=markup)
+        if message.chat.type == 'private':
+            remember_screen('top', user_id, text)
+    except db.DatabaseBusy:
+        raise
+    except Exception as e:
+        logger.error("Ошибка top: %s", e)
+        await message.answer("❌ Ошибка")
+
+@dp.message(Command("stats"))
+async def stats_command(message: Message):
+    # Только агрегаты: fight_stats и роллапы, без чтения fights
+    user_id = message.from_user.id
+    try:
+        macaco = await db.get_or_create_macaco(user_id)
+        stats = await db.get_fight_stats(macaco['macaco_id'])
+        lines = [f"📊 СТАТИСТИКА БОЁВ: {macaco['name']}", "────────────────────"]
+        if not stats:
+            lines.append("Боёв пока не было. Вызовите кого-нибудь или зайдите на арену!")
+        else:
+            total = stats['wins'] + stats['losses']
+            lines.append(f"🥊 Боёв: {total} (✅ {stats['wins']} / ❌ {stats['losses']}, {stats['wins'] / total:.0%} побед)")
+            lines.append(f"🏋️ Выиграно: +{stats['weight_won']} кг, проиграно: -{stats['weight_lost']} кг")
+            if stats['streak'] > 0:
+                lines.append(f"🔥 Серия: {stats['streak']} побед подряд")
+            elif stats['streak'] < 0:
+                lines.append(f"😔 Серия: {-stats['streak']} поражений подряд")
+            lines.append(f"🏆 Лучшая серия: {stats['best_streak']}")
+            day = await db.get_fight_period_stats(macaco['macaco_id'], 24)
+            lines.append(f"🕐 За 24 часа: ✅ {day['wins']} / ❌ {day['losses']}, {day['weight_delta']:+d} кг")
+        for title, days in (("за неделю", 7), ("за месяц", 30)):
+            gainers = await db.get_top_gainers(days, 5)
+            lines += ["────────────────────", f"📈 Прирост в боях {title}:"]
+            if not gainers:
+                lines.append("   пока никого")
+            for idx, g in enumerate(gainers, 1):
+                lines.append(f"{idx}. {g['name']} {g['weight_delta']:+d} кг (✅ {g['wins']} / ❌ {g['losses']})")
+        await message.answer("\n".join(lines), parse_mode=None, reply_markup=kb.back_to_menu_kb(user_id))
+    except db.DatabaseBusy:
+        raise
     except Exception as e:
-        logger.error(f"Ошибка top: {e}")
+        logger.error("Ошибка stats: %s", e)
         await message.answer("❌ Ошибка")
 
+@dp.message(Command("switch"))
+async def switch_command(message: Message):
+    user_id = message.from_user.id
+    macacos = await db.list_user_macacos(user_id)
+    if len(macacos) < 2:
+        await message.answer("🐒 У вас одна макака – переключаться не на кого.", reply_markup=kb.back_to_menu_kb(user_id))
+        return
+    await message.answer("🔁 Выберите активную макаку – она кормится, дерётся и стоит в топе:",
+                         reply_markup=kb.switch_macaco_kb(user_id, macacos))
+
+@dp.message(Command("profile"))
+async def profile_command(message: Message, command: CommandObject):
+    # /profile [wall|async] [30 | 30s | 200u] – секунды или число апдейтов; /profile stop – остановить досрочно
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = (command.args or '').split()
+    if args == ['stop']:
+        if not profiler.active:
+            await message.answer("🔬 Профилирование не запущено")
+        else:
+            await profiler.stop()  # файлы пришлёт задача, запущенная вместе с профилированием
+        return
+    mode = args.pop(0) if args and args[0] in PROFILE_MODES else 'wall'
+    limit = args[0] if args else '30s'
+    if not (limit.rstrip('su').isdigit() and int(limit.rstrip('su')) > 0):
+        await message.answer(f"Использование: /profile [{'|'.join(PROFILE_MODES)}] [30 | 30s | 200u] или /profile stop")
+        return
+    seconds, updates = (None, int(limit[:-1])) if limit.endswith('u') else (int(limit.rstrip('s')), None)
+    if profiler.active:
+        await message.answer(f"🔬 Уже идёт профилирование ({profiler.mode})")
+        return
+    finished = profiler.start(mode, seconds=seconds, updates=updates)
+    await message.answer(f"🔬 Профилирование ({mode}) запущено в процессе {os.getpid()}: "
+                         f"{f'{seconds} с' if seconds else f'{updates} апдейтов'}")
+    spawn(send_profile(message.chat.id, finished), 'send_profile')
+
+async def send_profile(chat_id: int, finished: asyncio.Future):
+    paths = await finished
+    for path in paths:
+        try:
+            await bot.send_document(chat_id, FSInputFile(path))
+        except Exception as e:
+            logger.warning("Не удалось отправить %s: %s", path, e)
+
+def toggle_profiling():
+    # SIGUSR1: включает профилирование на PROFILE_SIGNAL_SECONDS, повторный сигнал – останавливает; файлы – в PROFILE_DIR
+    if profiler.active:
+        spawn(profiler.stop(), 'profiler_stop')
+    else:
+        profiler.start('wall', seconds=PROFILE_SIGNAL_SECONDS)
+
+def install_profiling_signal():
+    # Ставится в каждом процессе: без обработчика SIGUSR1 по умолчанию завершает процесс
+    if hasattr(signal, 'SIGUSR1'):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, toggle_profiling)
+
+@dp.message(Command("notify"))
+async def notify_command(message: Message):
+    enabled = await db.toggle_notifications(message.from_user.id)
+    if enabled is None:
+        await message.answer("Сначала запустите игру: /start")
+    elif enabled:
+        await message.answer("🔔 Уведомления включены: напомню про награду, еду и голод.")
+    else:
+        await message.answer("🔕 Уведомления выключены. Включить снова: /notify")
+
 @dp.message(Command("rename"))
 async def rename_command(message: Message, state: FSMContext):
     user_id = message.from_user.id
@@ -288,9 +604,8 @@ async def process_new_name(message: Message, state: FSMContext):
         await message.answer("❌ Недопустимые символы.\nПопробуйте ещё раз:")
         return
 
-    pool = await db.get_pool()
-    async with pool.acquire() as conn:
-        await conn.execute('UPDATE macacos SET name = $1 WHERE user_id = $2', new_name, user_id)
+    macaco_id = await db.rename_active_macaco(user_id, new_name)
+    events.emit('rename', user_id, macaco_id, name=new_name)
 
     # Если есть ссылка на группу, отправляем приглашение (только при первом именовании – всегда сейчас)
     if GROUP_INVITE_LINK:
@@ -307,389 +622,436 @@ async def process_new_name(message: Message, state: FSMContext):
     await send_main_menu(message.chat.id, user_id)
     await state.clear()
 
-# ---------- Универсальный обработчик защищённых callback ----------
-@dp.callback_query(F.data.contains(":"))
-async def protected_callback_handler(callback: CallbackQuery, state: FSMContext):
-    parts = callback.data.split(":")
-    if len(parts) < 2:
-        await callback.answer("Ошибка данных", show_alert=True)
-        return
-    action = parts[0]
-    try:
-        owner_id = int(parts[1])
-    except ValueError:
-        await callback.answer("Ошибка идентификатора", show_alert=True)
-        return
+# ---------- Callback-кнопки: таблица действий ----------
+# callback_data собирается и разбирается в callbacks.py; здесь – действие -> обработчик
+callback_handlers: Dict[str, Callable[..., Awaitable[None]]] = {}
+
+def on_callback(name: str):
+    def register(handler):
+        callback_handlers[name] = handler
+        return handler
+    return register
 
+@dp.callback_query()
+async def callback_router(callback: CallbackQuery, state: FSMContext):
     current_user_id = callback.from_user.id
+    decoded = cb.decode(callback.data)
+    if decoded is None:
+        # Кнопка старого формата или подделанные данные
+        await callback.answer("Кнопка устарела", show_alert=True)
+        await send_main_menu(callback.message.chat.id, current_user_id)
+        return
 
-    if current_user_id != owner_id:
+    if decoded.action.owner_only and current_user_id != decoded.owner_id:
         await callback.answer()
         await send_main_menu(callback.message.chat.id, current_user_id)
         return
 
-    # ---------- Обработка основных действий ----------
-    if action == "my_macaco":
-        await show_my_macaco(current_user_id, callback)
-
-    elif action == "select_food":
-        macaco = await db.get_or_create_macaco(current_user_id)
-        safe_name = html.escape(macaco['name'])
-        text = (
-            f"<b>Меню макаки {safe_name}</b> 🐒\n\n"
-            "🍽️ Выберите еду:\n\n"
-            "🍌 Банан: +1 кг, КД 5ч, +30 🍖, +10 ❤️\n"
-            "🥩 Мясо: +3 кг, КД 8ч, +50 🍖, +15 ❤️\n"
-            "🍰 Торт: +5 кг, КД 12ч, +70 🍖, +5 ❤️\n"
-            "🥗 Салат: +2 кг, КД 6ч, +40 🍖, +12 ❤️"
+    handler = callback_handlers.get(decoded.action.name)
+    if handler is None:
+        await callback.answer("Неизвестное действие", show_alert=True)
+        return
+    await handler(callback, state, decoded.owner_id, *decoded.args)
+
+# ---------- Основные действия ----------
+@on_callback("my_macaco")
+async def my_macaco_callback(callback: CallbackQuery, state: FSMContext, user_id: int):
+    await show_my_macaco(user_id, callback)
+
+@on_callback("select_food")
+async def select_food_callback(callback: CallbackQuery, state: FSMContext, user_id: int):
+    macaco = await db.get_or_create_macaco(user_id)
+    foods = await db.get_foods()
+    safe_name = html.escape(macaco['name'])
+    text = (
+        f"<b>Меню макаки {safe_name}</b> 🐒\n\n"
+        "🍽️ Выберите еду:\n\n"
+        + "\n".join(
+            f"{html.escape(food.name)}: +{food.weight_gain} кг, КД {food.cooldown_hours}ч, "
+            f"+{food.hunger_decrease} 🍖, +{food.health_gain} ❤️"
+            for food in foods
         )
-        markup = kb.food_selection_kb(current_user_id)
-        await callback.message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
-        await callback.answer()
+    )
+    markup = kb.food_selection_kb(user_id, foods)
+    await callback.message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+    await callback.answer()
+
+@on_callback("food")
+async def food_callback(callback: CallbackQuery, state: FSMContext, user_id: int, food_id: int):
+    macaco = await db.get_or_create_macaco(user_id)
+    safe_name = html.escape(macaco['name'])
+    food = await db.get_food_info_cached(food_id)
+    if not food:
+        await callback.answer("❌ Еда не найдена")
+        return
+    text = (
+        f"<b>Меню макаки {safe_name}</b> 🐒\n\n"
+        f"{html.escape(food.name)}\n"
+        f"────────────────────\n"
+        f"🏋️ +{food.weight_gain} кг\n"
+        f"🍖 +{food.hunger_decrease}\n"
+        f"❤️ +{food.health_gain}\n"
+        f"⏳ КД {food.cooldown_hours} ч\n"
+        f"────────────────────\n"
+        f"Покормить этой едой?"
+    )
+    markup = kb.food_info_kb(food_id, user_id)
+    await callback.message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+    await callback.answer()
+
+@on_callback("feed")
+async def feed_callback(callback: CallbackQuery, state: FSMContext, user_id: int, food_id: int):
+    try:
+        macaco = await db.get_macaco_with_decay(user_id)
+
+        if macaco['happiness'] <= 0:
+            await callback.message.edit_text(
+                "🥺 Я расстроена…\nСначала подними мне настроение прогулкой!",
+                parse_mode=None,
+                reply_markup=kb.main_menu_kb(user_id)
+            )
+            await callback.answer()
+            return
 
-    elif action.startswith("food_"):
-        macaco = await db.get_or_create_macaco(current_user_id)
-        safe_name = html.escape(macaco['name'])
-        food_id = int(action.split("_")[1])
         food = await db.get_food_info_cached(food_id)
         if not food:
             await callback.answer("❌ Еда не найдена")
             return
-        text = (
-            f"<b>Меню макаки {safe_name}</b> 🐒\n\n"
-            f"{food['name']}\n"
-            f"────────────────────\n"
-            f"🏋️ +{food['weight_gain']} кг\n"
-            f"🍖 +{food['hunger_decrease']}\n"
-            f"❤️ +{food['health_gain']}\n"
-            f"⏳ КД {food['cooldown_hours']} ч\n"
-            f"────────────────────\n"
-            f"Покормить этой едой?"
-        )
-        markup = kb.food_info_kb(food_id, current_user_id)
-        await callback.message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
-        await callback.answer()
-
-    elif action.startswith("feed_"):
-        food_id = int(action.split("_")[1])
-        user_id = current_user_id
-        try:
-            macaco = await db.get_macaco_with_decay(user_id)
 
-            if macaco['happiness'] <= 0:
-                await callback.message.edit_text(
-                    "🥺 Я расстроена…\nСначала подними мне настроение прогулкой!",
-                    parse_mode=None,
-                    reply_markup=kb.main_menu_kb(user_id)
-                )
-                await callback.answer()
-                return
-
-            food = await db.get_food_info_cached(food_id)
-            if not food:
-                await callback.answer("❌ Еда не найдена")
-                return
+        can_feed, time_left = await db.can_feed_food(macaco['macaco_id'], food_id)
+        if not can_feed:
+            await callback.message.edit_text(
+                f"⏳ Нельзя кормить {food.name}!\nДо следующего раза: {time_left}",
+                parse_mode=None,
+                reply_markup=kb.food_selection_kb(user_id, await db.get_foods())
+            )
+            await callback.answer()
+            return
 
-            can_feed, time_left = await db.can_feed_food(macaco['macaco_id'], food_id)
-            if not can_feed:
-                await callback.message.edit_text(
-                    f"⏳ Нельзя кормить {food['name']}!\nДо следующего раза: {time_left}",
-                    parse_mode=None,
-                    reply_markup=kb.food_selection_kb(user_id)
-                )
-                await callback.answer()
-                return
+        await db.feed_macaco_with_food(macaco['macaco_id'], food_id)
+        macaco = await db.get_or_create_macaco(user_id)
+        events.emit('feed', user_id, macaco['macaco_id'], food_id=food_id, weight_gain=food.weight_gain,
+                    hunger_decrease=food.hunger_decrease, health_gain=food.health_gain, weight=macaco['weight'])
+
+        await callback.message.answer(
+            f"🍽️ Макака поела {food.name}!\n"
+            f"🏋️ Вес: +{food.weight_gain} кг (теперь {macaco['weight']} кг)\n"
+            f"❤️ Здоровье: +{food.health_gain} (теперь {macaco['health']}/100)\n"
+            f"🍖 Сытость: +{food.hunger_decrease} (теперь {100 - macaco['hunger']}/100)\n"
+            f"😊 Настроение: {macaco['happiness']}/100",
+            parse_mode=None
+        )
+        await callback.message.edit_text(
+            f"✅ Макака накормлена!\n\n"
+            f"🍽️ {food.name}\n"
+            f"🏋️ Вес: {macaco['weight']} кг\n"
+            f"❤️ Здоровье: {macaco['health']}/100\n"
+            f"🍖 Сытость: {100 - macaco['hunger']}/100\n"
+            f"😊 Настроение: {macaco['happiness']}/100",
+            parse_mode=None,
+            reply_markup=kb.main_menu_kb(user_id)
+        )
+    except db.DatabaseBusy:
+        raise
+    except Exception as e:
+        logger.error("Ошибка кормления: %s", e)
+        await callback.message.edit_text("❌ Ошибка при кормлении", reply_markup=kb.main_menu_kb(user_id))
+    await callback.answer()
 
-            await db.feed_macaco_with_food(macaco['macaco_id'], food_id)
-            macaco = await db.get_or_create_macaco(user_id)
+@on_callback("daily_reward")
+async def daily_reward_callback(callback: CallbackQuery, state: FSMContext, user_id: int):
+    try:
+        macaco = await db.get_macaco_with_decay(user_id)
 
-            await callback.message.answer(
-                f"🍽️ Макака поела {food['name']}!\n"
-                f"🏋️ Вес: +{food['weight_gain']} кг (теперь {macaco['weight']} кг)\n"
-                f"❤️ Здоровье: +{food['health_gain']} (теперь {macaco['health']}/100)\n"
-                f"🍖 Сытость: +{food['hunger_decrease']} (теперь {100 - macaco['hunger']}/100)\n"
-                f"😊 Настроение: {macaco['happiness']}/100",
-                parse_mode=None
-            )
+        can, time_left = await db.can_get_daily(macaco['macaco_id'])
+        if not can:
             await callback.message.edit_text(
-                f"✅ Макака накормлена!\n\n"
-                f"🍽️ {food['name']}\n"
-                f"🏋️ Вес: {macaco['weight']} кг\n"
-                f"❤️ Здоровье: {macaco['health']}/100\n"
-                f"🍖 Сытость: {100 - macaco['hunger']}/100\n"
-                f"😊 Настроение: {macaco['happiness']}/100",
+                f"⏳ Награда ещё не доступна. Следующая через: {time_left}",
                 parse_mode=None,
                 reply_markup=kb.main_menu_kb(user_id)
             )
-        except Exception as e:
-            logger.error(f"Ошибка кормления: {e}")
-            await callback.message.edit_text("❌ Ошибка при кормлении", reply_markup=kb.main_menu_kb(user_id))
-        await callback.answer()
+            await callback.answer()
+            return
 
-    elif action == "daily_reward":
-        user_id = current_user_id
-        try:
-            macaco = await db.get_macaco_with_decay(user_id)
-
-            can, time_left = await db.can_get_daily(macaco['macaco_id'])
-            if not can:
-                await callback.message.edit_text(
-                    f"⏳ Награда ещё не доступна. Следующая через: {time_left}",
-                    parse_mode=None,
-                    reply_markup=kb.main_menu_kb(user_id)
-                )
-                await callback.answer()
-                return
+        await db.give_daily_reward(macaco['macaco_id'])
+        macaco = await db.get_or_create_macaco(user_id)
+        events.emit('daily', user_id, macaco['macaco_id'], weight_gain=cfg.DAILY_WEIGHT,
+                    happiness_gain=cfg.DAILY_HAPPINESS, health_gain=cfg.DAILY_HEALTH, weight=macaco['weight'])
 
-            await db.give_daily_reward(macaco['macaco_id'])
-            macaco = await db.get_or_create_macaco(user_id)
-
-            # Если сообщение в группе, отправляем гифку в ЛС
-            chat = callback.message.chat
-            if chat.type != 'private':
-                try:
-                    await send_gif(
-                        user_id,
-                        'daily',
-                        'reward',
-                        caption=f"Текущий вес: {macaco['weight']} кг",
-                        parse_mode=None
-                    )
-                except Exception as e:
-                    logger.warning(f"Не удалось отправить гифку в ЛС: {e}")
-            else:
-                # Если уже в личке, отправляем гифку прямо сюда
+        # Если сообщение в группе, отправляем гифку в ЛС
+        chat = callback.message.chat
+        if chat.type != 'private':
+            try:
                 await send_gif(
-                    chat.id,
+                    user_id,
                     'daily',
                     'reward',
                     caption=f"Текущий вес: {macaco['weight']} кг",
                     parse_mode=None
                 )
-
-            await callback.message.edit_text(
-                f"✅ Ежедневная награда получена!\n\n"
-                f"🎁 +1 кг веса\n"
-                f"❤️ +5 здоровья\n"
-                f"😊 +5 настроения\n"
-                f"🏋️ Текущий вес: {macaco['weight']} кг\n"
-                f"❤️ Здоровье: {macaco['health']}/100\n"
-                f"😊 Настроение: {macaco['happiness']}/100",
-                parse_mode=None,
-                reply_markup=kb.main_menu_kb(user_id)
+            except Exception as e:
+                logger.warning("Не удалось отправить гифку в ЛС: %s", e)
+        else:
+            # Если уже в личке, отправляем гифку прямо сюда
+            await send_gif(
+                chat.id,
+                'daily',
+                'reward',
+                caption=f"Текущий вес: {macaco['weight']} кг",
+                parse_mode=None
             )
-        except Exception as e:
-            logger.error(f"Ошибка ежедневки: {e}")
-            await callback.message.edit_text("❌ Ошибка", reply_markup=kb.main_menu_kb(user_id))
-        await callback.answer()
 
-    elif action == "walk_macaco":
-        user_id = current_user_id
-        try:
-            macaco = await db.get_macaco_with_decay(user_id)
-            await db.walk_macaco(macaco['macaco_id'])
-            macaco = await db.get_or_create_macaco(user_id)
+        await callback.message.edit_text(
+            f"✅ Ежедневная награда получена!\n\n"
+            f"🎁 +1 кг веса\n"
+            f"❤️ +5 здоровья\n"
+            f"😊 +5 настроения\n"
+            f"🏋️ Текущий вес: {macaco['weight']} кг\n"
+            f"❤️ Здоровье: {macaco['health']}/100\n"
+            f"😊 Настроение: {macaco['happiness']}/100",
+            parse_mode=None,
+            reply_markup=kb.main_menu_kb(user_id)
+        )
+    except db.DatabaseBusy:
+        raise
+    except Exception as e:
+        logger.error("Ошибка ежедневки: %s", e)
+        await callback.message.edit_text("❌ Ошибка", reply_markup=kb.main_menu_kb(user_id))
+    await callback.answer()
 
-            await callback.message.edit_text(
-                f"🚶 Прогулка успешна!\n\n"
-                f"😊 Настроение полностью восстановлено (100)\n"
-                f"❤️ Здоровье осталось без изменений: {macaco['health']}/100",
-                parse_mode=None,
-                reply_markup=kb.main_menu_kb(user_id)
-            )
-        except Exception as e:
-            logger.error(f"Ошибка прогулки: {e}")
-            await callback.message.edit_text("❌ Ошибка", reply_markup=kb.main_menu_kb(user_id))
-        await callback.answer()
+@on_callback("walk_macaco")
+async def walk_macaco_callback(callback: CallbackQuery, state: FSMContext, user_id: int):
+    try:
+        macaco = await db.get_macaco_with_decay(user_id)
+        await db.walk_macaco(macaco['macaco_id'])
+        macaco = await db.get_or_create_macaco(user_id)
+        events.emit('walk', user_id, macaco['macaco_id'], happiness=macaco['happiness'])
 
-    elif action == "top_weight":
-        await show_top_players(callback, current_user_id)
+        await callback.message.edit_text(
+            f"🚶 Прогулка успешна!\n\n"
+            f"😊 Настроение полностью восстановлено (100)\n"
+            f"❤️ Здоровье осталось без изменений: {macaco['health']}/100",
+            parse_mode=None,
+            reply_markup=kb.main_menu_kb(user_id)
+        )
+    except db.DatabaseBusy:
+        raise
+    except Exception as e:
+        logger.error("Ошибка прогулки: %s", e)
+        await callback.message.edit_text("❌ Ошибка", reply_markup=kb.main_menu_kb(user_id))
+    await callback.answer()
 
-    elif action == "help_info":
-        await callback.answer()
-        await help_command(callback.message)
+@on_callback("top_weight")
+async def top_weight_callback(callback: CallbackQuery, state: FSMContext, user_id: int):
+    await show_top_players(callback, user_id)
 
-    elif action == "main_menu":
-        await send_main_menu(callback.message.chat.id, current_user_id)
-        await callback.answer()
+@on_callback("help_info")
+async def help_info_callback(callback: CallbackQuery, state: FSMContext, user_id: int):
+    await callback.answer()
+    await help_command(callback.message)
 
-    elif action == "cancel_fight":
-        await callback.message.edit_text("❌ Бой отменён", reply_markup=kb.main_menu_kb(current_user_id))
-        await callback.answer()
+@on_callback("main_menu")
+async def main_menu_callback(callback: CallbackQuery, state: FSMContext, user_id: int):
+    await send_main_menu(callback.message.chat.id, user_id)
+    await callback.answer()
 
-    # ---------- ВЫЗОВ НА БОЙ ----------
-    elif action == "challenge_fight":
-        user_id = current_user_id
-        user_macaco = await db.get_macaco_with_decay(user_id)
+@on_callback("switch_macaco")
+async def switch_macaco_callback(callback: CallbackQuery, state: FSMContext, user_id: int, macaco_id: int):
+    macaco = await db.set_active_macaco(user_id, macaco_id)
+    if macaco is None:
+        await callback.answer("❌ Эта макака вам не принадлежит", show_alert=True)
+        return
+    await state.clear()  # начатый выбор соперника относился к прежней макаке
+    await callback.answer(f"✅ Активная макака: {macaco['name']}")
+    await send_main_menu(callback.message.chat.id, user_id)
 
-        if user_macaco['health'] <= 0:
-            await callback.message.edit_text("💔 Слишком слаб для боя! Восстанови здоровье.", reply_markup=kb.main_menu_kb(user_id))
-            await callback.answer()
-            return
+@on_callback("arena")
+async def arena_callback(callback: CallbackQuery, state: FSMContext, user_id: int):
+    await show_arena(callback, user_id)
 
-        if 100 - user_macaco['hunger'] <= 60:
-            await callback.message.edit_text("🍖 Слишком голоден для боя! Покорми макаку.", reply_markup=kb.main_menu_kb(user_id))
-            await callback.answer()
-            return
+@on_callback("arena_bet")
+async def arena_bet_callback(callback: CallbackQuery, state: FSMContext, user_id: int, bet_amount: int):
+    if bet_amount not in cfg.FIGHT_BETS:
+        await callback.answer("Ошибка данных", show_alert=True)
+        return
+    macaco = await db.get_macaco_with_decay(user_id)
+    if macaco['health'] <= 0:
+        await callback.answer("💔 Слишком слаб для боя! Восстанови здоровье.", show_alert=True)
+        return
+    if 100 - macaco['hunger'] <= cfg.FIGHT_MIN_SATIETY:
+        await callback.answer("🍖 Слишком голоден для боя! Покорми макаку.", show_alert=True)
+        return
+    can, msg = await db.can_make_bet(macaco['macaco_id'], bet_amount)
+    if not can:
+        await callback.answer(f"❌ {msg}", show_alert=True)
+        return
+    await db.arena_join(macaco['macaco_id'], user_id, bet_amount)
+    await show_arena(callback, user_id, notice=f"✅ Вы на арене со ставкой {bet_amount} кг!\n\n")
 
-        pool = await db.get_pool()
-        async with pool.acquire() as conn:
-            opponents = await conn.fetch('''
-                SELECT macaco_id, name, weight, level, user_id FROM macacos WHERE user_id != $1
-            ''', user_id)
+@on_callback("arena_leave")
+async def arena_leave_callback(callback: CallbackQuery, state: FSMContext, user_id: int):
+    macaco = await db.get_or_create_macaco(user_id)
+    await db.arena_leave(macaco['macaco_id'])
+    await show_arena(callback, user_id, notice="🚪 Вы покинули арену.\n\n")
 
-        if not opponents:
-            await callback.message.edit_text("😕 Нет соперников!", reply_markup=kb.main_menu_kb(user_id))
-            await callback.answer()
-            return
+@on_callback("cancel_fight")
+async def cancel_fight_callback(callback: CallbackQuery, state: FSMContext, user_id: int):
+    await callback.message.edit_text("❌ Бой отменён", reply_markup=kb.main_menu_kb(user_id))
+    await callback.answer()
 
-        safe_name = html.escape(user_macaco['name'])
-        header = f"<b>Меню макаки {safe_name}</b> 🐒\n\n"
-        await state.update_data(opponents_list=opponents, challenger_id=user_id)
-
-        btns = []
-        for opp in opponents[:10]:
-            opp_id, name, weight, level, _ = opp
-            btns.append([InlineKeyboardButton(text=f"{name} | 🏋️ {weight} кг | ⭐ {level}", callback_data=f"select_opp:{user_id}:{opp_id}")])
-        btns.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"main_menu:{user_id}")])
-        markup = InlineKeyboardMarkup(inline_keyboard=btns)
-        await callback.message.edit_text(header + "🥊 Выберите соперника:", parse_mode=ParseMode.HTML, reply_markup=markup)
-        await callback.answer()
+# ---------- ВЫЗОВ НА БОЙ ----------
+@on_callback("challenge_fight")
+async def challenge_fight_callback(callback: CallbackQuery, state: FSMContext, user_id: int):
+    user_macaco = await db.get_macaco_with_decay(user_id)
 
-    elif action == "select_opp":
-        if len(parts) != 3:
-            await callback.answer("Ошибка данных", show_alert=True)
-            return
-        try:
-            opponent_id = int(parts[2])
-        except ValueError:
-            await callback.answer("Ошибка данных соперника", show_alert=True)
-            return
+    if user_macaco['health'] <= 0:
+        await callback.message.edit_text("💔 Слишком слаб для боя! Восстанови здоровье.", reply_markup=kb.main_menu_kb(user_id))
+        await callback.answer()
+        return
 
-        user_id = current_user_id
-        macaco = await db.get_or_create_macaco(user_id)
-        safe_name = html.escape(macaco['name'])
-        pool = await db.get_pool()
-        async with pool.acquire() as conn:
-            opp = await conn.fetchrow('SELECT name, weight, level FROM macacos WHERE macaco_id = $1', opponent_id)
-        if not opp:
-            await callback.message.edit_text("❌ Соперник недоступен", reply_markup=kb.main_menu_kb(user_id))
-            await callback.answer()
-            return
+    if 100 - user_macaco['hunger'] <= cfg.FIGHT_MIN_SATIETY:
+        await callback.message.edit_text("🍖 Слишком голоден для боя! Покорми макаку.", reply_markup=kb.main_menu_kb(user_id))
+        await callback.answer()
+        return
 
-        await state.update_data(challenge_opponent_id=opponent_id, opponent_name=opp['name'])
+    opponents = await db.list_opponents(user_id, 10)
 
-        text = (
-            f"<b>Меню макаки {safe_name}</b> 🐒\n\n"
-            f"⚔️ Вызов на бой\n────────────────────\n"
-            f"🥊 Соперник: {opp['name']}\n🏋️ Вес: {opp['weight']} кг\n⭐ Уровень: {opp['level']}\n────────────────────\n"
-            f"👇 Выберите ставку:"
-        )
-        markup = kb.bet_selection_challenge_kb(user_id, opponent_id)
-        await callback.message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+    if not opponents:
+        await callback.message.edit_text("😕 Нет соперников!", reply_markup=kb.main_menu_kb(user_id))
         await callback.answer()
+        return
 
-    elif action.startswith("challenge_bet_"):
-        if len(parts) != 3:
-            await callback.answer("Ошибка данных", show_alert=True)
-            return
-        bet_amount = int(action.split("_")[2])
-        opponent_id = int(parts[2])
-        user_id = current_user_id
+    safe_name = html.escape(user_macaco['name'])
+    header = f"<b>Меню макаки {safe_name}</b> 🐒\n\n"
+    await state.update_data(opponents_list=opponents, challenger_id=user_id)
+
+    btns = []
+    for opp in opponents:
+        btns.append([InlineKeyboardButton(text=f"{opp['name']} | 🏋️ {opp['weight']} кг | ⭐ {opp['level']}",
+                                          callback_data=cb.encode("select_opp", user_id, opp['macaco_id']))])
+    btns.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=cb.encode("main_menu", user_id))])
+    markup = InlineKeyboardMarkup(inline_keyboard=btns)
+    await callback.message.edit_text(header + "🥊 Выберите соперника:", parse_mode=ParseMode.HTML, reply_markup=markup)
+    await callback.answer()
 
-        user_macaco = await db.get_macaco_with_decay(user_id)
+async def opponent_bet_screen(user_id: int, opponent_id: int, state: FSMContext) -> Optional[str]:
+    """Текст выбора ставки против соперника; None – соперника нет или это своя же макака."""
+    macaco = await db.get_or_create_macaco(user_id)
+    safe_name = html.escape(macaco['name'])
+    opp = await db.get_macaco_card(opponent_id)
+    if not opp or opp['user_id'] == user_id:
+        return None
 
-        can, msg = await db.can_make_bet(user_macaco['macaco_id'], bet_amount)
-        if not can:
-            await callback.message.edit_text(f"❌ {msg}", reply_markup=kb.main_menu_kb(user_id))
-            await callback.answer()
-            return
+    await state.update_data(challenge_opponent_id=opponent_id, opponent_name=opp['name'])
 
-        pool = await db.get_pool()
-        async with pool.acquire() as conn:
-            opp_data = await conn.fetchrow('SELECT name, weight, user_id FROM macacos WHERE macaco_id = $1', opponent_id)
-        if not opp_data:
-            await callback.message.edit_text("❌ Соперник недоступен", reply_markup=kb.main_menu_kb(user_id))
-            await callback.answer()
-            return
-        opp_name, opp_weight, opp_user_id = opp_data['name'], opp_data['weight'], opp_data['user_id']
+    return (
+        f"<b>Меню макаки {safe_name}</b> 🐒\n\n"
+        f"⚔️ Вызов на бой\n────────────────────\n"
+        f"🥊 Соперник: {html.escape(opp['name'])}\n🏋️ Вес: {opp['weight']} кг\n⭐ Уровень: {opp['level']}\n────────────────────\n"
+        f"👇 Выберите ставку:"
+    )
 
-        if opp_weight < bet_amount:
-            await callback.message.edit_text(f"❌ У соперника недостаточно веса!", parse_mode=None,
-                                             reply_markup=kb.main_menu_kb(user_id))
-            await callback.answer()
-            return
+@on_callback("select_opp")
+async def select_opp_callback(callback: CallbackQuery, state: FSMContext, user_id: int, opponent_id: int):
+    text = await opponent_bet_screen(user_id, opponent_id, state)
+    if text is None:
+        await callback.message.edit_text("❌ Соперник недоступен", reply_markup=kb.main_menu_kb(user_id))
+        await callback.answer()
+        return
+    markup = kb.bet_selection_challenge_kb(user_id, opponent_id)
+    await callback.message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+    await callback.answer()
 
-        try:
-            await bot.send_chat_action(opp_user_id, action="typing")
-        except:
-            await callback.message.edit_text(f"😕 Соперник ({opp_name}) ещё не запускал бота.", reply_markup=kb.main_menu_kb(user_id))
-            await callback.answer()
-            return
+@on_callback("challenge_bet")
+async def challenge_bet_callback(callback: CallbackQuery, state: FSMContext, user_id: int, bet_amount: int, opponent_id: int):
+    if bet_amount not in cfg.FIGHT_BETS:
+        await callback.answer("Ошибка данных", show_alert=True)
+        return
 
-        global challenge_counter
-        challenge_counter += 1
-        cid = f"{user_id}-{opponent_id}-{challenge_counter}"
-        challenge_text = (
-            f"⚔️ Вас вызывают на бой!\n\n"
-            f"🐒 Противник: {user_macaco['name']}\n"
-            f"🏋️ Вес: {user_macaco['weight']} кг\n"
-            f"⭐ Уровень: {user_macaco['level']}\n"
-            f"💰 Ставка: {bet_amount} кг\n\n"
-            f"У вас есть 120 секунд."
-        )
-        try:
-            challenge_msg = await bot.send_message(opp_user_id, challenge_text, parse_mode=None,
-                                                   reply_markup=kb.challenge_response_kb(cid, bet_amount))
-        except Exception as e:
-            logger.error(f"Не удалось отправить вызов: {e}")
-            await callback.message.edit_text("❌ Не удалось отправить вызов", reply_markup=kb.main_menu_kb(user_id))
-            await callback.answer()
-            return
+    user_macaco = await db.get_macaco_with_decay(user_id)
 
-        async def timeout():
-            await asyncio.sleep(120)
-            if cid in active_challenges:
-                del active_challenges[cid]
-                try:
-                    await challenge_msg.edit_text(f"⏳ Время вышло. Вызов от {user_macaco['name']} отклонён.")
-                    await callback.message.edit_text("⏳ Соперник не ответил.", reply_markup=kb.main_menu_kb(user_id))
-                except:
-                    pass
-
-        task = asyncio.create_task(timeout())
-        active_challenges[cid] = {
-            'challenger_id': user_id,
-            'challenger_macaco_id': user_macaco['macaco_id'],
-            'challenger_name': user_macaco['name'],
-            'opponent_id': opp_user_id,
-            'opponent_macaco_id': opponent_id,
-            'opponent_name': opp_name,
-            'bet': bet_amount,
-            'message': challenge_msg,
-            'task': task,
-            'challenge_msg_id': callback.message.message_id,
-            'challenge_chat_id': callback.message.chat.id
-        }
+    can, msg = await db.can_make_bet(user_macaco['macaco_id'], bet_amount)
+    if not can:
+        await callback.message.edit_text(f"❌ {msg}", reply_markup=kb.main_menu_kb(user_id))
+        await callback.answer()
+        return
 
-        await callback.message.edit_text(
-            f"✅ Вызов отправлен!\n\n🥊 Соперник: {opp_name}\n💰 Ставка: {bet_amount} кг\n\nОжидайте ответа... (120 сек)",
-            parse_mode=None, reply_markup=kb.main_menu_kb(user_id)
-        )
+    opp_data = await db.get_macaco_card(opponent_id)
+    if not opp_data:
+        await callback.message.edit_text("❌ Соперник недоступен", reply_markup=kb.main_menu_kb(user_id))
         await callback.answer()
-        await state.clear()
+        return
+    opp_name, opp_weight, opp_user_id = opp_data['name'], opp_data['weight'], opp_data['user_id']
 
-    else:
-        await callback.answer("Неизвестное действие", show_alert=True)
+    if opp_weight < bet_amount:
+        await callback.message.edit_text(f"❌ У соперника недостаточно веса!", parse_mode=None,
+                                         reply_markup=kb.main_menu_kb(user_id))
+        await callback.answer()
+        return
+
+    try:
+        await bot.send_chat_action(opp_user_id, action="typing")
+    except:
+        await callback.message.edit_text(f"😕 Соперник ({opp_name}) ещё не запускал бота.", reply_markup=kb.main_menu_kb(user_id))
+        await callback.answer()
+        return
 
-# ---------- Обработчики для ответа на вызов (без owner_id – личные сообщения) ----------
-@dp.callback_query(F.data.startswith("accept_fight_"))
-async def accept_fight_callback(callback: CallbackQuery):
-    parts = callback.data.split("_")
-    if len(parts) != 3:
-        await callback.answer("❌ Ошибка данных")
+    global challenge_counter
+    challenge_counter += 1
+    cid = (user_id, opponent_id, challenge_counter)
+    challenge_text = (
+        f"⚔️ Вас вызывают на бой!\n\n"
+        f"🐒 Противник: {user_macaco['name']}\n"
+        f"🏋️ Вес: {user_macaco['weight']} кг\n"
+        f"⭐ Уровень: {user_macaco['level']}\n"
+        f"💰 Ставка: {bet_amount} кг\n\n"
+        f"У вас есть 120 секунд."
+    )
+    try:
+        challenge_msg = await bot.send_message(opp_user_id, challenge_text, parse_mode=None,
+                                               reply_markup=kb.challenge_response_kb(cid))
+    except Exception as e:
+        logger.error("Не удалось отправить вызов: %s", e)
+        await callback.message.edit_text("❌ Не удалось отправить вызов", reply_markup=kb.main_menu_kb(user_id))
+        await callback.answer()
         return
-    cid = parts[2]
+
+    async def timeout():
+        await asyncio.sleep(120)
+        if cid in active_challenges:
+            del active_challenges[cid]
+            try:
+                await challenge_msg.edit_text(f"⏳ Время вышло. Вызов от {user_macaco['name']} отклонён.")
+                await callback.message.edit_text("⏳ Соперник не ответил.", reply_markup=kb.main_menu_kb(user_id))
+            except:
+                pass
+
+    task = asyncio.create_task(timeout())
+    active_challenges[cid] = {
+        'challenger_id': user_id,
+        'challenger_macaco_id': user_macaco['macaco_id'],
+        'challenger_name': user_macaco['name'],
+        'opponent_id': opp_user_id,
+        'opponent_macaco_id': opponent_id,
+        'opponent_name': opp_name,
+        'bet': bet_amount,
+        'message': challenge_msg,
+        'task': task,
+        'challenge_msg_id': callback.message.message_id,
+        'challenge_chat_id': callback.message.chat.id
+    }
+
+    await callback.message.edit_text(
+        f"✅ Вызов отправлен!\n\n🥊 Соперник: {opp_name}\n💰 Ставка: {bet_amount} кг\n\nОжидайте ответа... (120 сек)",
+        parse_mode=None, reply_markup=kb.main_menu_kb(user_id)
+    )
+    await callback.answer()
+    await state.clear()
+
+# ---------- Ответ на вызов: кнопку нажимает соперник, владелец в callback_data – инициатор ----------
+@on_callback("accept_fight")
+async def accept_fight_callback(callback: CallbackQuery, state: FSMContext, challenger_id: int, opponent_id: int, counter: int):
+    cid = (challenger_id, opponent_id, counter)
     if cid not in active_challenges:
         await callback.message.edit_text("❌ Вызов недействителен", reply_markup=None)
         await callback.answer()
@@ -700,89 +1062,87 @@ async def accept_fight_callback(callback: CallbackQuery):
         await callback.answer("❌ Это не ваш вызов!")
         return
     chall['task'].cancel()
+    # Вызов убирается при любом исходе – и если бой не удалось записать в базу: таймера у него больше нет
+    try:
+        # Дерутся макаки из вызова, а не текущие активные: /switch между вызовом и ответом бой не подменяет
+        c_macaco = await db.get_user_macaco_with_decay(chall['challenger_id'], chall['challenger_macaco_id'])
+        o_macaco = await db.get_user_macaco_with_decay(opp_user_id, chall['opponent_macaco_id'])
+        bet = chall['bet']
 
-    c_macaco = await db.get_macaco_with_decay(chall['challenger_id'])
-    o_macaco = await db.get_macaco_with_decay(opp_user_id)
-    bet = chall['bet']
-
-    if c_macaco['health'] <= 0 or o_macaco['health'] <= 0:
-        await callback.message.edit_text("💔 Один из участников не может драться (здоровье = 0).", reply_markup=None)
-        del active_challenges[cid]
-        await callback.answer()
-        return
-
-    c_sat = 100 - c_macaco['hunger']
-    o_sat = 100 - o_macaco['hunger']
-    if c_sat <= 60 or o_sat <= 60:
-        await callback.message.edit_text("🍖 Один из участников слишком голоден.", reply_markup=None)
-        del active_challenges[cid]
-        await callback.answer()
-        return
+        if c_macaco is None or o_macaco is None:
+            await callback.message.edit_text("❌ Макаки из вызова больше нет у владельца. Вызов отменён.", reply_markup=None)
+            await callback.answer()
+            return
 
-    if c_macaco['weight'] < bet or o_macaco['weight'] < bet:
-        await callback.message.edit_text("❌ Недостаточно веса у одного из участников.", reply_markup=None)
-        del active_challenges[cid]
-        await callback.answer()
-        return
+        if c_macaco['health'] <= 0 or o_macaco['health'] <= 0:
+            await callback.message.edit_text("💔 Один из участников не может драться (здоровье = 0).", reply_markup=None)
+            await callback.answer()
+            return
 
-    await send_gif(callback.message.chat.id, 'fight', 'start', parse_mode=None)
+        c_sat = 100 - c_macaco['hunger']
+        o_sat = 100 - o_macaco['hunger']
+        if c_sat <= cfg.FIGHT_MIN_SATIETY or o_sat <= cfg.FIGHT_MIN_SATIETY:
+            await callback.message.edit_text("🍖 Один из участников слишком голоден.", reply_markup=None)
+            await callback.answer()
+            return
 
-    winner_id = random.choice([c_macaco['macaco_id'], o_macaco['macaco_id']])
-    loser_id = o_macaco['macaco_id'] if winner_id == c_macaco['macaco_id'] else c_macaco['macaco_id']
+        if c_macaco['weight'] < bet or o_macaco['weight'] < bet:
+            await callback.message.edit_text("❌ Недостаточно веса у одного из участников.", reply_markup=None)
+            await callback.answer()
+            return
 
-    await db.decrease_happiness(loser_id, 20)
-    await db.decrease_health(loser_id, 10)
-    await db.update_weight_after_fight(winner_id, loser_id, bet)
-    await db.record_fight(c_macaco['macaco_id'], o_macaco['macaco_id'], winner_id, bet)
+        await send_gif(callback.message.chat.id, 'fight', 'start', parse_mode=None)
 
-    exp_gain = 25 if winner_id == c_macaco['macaco_id'] else 10
-    await db.add_experience(winner_id, exp_gain)
+        winner_id = random.choice([c_macaco['macaco_id'], o_macaco['macaco_id']])
+        loser_id = o_macaco['macaco_id'] if winner_id == c_macaco['macaco_id'] else c_macaco['macaco_id']
 
-    c_macaco = await db.get_or_create_macaco(chall['challenger_id'])
-    o_macaco = await db.get_or_create_macaco(opp_user_id)
+        exp_gain = cfg.FIGHT_WIN_EXP if winner_id == c_macaco['macaco_id'] else cfg.FIGHT_LOSE_EXP
+        # Вес, опыт, штрафы проигравшего, запись боя и агрегаты – одной транзакцией
+        updated = await db.resolve_fight(c_macaco['macaco_id'], o_macaco['macaco_id'], winner_id, bet, exp_gain)
+        events.emit('fight', chall['challenger_id'], c_macaco['macaco_id'],
+                    winner_id=winner_id, loser_id=loser_id, bet=bet, arena=False)
 
-    if winner_id == c_macaco['macaco_id']:
-        result_text = f"🎉 ПОБЕДА! {c_macaco['name']} победил {o_macaco['name']} и забрал {bet} кг!"
-        loser_h = o_macaco['happiness']
-        loser_hp = o_macaco['health']
-    else:
-        result_text = f"😔 ПОРАЖЕНИЕ {c_macaco['name']} проиграл {o_macaco['name']} и потерял {bet} кг.\n😊 -20, ❤️ -10"
-        loser_h = c_macaco['happiness']
-        loser_hp = c_macaco['health']
-
-    result_msg = (
-        f"{'🎉' if winner_id == c_macaco['macaco_id'] else '😔'} БОЙ ЗАВЕРШЁН!\n"
-        f"────────────────────\n{result_text}\n\n"
-        f"🏋️ {c_macaco['name']}: {c_macaco['weight']} кг\n"
-        f"🏋️ {o_macaco['name']}: {o_macaco['weight']} кг\n"
-        f"📊 Победитель +{exp_gain} опыта\n"
-        f"😊 Настроение проигравшего: {loser_h}/100\n"
-        f"❤️ Здоровье проигравшего: {loser_hp}/100\n"
-        f"────────────────────"
-    )
+        c_macaco = updated.get(chall['challenger_macaco_id'], c_macaco)
+        o_macaco = updated.get(chall['opponent_macaco_id'], o_macaco)
 
-    await callback.message.edit_text(result_msg, parse_mode=None, reply_markup=None)
-    try:
-        await bot.send_message(chall['challenger_id'], result_msg, parse_mode=None)
-    except Exception as e:
-        logger.warning(f"Не удалось отправить результат инициатору боя: {e}")
+        if winner_id == c_macaco['macaco_id']:
+            result_text = f"🎉 ПОБЕДА! {c_macaco['name']} победил {o_macaco['name']} и забрал {bet} кг!"
+            loser_h = o_macaco['happiness']
+            loser_hp = o_macaco['health']
+        else:
+            result_text = f"😔 ПОРАЖЕНИЕ {c_macaco['name']} проиграл {o_macaco['name']} и потерял {bet} кг.\n😊 -20, ❤️ -10"
+            loser_h = c_macaco['happiness']
+            loser_hp = c_macaco['health']
+
+        result_msg = (
+            f"{'🎉' if winner_id == c_macaco['macaco_id'] else '😔'} БОЙ ЗАВЕРШЁН!\n"
+            f"────────────────────\n{result_text}\n\n"
+            f"🏋️ {c_macaco['name']}: {c_macaco['weight']} кг\n"
+            f"🏋️ {o_macaco['name']}: {o_macaco['weight']} кг\n"
+            f"📊 Победитель +{exp_gain} опыта\n"
+            f"😊 Настроение проигравшего: {loser_h}/100\n"
+            f"❤️ Здоровье проигравшего: {loser_hp}/100\n"
+            f"────────────────────"
+        )
 
-    if chall['challenge_chat_id'] != chall['challenger_id'] and chall['challenge_chat_id'] != opp_user_id:
+        await callback.message.edit_text(result_msg, parse_mode=None, reply_markup=None)
         try:
-            await bot.send_message(chall['challenge_chat_id'], result_msg, parse_mode=None)
+            await bot.send_message(chall['challenger_id'], result_msg, parse_mode=None)
         except Exception as e:
-            logger.warning(f"Не удалось отправить результат в общий чат: {e}")
+            logger.warning("Не удалось отправить результат инициатору боя: %s", e)
 
-    del active_challenges[cid]
-    await callback.answer()
+        if chall['challenge_chat_id'] != chall['challenger_id'] and chall['challenge_chat_id'] != opp_user_id:
+            try:
+                await bot.send_message(chall['challenge_chat_id'], result_msg, parse_mode=None)
+            except Exception as e:
+                logger.warning("Не удалось отправить результат в общий чат: %s", e)
+        await callback.answer()
+    finally:
+        active_challenges.pop(cid, None)
 
-@dp.callback_query(F.data.startswith("decline_fight_"))
-async def decline_fight_callback(callback: CallbackQuery):
-    parts = callback.data.split("_")
-    if len(parts) != 3:
-        await callback.answer("❌ Ошибка")
-        return
-    cid = parts[2]
+@on_callback("decline_fight")
+async def decline_fight_callback(callback: CallbackQuery, state: FSMContext, challenger_id: int, opponent_id: int, counter: int):
+    cid = (challenger_id, opponent_id, counter)
     if cid not in active_challenges:
         await callback.message.edit_text("❌ Вызов недействителен", reply_markup=None)
         await callback.answer()
@@ -797,18 +1157,154 @@ async def decline_fight_callback(callback: CallbackQuery):
     del active_challenges[cid]
     await callback.answer()
 
+# ---------- Inline-режим: @bot <имя> ----------
+INLINE_MIN_QUERY = 2
+INLINE_DEBOUNCE = 0.4  # запрос, который за это время сменился более новым, не выполняется
+INLINE_RESULTS = 20
+INLINE_CACHE_TIME = 30  # карточки одинаковы для всех, Telegram может отдавать их из своего кэша
+INLINE_SEARCHES = 4  # одновременных запросов к базе на процесс
+
+def macaco_matches(row: Dict, query: str) -> bool:
+    return query in row['name'].lower() or query in (row['username'] or '').lower()
+
+search_cache: PrefixCache[Dict] = PrefixCache(macaco_matches, limit=50, ttl=INLINE_CACHE_TIME)
+search_slots = asyncio.Semaphore(INLINE_SEARCHES)
+inline_latest: Dict[int, str] = {}  # user_id -> id последнего inline-запроса
+inline_superseded = 0
+
+async def search_cached(query: str) -> List[Dict]:
+    results = search_cache.get(query)
+    if results is not None:
+        return results
+    async with search_slots:
+        # Пока ждали слот, тот же запрос мог выполнить другой пользователь
+        results = search_cache.get(query)
+        if results is None:
+            results = await db.search_macacos(query, search_cache.limit)
+            search_cache.put(query, results)
+    return results
+
+def macaco_card(row: Dict, bot_username: str) -> InlineQueryResultArticle:
+    owner = f"@{row['username']}" if row['username'] else "Без юзернейма"
+    description = f"🏋️ {row['weight']} кг | ⭐ Ур. {row['level']} | 👤 {owner}"
+    return InlineQueryResultArticle(
+        id=str(row['macaco_id']),
+        title=f"🐒 {row['name']}",
+        description=description,
+        input_message_content=InputTextMessageContent(message_text=f"🐒 {row['name']}\n{description}"),
+        reply_markup=kb.challenge_link_kb(bot_username, row['macaco_id']),
+    )
+
+@dp.inline_query()
+async def inline_search(query: InlineQuery):
+    global inline_superseded
+    user_id = query.from_user.id
+    inline_latest[user_id] = query.id
+    text = " ".join(query.query.split()).lower()
+    if len(text) < INLINE_MIN_QUERY:
+        inline_latest.pop(user_id, None)
+        await query.answer([], cache_time=300, is_personal=False,
+                           button=InlineQueryResultsButton(text="🐒 Открыть игру", start_parameter="inline"))
+        return
+
+    if search_cache.get(text) is None:
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        if inline_latest.get(user_id) != query.id:
+            # Пользователь продолжил печатать – ответ на этот запрос Telegram всё равно не покажет
+            inline_superseded += 1
+            return
+    try:
+        results = await search_cached(text)
+    finally:
+        if inline_latest.get(user_id) == query.id:
+            del inline_latest[user_id]
+    bot_username = (await bot.me()).username
+    await query.answer([macaco_card(row, bot_username) for row in results[:INLINE_RESULTS]],
+                       cache_time=INLINE_CACHE_TIME, is_personal=False)
+
+# ---------- Участники групп ----------
+@dp.message(F.left_chat_member)
+async def member_left(message: Message):
+    await db.remove_chat_member(message.chat.id, message.left_chat_member.id)
+
+@dp.my_chat_member()
+async def bot_membership_changed(event: ChatMemberUpdated):
+    if event.chat.type != 'private' and event.new_chat_member.status in ('left', 'kicked'):
+        await db.forget_chat(event.chat.id)
+
+@dp.startup()
+async def on_startup():
+    # Запускается в каждом процессе, который обрабатывает апдейты (и в воркерах)
+    db.start_food_listener()
+    db.start_rank_resync()
+    db.start_replica_monitor()
+    db.start_chat_member_flusher()
+    events.start()
+    install_profiling_signal()
+
+@dp.shutdown()
+async def on_shutdown():
+    await stop_background_tasks()
+    db.stop_food_listener()
+    db.stop_rank_resync()
+    db.stop_replica_monitor()
+    await db.stop_chat_member_flusher()
+    await events.stop()
+    await profiler.stop()
+    logger.info("📉 Троттлинг: %s", throttling.stats())
+    logger.info("✏️ Правки сообщений: %s", edit_dedup.stats())
+    logger.info("🚦 Нагрузка: %s, нет соединения с базой: %s", admission.stats(), db.busy_count)
+    logger.info("🔎 Inline-поиск: %s, пропущено устаревших: %s", search_cache.stats(), inline_superseded)
+    logger.info("📝 Логи: %s", logs.stats())
+    if recorder is not None:
+        recorder.close()
+        logger.info("📼 Записано апдейтов: %s, отброшено: %s", recorder.recorded, recorder.dropped)
+
+async def timed(timings: dict, phase: str, coro):
+    started = time.perf_counter()
+    result = await coro
+    timings[phase] = (time.perf_counter() - started) * 1000
+    return result
+
 async def main():
     global BOT_USERNAME
     logger.info("🤖 Бот 'Боевые Макаки PRO' запускается...")
-    await db.init_db()
+    started = time.perf_counter()
+    timings = {}
+    # До разделения режимов: процесс ingress хуки startup не вызывает, а сигнал ему тоже могут послать
+    install_profiling_signal()
     try:
-        bot_info = await bot.get_me()
+        # База и Bot API независимы – их задержки перекрываются
+        db_timings, bot_info = await asyncio.gather(
+            db.init_db(),
+            timed(timings, 'get_me', bot_api.probe(bot))
+        )
+        timings.update(db_timings)
         BOT_USERNAME = bot_info.username
-        logger.info(f"✅ Бот авторизован: @{BOT_USERNAME}")
-        await dp.start_polling(bot)
+        logger.info("✅ Бот авторизован: @%s", BOT_USERNAME)
+        phases = ", ".join(f"{phase} {ms:.0f} мс" for phase, ms in timings.items())
+        logger.info("⏱ Старт за %.0f мс (%s)", (time.perf_counter() - started) * 1000, phases)
+        missing = cfg.missing_assets()
+        if missing:
+            logger.warning("🖼 Нет анимаций: %s – они не будут отправляться", ', '.join(missing))
+        if cfg.STALE_ASSETS:
+            logger.warning("🖼 Сборка устарела или неполная для: %s – отправляются исходные GIF", ', '.join(cfg.STALE_ASSETS))
+        if not cfg.ASSET_MANIFEST and not cfg.STALE_ASSETS:
+            logger.warning("🖼 images/manifest.json не найден – отправляются исходные GIF (соберите: python build_assets.py)")
+        spawn(db.warm_up(), 'warm_up')
+        events.start()  # арена пишет события и в процессе ingress, где хуки startup не вызываются
+        spawn(arena.run_arena(bot), 'arena')
+        spawn(notifications.run_notifications(bot), 'notifications')
+        if WORKERS > 1:
+            await workers.run_ingress(bot, dp, WORKERS)
+        else:
+            await dp.start_polling(bot)
     except Exception as e:
-        logger.error(f"❌ Критическая ошибка: {e}")
-        print("\nПРОВЕРЬТЕ:\n1. Токен в BOT_TOKEN\n2. Зависимости\n3. Интернет\n")
+        logger.error("❌ Критическая ошибка: %s. Проверьте: 1. Токен в BOT_TOKEN 2. Зависимости 3. Интернет", e)
+    finally:
+        # Сначала арена и уведомления: арена пишет события, которые events.stop() ещё должен дописать
+        await stop_background_tasks()
+        await events.stop()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,73 @@
+import logging
+import os
+from typing import Dict, Optional
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.exceptions import TelegramNetworkError, TelegramUnauthorizedError
+from aiogram.types import User
+
+logger = logging.getLogger(__name__)
+
+# Куда и как бот ходит в Bot API.
+# BOT_API_URL – свой сервер (telegram-bot-api): рядом с ботом задержка меньше, а с --local и файлы до 2 ГБ;
+# не задан – api.telegram.org. Для проверки без сети – заглушка: python loadtest.py --fake-api 8081
+BOT_API_URL = os.getenv('BOT_API_URL')
+BOT_API_LOCAL = os.getenv('BOT_API_LOCAL', '') == '1'  # сервер запущен с --local
+BOT_API_POOL_SIZE = int(os.getenv('BOT_API_POOL_SIZE', '100'))  # соединений с сервером одновременно
+BOT_API_KEEPALIVE = float(os.getenv('BOT_API_KEEPALIVE', '60'))  # сколько держать простаивающее соединение, сек
+BOT_API_TIMEOUT = float(os.getenv('BOT_API_TIMEOUT', '30'))  # для методов, которых нет в METHOD_TIMEOUTS
+
+# Ответы на нажатия бесполезны после нескольких секунд ожидания, а анимации грузятся долго.
+# getUpdates здесь нет: таймаут длинного опроса aiogram передаёт сам.
+# Переопределяются через BOT_API_TIMEOUTS="sendAnimation=90,answerCallbackQuery=3".
+METHOD_TIMEOUTS: Dict[str, float] = {
+    'getMe': 10,
+    'answerCallbackQuery': 5,
+    'answerInlineQuery': 5,
+    'sendMessage': 15,
+    'editMessageText': 15,
+    'sendAnimation': 60,
+}
+METHOD_TIMEOUTS.update(
+    (name.strip(), float(seconds))
+    for name, seconds in (item.split('=') for item in os.getenv('BOT_API_TIMEOUTS', '').split(',') if item.strip())
+)
+
+
+class TunedSession(AiohttpSession):
+    """AiohttpSession со своим адресом сервера, размером пула, keep-alive и таймаутами по методам."""
+
+    def __init__(self, api: TelegramAPIServer = PRODUCTION, limit: int = BOT_API_POOL_SIZE,
+                 keepalive: float = BOT_API_KEEPALIVE, timeout: float = BOT_API_TIMEOUT,
+                 method_timeouts: Optional[Dict[str, float]] = None):
+        super().__init__(api=api, limit=limit, timeout=timeout)
+        self._connector_init['keepalive_timeout'] = keepalive
+        self.method_timeouts = METHOD_TIMEOUTS if method_timeouts is None else method_timeouts
+
+    async def make_request(self, bot: Bot, method, timeout: Optional[int] = None):
+        if timeout is None:
+            timeout = self.method_timeouts.get(method.__api_method__)
+        return await super().make_request(bot, method, timeout)
+
+
+def endpoint() -> str:
+    return BOT_API_URL.rstrip('/') if BOT_API_URL else 'https://api.telegram.org'
+
+
+def create_session() -> TunedSession:
+    api = TelegramAPIServer.from_base(BOT_API_URL, is_local=BOT_API_LOCAL) if BOT_API_URL else PRODUCTION
+    return TunedSession(api=api)
+
+
+async def probe(bot: Bot) -> User:
+    """getMe на старте: адрес сервера, токен и сеть проверяются до приёма апдейтов."""
+    try:
+        me = await bot.me()
+    except TelegramUnauthorizedError as e:
+        raise RuntimeError(f"Bot API {endpoint()} не принял токен: {e}") from e
+    except TelegramNetworkError as e:
+        raise RuntimeError(f"Bot API {endpoint()} недоступен: {e}") from e
+    logger.info("🌐 Bot API: %s%s", endpoint(), " (локальный режим)" if BOT_API_LOCAL else "")
+    return me
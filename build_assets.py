@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+from typing import Dict, Optional
+
+import config as cfg
+
+# Офлайн-сборка анимаций: GIF из GIF_CONFIG -> MP4/H.264 + JPEG-превью в images/build,
+# плюс images/manifest.json, который config.py читает при старте.
+# Запускается при деплое; images/build и манифест – артефакты сборки и в git не коммитятся.
+
+BUILD_DIR = os.path.join('images', 'build')
+MAX_WIDTH = 480  # шире Telegram всё равно не показывает анимацию в чате
+THUMBNAIL_SIZE = 320  # ограничение Bot API на превью
+CRF = 28
+
+
+def run(*args: str):
+    subprocess.run(args, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def probe(path: str) -> Dict:
+    out = subprocess.run(
+        ('ffprobe', '-v', 'error', '-select_streams', 'v:0',
+         '-show_entries', 'stream=width,height:format=duration', '-of', 'json', path),
+        check=True, capture_output=True, text=True
+    ).stdout
+    info = json.loads(out)
+    stream = info['streams'][0]
+    return {
+        'width': stream['width'],
+        'height': stream['height'],
+        'duration': max(1, round(float(info['format'].get('duration', 0)))),
+    }
+
+
+def transcode(source: str, video: str, thumbnail: str):
+    run('ffmpeg', '-y', '-v', 'error', '-i', source,
+        '-an', '-c:v', 'libx264', '-preset', 'slow', '-crf', str(CRF), '-pix_fmt', 'yuv420p',
+        # yuv420p требует чётных размеров
+        '-vf', f"scale=trunc(min({MAX_WIDTH}\\,iw)/2)*2:-2",
+        '-movflags', '+faststart', video)
+    run('ffmpeg', '-y', '-v', 'error', '-i', video, '-frames:v', '1',
+        '-vf', f"scale={THUMBNAIL_SIZE}:{THUMBNAIL_SIZE}:force_original_aspect_ratio=decrease",
+        '-q:v', '4', thumbnail)
+
+
+def build_asset(source: str, built: Dict[str, Dict], force: bool) -> Dict:
+    source_sha = cfg.file_sha256(source)
+    # Одинаковые исходники (например, разные виды еды с общей гифкой) собираются один раз
+    if source_sha in built:
+        return built[source_sha]
+    video = os.path.join(BUILD_DIR, f"{source_sha[:16]}.mp4")
+    thumbnail = os.path.join(BUILD_DIR, f"{source_sha[:16]}.jpg")
+    if force or not (os.path.exists(video) and os.path.exists(thumbnail)):
+        transcode(source, video, thumbnail)
+    entry = {
+        'path': video.replace(os.sep, '/'),
+        'thumbnail': thumbnail.replace(os.sep, '/'),
+        **probe(video),
+        # По размерам и хэшу исходника config.py при старте проверяет, что сборка не устарела
+        'size': os.path.getsize(video),
+        'source_size': os.path.getsize(source),
+        'source_sha256': source_sha,
+    }
+    built[source_sha] = entry
+    return entry
+
+
+def build(force: bool = False) -> Optional[int]:
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    assets: Dict[str, Dict] = {}
+    built: Dict[str, Dict] = {}
+    missing = []
+    for gif_type, names in cfg.GIF_CONFIG.items():
+        for gif_name, gif in names.items():
+            key = cfg.asset_key(gif_type, gif_name)
+            if not os.path.exists(gif['path']):
+                missing.append(f"{key} ({gif['path']})")
+                continue
+            entry = build_asset(gif['path'], built, force)
+            assets[key] = dict(entry, source=gif['path'])
+            print(f"✅ {key}: {entry['source_size'] / 1024:.0f} КБ -> {entry['size'] / 1024:.0f} КБ "
+                  f"({entry['width']}x{entry['height']}, {entry['duration']} с)")
+
+    with open(cfg.ASSET_MANIFEST_PATH, 'w', encoding='utf-8') as f:
+        json.dump({'version': cfg.ASSET_MANIFEST_VERSION, 'assets': assets}, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+    # Экономия считается на одну отправку каждого ассета
+    before = sum(a['source_size'] for a in assets.values())
+    after = sum(a['size'] for a in assets.values())
+    if before:
+        print(f"📦 {len(assets)} анимаций: {before / 1024:.0f} КБ -> {after / 1024:.0f} КБ, "
+              f"экономия {(before - after) / 1024:.0f} КБ ({1 - after / before:.0%})")
+    if missing:
+        print("❌ Нет исходников для анимаций из GIF_CONFIG:\n  " + "\n  ".join(missing))
+        return 1
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сборка анимаций для бота (нужны ffmpeg и ffprobe)")
+    parser.add_argument('--force', action='store_true', help="пересобрать даже уже собранные файлы")
+    args = parser.parse_args()
+    for tool in ('ffmpeg', 'ffprobe'):
+        if shutil.which(tool) is None:
+            sys.exit(f"❌ {tool} не найден в PATH")
+    sys.exit(build(args.force))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import re
+from typing import Dict, NamedTuple, Optional, Tuple
+
+# Формат callback_data: <версия><код действия>.<владелец>[.<аргумент>...]
+# Все числа – неотрицательные целые в base36 без ведущих нулей: id пользователя Telegram занимает до 9 символов,
+# самая длинная кнопка (ставка в вызове) занимает около 20 байт из 64 допустимых.
+VERSION = '1'
+MAX_CALLBACK_BYTES = 64
+
+_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+class Action(NamedTuple):
+    name: str
+    code: str
+    args: int  # сколько чисел идёт после владельца
+    owner_only: bool = True  # нажать кнопку может только её владелец
+
+
+ACTIONS: Tuple[Action, ...] = (
+    Action('main_menu', 'm', 0),
+    Action('my_macaco', 'i', 0),
+    Action('select_food', 's', 0),
+    Action('food', 'f', 1),  # food_id
+    Action('feed', 'e', 1),  # food_id
+    Action('daily_reward', 'd', 0),
+    Action('walk_macaco', 'w', 0),
+    Action('top_weight', 't', 0),
+    Action('help_info', 'h', 0),
+    Action('arena', 'a', 0),
+    Action('arena_bet', 'b', 1),  # ставка
+    Action('arena_leave', 'l', 0),
+    Action('cancel_fight', 'x', 0),
+    Action('challenge_fight', 'c', 0),
+    Action('select_opp', 'o', 1),  # macaco_id соперника
+    Action('challenge_bet', 'k', 2),  # ставка, macaco_id соперника
+    # Ответ на вызов: владелец – инициатор, нажимает соперник
+    Action('accept_fight', 'y', 2, owner_only=False),  # macaco_id соперника, номер вызова
+    Action('decline_fight', 'n', 2, owner_only=False),
+    Action('switch_macaco', 'v', 1),  # macaco_id
+)
+_BY_NAME: Dict[str, Action] = {action.name: action for action in ACTIONS}
+_BY_CODE: Dict[str, Action] = {action.code: action for action in ACTIONS}
+
+_CALLBACK_RE = re.compile(r'(?P<version>[0-9])(?P<code>[a-z])(?P<numbers>(?:\.(?:0|[1-9a-z][0-9a-z]{0,12}))+)')
+
+
+class Callback(NamedTuple):
+    action: Action
+    owner_id: int
+    args: Tuple[int, ...]
+
+
+def _pack(number: int) -> str:
+    if number < 0:
+        raise ValueError(f"callback_data хранит только неотрицательные числа: {number}")
+    packed = ''
+    while True:
+        number, digit = divmod(number, 36)
+        packed = _DIGITS[digit] + packed
+        if not number:
+            return packed
+
+
+def encode(name: str, owner_id: int, *args: int) -> str:
+    action = _BY_NAME[name]
+    if len(args) != action.args:
+        raise ValueError(f"{name}: ожидается {action.args} аргумент(ов), получено {len(args)}")
+    data = VERSION + action.code + ''.join('.' + _pack(n) for n in (owner_id, *args))
+    if len(data.encode()) > MAX_CALLBACK_BYTES:
+        raise ValueError(f"callback_data длиннее {MAX_CALLBACK_BYTES} байт: {data}")
+    return data
+
+
+def decode(data: Optional[str]) -> Optional[Callback]:
+    """Разбирает callback_data; любое отклонение от формата – None."""
+    match = _CALLBACK_RE.fullmatch(data or '')
+    if not match or match['version'] != VERSION:
+        return None
+    action = _BY_CODE.get(match['code'])
+    if action is None:
+        return None
+    numbers = match['numbers'][1:].split('.')
+    if len(numbers) != action.args + 1:
+        return None
+    owner_id, *args = (int(n, 36) for n in numbers)
+    return Callback(action, owner_id, tuple(args))
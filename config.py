@@ -1,5 +1,7 @@
+import hashlib
+import json
 import os
-from typing import Dict, List
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
 
 # Конфигурация гифок
 GIF_CONFIG: Dict[str, Dict] = {
@@ -58,22 +60,152 @@ GIF_CONFIG: Dict[str, Dict] = {
     }
 }
 
-# Конфигурация еды
+# Начальное наполнение таблицы food_types; дальше источник правды – сама таблица
 FOOD_CONFIG: Dict[int, Dict] = {
-    1: {'name': '🍌 Банан', 'weight': 1, 'happiness': 10, 'hunger': 30, 'cooldown': 5},
-    2: {'name': '🥩 Мясо', 'weight': 3, 'happiness': 5, 'hunger': 50, 'cooldown': 8},
-    3: {'name': '🍰 Торт', 'weight': 5, 'happiness': 20, 'hunger': 70, 'cooldown': 12},
-    4: {'name': '🥗 Салат', 'weight': 2, 'happiness': 15, 'hunger': 40, 'cooldown': 6}
+    1: {'name': '🍌 Банан', 'weight': 1, 'happiness': 0, 'hunger': 30, 'cooldown': 5, 'health': 10},
+    2: {'name': '🥩 Мясо', 'weight': 3, 'happiness': 0, 'hunger': 50, 'cooldown': 8, 'health': 15},
+    3: {'name': '🍰 Торт', 'weight': 5, 'happiness': 0, 'hunger': 70, 'cooldown': 12, 'health': 5},
+    4: {'name': '🥗 Салат', 'weight': 2, 'happiness': 0, 'hunger': 40, 'cooldown': 6, 'health': 12}
 }
 
+# Строка food_types в памяти: неизменяемая и компактная, поля в порядке столбцов таблицы
+class Food(NamedTuple):
+    food_id: int
+    name: str
+    weight_gain: int
+    happiness_gain: int
+    hunger_decrease: int
+    cooldown_hours: int
+    health_gain: int
+
+def seed_foods() -> Tuple[Food, ...]:
+    """FOOD_CONFIG в виде строк food_types – для заполнения пустой таблицы."""
+    return tuple(Food(food_id, f['name'], f['weight'], f['happiness'], f['hunger'], f['cooldown'], f['health'])
+                 for food_id, f in FOOD_CONFIG.items())
+
+# Распад характеристик
+HUNGER_DECAY_STEP_HOURS = 2
+HUNGER_DECAY_AMOUNT = 5
+HAPPINESS_DECAY_PER_HOUR = 10
+HEALTH_DECAY_PER_HOUR = 5  # только при голоде = 100
+
+# Ежедневная награда
+DAILY_WEIGHT = 1
+DAILY_HAPPINESS = 5
+DAILY_HEALTH = 5
+
+# Правила боя
+FIGHT_BETS = (1, 3, 5, 10)
+FIGHT_MIN_SATIETY = 60  # сытость должна быть строго больше
+FIGHT_WIN_EXP = 25
+FIGHT_LOSE_EXP = 10
+FIGHT_LOSER_HAPPINESS_LOSS = 20
+FIGHT_LOSER_HEALTH_LOSS = 10
+
+# Опыт за уровень
+LEVEL_EXP = 100
+
+# ---------- Формулы баланса ----------
+# Работают и с числами, и с массивами NumPy (симулятор передаёт np.minimum / np.maximum)
+def hunger_after_decay(hunger, hours, minimum=min):
+    steps = hours // HUNGER_DECAY_STEP_HOURS
+    return minimum(100, hunger + steps * HUNGER_DECAY_AMOUNT), steps * HUNGER_DECAY_STEP_HOURS
+
+def happiness_after_decay(happiness, hours, maximum=max):
+    return maximum(0, happiness - hours * HAPPINESS_DECAY_PER_HOUR)
+
+def health_after_decay(health, hours, maximum=max):
+    return maximum(0, health - hours * HEALTH_DECAY_PER_HOUR)
+
+def level_after_experience(level, experience, gain):
+    total = experience + gain
+    return level + total // LEVEL_EXP, total % LEVEL_EXP
+
+# ---------- Анимации ----------
+# Собранные build_assets.py файлы (MP4 + превью) описаны в манифесте; без манифеста шлются исходные GIF.
+# Сборка делается при деплое и в git не попадает, поэтому запись манифеста сверяется с диском при старте
+ASSET_MANIFEST_PATH = 'images/manifest.json'
+ASSET_MANIFEST_VERSION = 1
+
+def asset_key(gif_type: str, gif_name: str) -> str:
+    return f"{gif_type}/{gif_name}"
+
+def load_asset_manifest(path: str = ASSET_MANIFEST_PATH) -> Dict[str, Dict]:
+    try:
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    if manifest.get('version') != ASSET_MANIFEST_VERSION:
+        return {}
+    return manifest['assets']
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _built_is_valid(built: Dict, source: Optional[str], source_hashes: Dict[str, str]) -> bool:
+    # Сборка на месте и того же размера, а исходная GIF из GIF_CONFIG – та же, из которой собирали:
+    # заменённую без пересборки гифку иначе подменяла бы старая анимация
+    try:
+        if os.path.getsize(built['path']) != built['size'] or not os.path.exists(built['thumbnail']):
+            return False
+        if source is None or os.path.getsize(source) != built['source_size']:
+            return False
+        if source not in source_hashes:
+            source_hashes[source] = file_sha256(source)  # у разных ассетов бывает общий исходник
+        return source_hashes[source] == built['source_sha256']
+    except (OSError, KeyError):
+        return False
+
+def _valid_built_assets(manifest: Dict[str, Dict]) -> Tuple[Dict[str, Dict], List[str]]:
+    valid, stale = {}, []
+    source_hashes: Dict[str, str] = {}
+    for key, built in manifest.items():
+        gif_type, _, gif_name = key.partition('/')
+        source = GIF_CONFIG.get(gif_type, {}).get(gif_name, {}).get('path')
+        if _built_is_valid(built, source, source_hashes):
+            valid[key] = built
+        else:
+            stale.append(key)
+    return valid, stale
+
+def _available_assets() -> Set[str]:
+    # Диск проверяется один раз при старте, а не при каждой отправке
+    available = set()
+    for gif_type, names in GIF_CONFIG.items():
+        for gif_name, config in names.items():
+            key = asset_key(gif_type, gif_name)
+            # Без проверенной сборки – исходная GIF из GIF_CONFIG
+            built = ASSET_MANIFEST.get(key)
+            path = built['path'] if built else config.get('path')
+            if path and os.path.exists(path):
+                available.add(key)
+    return available
+
+# Только записи, чьи файлы прошли проверку; устаревшие – в STALE_ASSETS, для них шлются исходные GIF
+ASSET_MANIFEST, STALE_ASSETS = _valid_built_assets(load_asset_manifest())
+AVAILABLE_ASSETS = _available_assets()
+
+def missing_assets() -> List[str]:
+    return [
+        asset_key(gif_type, gif_name)
+        for gif_type, names in GIF_CONFIG.items()
+        for gif_name in names
+        if asset_key(gif_type, gif_name) not in AVAILABLE_ASSETS
+    ]
+
 # Проверка существования гифок
 def check_gif_exists(gif_type: str, gif_name: str) -> bool:
-    config = GIF_CONFIG.get(gif_type, {}).get(gif_name, {})
-    if not config or 'path' not in config:
-        return False
-    return os.path.exists(config['path'])
+    return asset_key(gif_type, gif_name) in AVAILABLE_ASSETS
 
-# Получение информации о гифке
+# Получение информации о гифке: подпись из GIF_CONFIG, файл, превью и размеры – из манифеста
 def get_gif_info(gif_type: str, gif_name: str) -> Dict:
     config = GIF_CONFIG.get(gif_type, {}).get(gif_name, {})
-    return config if config else {}
\ No newline at end of file
+    if not config:
+        return {}
+    built = ASSET_MANIFEST.get(asset_key(gif_type, gif_name))
+    return {**config, **built} if built else config
\ No newline at end of file
@@ -1,44 +1,317 @@
 import asyncpg
 from datetime import datetime, timedelta
+import logging
 import os
 import asyncio
-from typing import Dict, List, Tuple, Optional
+import time
+from collections import OrderedDict
+from typing import Dict, List, Set, Tuple, Optional
+
+import achievements
+import config as cfg
+from ranking import RankIndex
+
+logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv('DATABASE_URL')
-if not DATABASE_URL:
-    raise ValueError("❌ DATABASE_URL не задан! Добавьте его в переменные окружения Bothost.")
+
+# Увеличивать при каждом изменении create_tables – иначе на старте схема не обновится
+SCHEMA_VERSION = 8
+
+POOL_WARM_SIZE = 5
+POOL_MAX_SIZE = 20
+# Сколько ждать свободное соединение: дольше пользователь всё равно не дождётся ответа
+POOL_ACQUIRE_TIMEOUT = float(os.getenv('POOL_ACQUIRE_TIMEOUT', '3'))
+# Класс соединений основного пула; loadtest.py подменяет его до создания пула, чтобы считать запросы
+POOL_CONNECTION_CLASS = asyncpg.Connection
+
+# Реплики для чтения (через запятую) и допустимое отставание в секундах
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', '5'))
+REPLICA_POOL_SIZE = 10
+REPLICA_CHECK_INTERVAL = 5  # как часто перепроверять отставание реплики, сек
+REPLICA_STATUS_TTL = REPLICA_CHECK_INTERVAL * 3  # статус старше – реплика считается недоступной
+REPLICA_CONNECT_TIMEOUT = 2  # подключение к реплике и проверка отставания, сек
 
 _pool = None
 _pool_init_lock = asyncio.Lock()
-_food_cache = None
+_foods: Optional[Tuple[cfg.Food, ...]] = None
+_food_by_id: Dict[int, cfg.Food] = {}
+_food_listener_task = None
+_food_reload_tasks: Set[asyncio.Task] = set()  # перезагрузки по NOTIFY; ссылка держится, пока задача идёт
+
+RANK_RESYNC_SECONDS = int(os.getenv('RANK_RESYNC_SECONDS', '300'))
+_rank_index = RankIndex()
+_rank_loaded = False
+_rank_load_lock = asyncio.Lock()  # полная загрузка индекса – одна за раз, остальные ждут её результата
+_rank_pending: List[Dict[int, Dict]] = []  # буферы идущих пересборок: изменения, пришедшие во время запроса
+_rank_resync_task = None
+
+ACHIEVEMENT_SEEN_SIZE = 100000
+# (macaco_id, code) достижений, которые точно есть в базе: повторно их не вставляем
+_achievements_seen: OrderedDict = OrderedDict()
+
+_replica_pools: Dict[str, '_DeadlinePool'] = {}
+_replica_status: Dict[str, Tuple[float, float]] = {}  # url -> (время проверки, отставание; inf – недоступна)
+_replica_turn = 0
+_replica_locks: Dict[str, asyncio.Lock] = {}
+_replica_checking: Set[str] = set()  # проверка уже идёт – вторую не запускаем
+_replica_monitor_task = None
+
+# Ошибки, при которых чтение повторяется на основной базе
+_CONNECTION_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.PostgresConnectionError, asyncpg.InterfaceError)
+
+class DatabaseBusy(Exception):
+    """Все соединения пула заняты дольше POOL_ACQUIRE_TIMEOUT."""
+
+
+busy_count = 0  # сколько раз соединение не удалось получить вовремя
+
+
+class _AcquireContext:
+    __slots__ = ('_pool', '_timeout', '_conn')
+
+    def __init__(self, pool: asyncpg.Pool, timeout: float):
+        self._pool = pool
+        self._timeout = timeout
+        self._conn = None
+
+    async def _acquire(self) -> asyncpg.Connection:
+        global busy_count
+        try:
+            return await self._pool.acquire(timeout=self._timeout)
+        except asyncio.TimeoutError:
+            busy_count += 1
+            raise DatabaseBusy(f"нет свободного соединения за {self._timeout:g} с") from None
+
+    async def __aenter__(self) -> asyncpg.Connection:
+        self._conn = await self._acquire()
+        return self._conn
+
+    async def __aexit__(self, *exc):
+        conn, self._conn = self._conn, None
+        await self._pool.release(conn)
+
+    def __await__(self):
+        return self._acquire().__await__()
+
+
+class _DeadlinePool:
+    """
+    Пул asyncpg, у которого acquire() ждёт не дольше POOL_ACQUIRE_TIMEOUT и бросает DatabaseBusy.
+    Запросы прямо на пуле (fetch, execute...) тоже берут соединение через acquire() – с тем же сроком.
+    """
+
+    def __init__(self, pool: asyncpg.Pool):
+        self._pool = pool
+
+    def acquire(self, *, timeout: Optional[float] = None) -> _AcquireContext:
+        return _AcquireContext(self._pool, POOL_ACQUIRE_TIMEOUT if timeout is None else timeout)
+
+    async def execute(self, query: str, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.execute(query, *args, **kwargs)
+
+    async def fetch(self, query: str, *args, **kwargs) -> List[asyncpg.Record]:
+        async with self.acquire() as conn:
+            return await conn.fetch(query, *args, **kwargs)
+
+    async def fetchrow(self, query: str, *args, **kwargs) -> Optional[asyncpg.Record]:
+        async with self.acquire() as conn:
+            return await conn.fetchrow(query, *args, **kwargs)
+
+    async def fetchval(self, query: str, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.fetchval(query, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
 
 async def get_pool():
     global _pool
     if _pool is None:
         async with _pool_init_lock:
             if _pool is None:
-                _pool = await asyncpg.create_pool(
+                if not DATABASE_URL:
+                    raise ValueError("❌ DATABASE_URL не задан! Добавьте его в переменные окружения Bothost.")
+                # Одно соединение на старте, остальные открывает warm_up() в фоне
+                _pool = _DeadlinePool(await asyncpg.create_pool(
                     DATABASE_URL,
-                    min_size=5,
-                    max_size=20,
-                    command_timeout=60
-                )
-                print("✅ Пул соединений инициализирован")
+                    min_size=1,
+                    max_size=POOL_MAX_SIZE,
+                    command_timeout=60,
+                    connection_class=POOL_CONNECTION_CLASS
+                ))
+                logger.info("✅ Пул соединений инициализирован")
     return _pool
 
+# ---------- Реплики для чтения ----------
+_REPLICA_LAG_SQL = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+'''
+
+async def _replica_pool(url: str) -> _DeadlinePool:
+    # Свой замок на каждую реплику: недоступная реплика не задерживает ни основной пул, ни другие реплики
+    async with _replica_locks.setdefault(url, asyncio.Lock()):
+        pool = _replica_pools.get(url)
+        if pool is None:
+            pool = _replica_pools[url] = _DeadlinePool(await asyncpg.create_pool(
+                url, min_size=1, max_size=REPLICA_POOL_SIZE, command_timeout=60, timeout=REPLICA_CONNECT_TIMEOUT
+            ))
+        return pool
+
+async def _probe_replica(url: str):
+    if url in _replica_checking:
+        return
+    _replica_checking.add(url)
+    try:
+        pool = await _replica_pool(url)
+        lag = float(await pool.fetchval(_REPLICA_LAG_SQL, timeout=REPLICA_CONNECT_TIMEOUT))
+    except _CONNECTION_ERRORS + (asyncpg.PostgresError, DatabaseBusy) as e:
+        logger.warning("⚠️ Реплика недоступна: %s", e)
+        lag = float('inf')
+    finally:
+        _replica_checking.discard(url)
+    _replica_status[url] = (time.monotonic(), lag)
+
+async def _run_replica_monitor():
+    # Отставание реплик проверяется только здесь; запросы пользователей читают готовый _replica_status
+    while True:
+        await asyncio.gather(*(_probe_replica(url) for url in DATABASE_REPLICA_URLS))
+        await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+
+def start_replica_monitor():
+    global _replica_monitor_task
+    if _replica_monitor_task is None and DATABASE_REPLICA_URLS:
+        _replica_monitor_task = asyncio.create_task(_run_replica_monitor())
+
+def stop_replica_monitor():
+    global _replica_monitor_task
+    if _replica_monitor_task is not None:
+        _replica_monitor_task.cancel()
+        _replica_monitor_task = None
+
+def _replica_lag(url: str) -> float:
+    checked_at, lag = _replica_status.get(url, (0.0, float('inf')))
+    if time.monotonic() - checked_at > REPLICA_STATUS_TTL:
+        return float('inf')  # монитор давно не отчитывался – реплике не доверяем
+    return lag
+
+async def get_read_pool(max_lag: Optional[float] = None):
+    """Пул реплики с отставанием не больше max_lag, иначе основной пул. Базу не трогает – только кэш статусов."""
+    global _replica_turn
+    start_replica_monitor()
+    max_lag = REPLICA_MAX_LAG if max_lag is None else max_lag
+    for _ in range(len(DATABASE_REPLICA_URLS)):
+        url = DATABASE_REPLICA_URLS[_replica_turn % len(DATABASE_REPLICA_URLS)]
+        _replica_turn += 1
+        if url in _replica_pools and _replica_lag(url) <= max_lag:
+            return _replica_pools[url]
+    return await get_pool()
+
+async def _fetch_read(query: str, *args) -> List[asyncpg.Record]:
+    pool = await get_read_pool()
+    try:
+        async with pool.acquire() as conn:
+            return await conn.fetch(query, *args)
+    except _CONNECTION_ERRORS:
+        if pool is _pool:
+            raise
+        # Реплика отвалилась посреди запроса – помечаем и читаем с основной базы
+        for url, replica in _replica_pools.items():
+            if replica is pool:
+                _replica_status[url] = (time.monotonic(), float('inf'))
+        primary = await get_pool()
+        async with primary.acquire() as conn:
+            return await conn.fetch(query, *args)
+
+# ---------- Еда: food_types – единственный источник, в памяти – неизменяемые кортежи ----------
 async def load_food_cache():
-    global _food_cache
+    global _foods, _food_by_id
     pool = await get_pool()
     async with pool.acquire() as conn:
-        rows = await conn.fetch('SELECT * FROM food_types')
-        _food_cache = {row['food_id']: dict(row) for row in rows}
-    print(f"✅ Кэш еды загружен ({len(_food_cache)} записей)")
+        rows = await conn.fetch(f"SELECT {', '.join(cfg.Food._fields)} FROM food_types ORDER BY food_id")
+    foods = tuple(cfg.Food(*row) for row in rows)
+    # Оба объекта заменяются целиком – читатели никогда не видят наполовину обновлённый кэш
+    _foods, _food_by_id = foods, {food.food_id: food for food in foods}
+    logger.info("✅ Кэш еды загружен (%s записей)", len(foods))
 
-async def get_food_info_cached(food_id: int) -> Optional[Dict]:
-    global _food_cache
-    if _food_cache is None:
+async def get_foods() -> Tuple[cfg.Food, ...]:
+    if _foods is None:
         await load_food_cache()
-    return _food_cache.get(food_id)
+    return _foods
+
+async def get_food_info_cached(food_id: int) -> Optional[cfg.Food]:
+    if _foods is None:
+        await load_food_cache()
+    return _food_by_id.get(food_id)
+
+def _food_reload_done(task: asyncio.Task):
+    _food_reload_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        # Кэш остаётся прежним до следующего изменения или переподключения подписки
+        logger.error("❌ Не удалось перезагрузить кэш еды: %s", task.exception(), exc_info=task.exception())
+
+async def _listen_food_changes():
+    def on_notify(conn, pid, channel, payload):
+        task = asyncio.create_task(load_food_cache())
+        _food_reload_tasks.add(task)
+        task.add_done_callback(_food_reload_done)
+
+    while True:
+        conn = None
+        try:
+            # LISTEN держится на отдельном соединении: соединения пула сбрасываются при возврате
+            conn = await asyncpg.connect(DATABASE_URL)
+            await conn.add_listener('food_types_changed', on_notify)
+            await load_food_cache()  # пока соединения не было, изменения могли пройти мимо
+            while not conn.is_closed():
+                await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("⚠️ Подписка на изменения еды: %s", e)
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(5)
+
+def start_food_listener():
+    global _food_listener_task
+    if _food_listener_task is None:
+        _food_listener_task = asyncio.create_task(_listen_food_changes())
+
+def stop_food_listener():
+    global _food_listener_task
+    if _food_listener_task is not None:
+        _food_listener_task.cancel()
+        _food_listener_task = None
+
+# Ближайшее из событий: сброс ежедневной награды, конец самого короткого КД еды, голод = 100.
+# События не позже last_notified_at уже отправлены.
+_NEXT_EVENT_FUNCTION_SQL = '''
+    CREATE OR REPLACE FUNCTION macaco_next_event(
+        last_daily TIMESTAMP, last_fed TIMESTAMP, hunger INTEGER,
+        last_hunger_decay TIMESTAMP, last_notified_at TIMESTAMP
+    ) RETURNS TIMESTAMP LANGUAGE sql STABLE AS $$
+        SELECT MIN(t) FROM (VALUES
+            (date_trunc('day', last_daily) + INTERVAL '1 day'),
+            (last_fed + (SELECT MIN(cooldown_hours) FROM food_types) * INTERVAL '1 hour'),
+            (CASE WHEN hunger < 100 THEN
+                last_hunger_decay + ((100 - hunger + {hunger_step} - 1) / {hunger_step} * {hunger_hours}) * INTERVAL '1 hour'
+            END)
+        ) AS e(t)
+        WHERE t > COALESCE(last_notified_at, '-infinity'::timestamp)
+    $$
+'''.format(
+    hunger_step=cfg.HUNGER_DECAY_AMOUNT,
+    hunger_hours=cfg.HUNGER_DECAY_STEP_HOURS,
+)
 
 async def create_tables():
     pool = await get_pool()
@@ -91,18 +364,138 @@ async def create_tables():
                 health_gain INTEGER DEFAULT 10
             )
         ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS arena_queue (
+                macaco_id INTEGER PRIMARY KEY REFERENCES macacos(macaco_id),
+                user_id BIGINT NOT NULL,
+                bet INTEGER NOT NULL,
+                joined_at TIMESTAMP DEFAULT NOW()
+            )
+        ''')
+        # Журнал событий (events.py): только INSERT через COPY, никаких UPDATE
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS game_events (
+                event_id BIGSERIAL PRIMARY KEY,
+                created_at TIMESTAMP NOT NULL,
+                kind TEXT NOT NULL,
+                user_id BIGINT,
+                macaco_id INTEGER,
+                payload JSONB NOT NULL DEFAULT '{}'
+            )
+        ''')
+        await conn.execute('CREATE INDEX IF NOT EXISTS game_events_macaco_idx ON game_events (macaco_id, event_id)')
+        # Макаки пользователя для /switch
+        await conn.execute('CREATE INDEX IF NOT EXISTS macacos_user_idx ON macacos (user_id, macaco_id DESC)')
+        # Активная макака пользователя: все поиски «макаки пользователя» идут через неё по первичному ключу
+        await conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS active_macaco_id INTEGER REFERENCES macacos(macaco_id)')
+        await conn.execute('''
+            UPDATE users u
+            SET active_macaco_id = (SELECT MAX(macaco_id) FROM macacos m WHERE m.user_id = u.user_id)
+            WHERE active_macaco_id IS NULL
+        ''')
+        # Кто из пользователей писал в каком групповом чате; топ чата идёт по первичному ключу
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS chat_members (
+                chat_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                last_seen TIMESTAMP NOT NULL,
+                PRIMARY KEY (chat_id, user_id)
+            )
+        ''')
+        # Агрегаты боёв: ведутся в транзакции resolve_fight / arena_tick, пересобираются из fights
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS fight_stats (
+                macaco_id INTEGER PRIMARY KEY REFERENCES macacos(macaco_id),
+                wins INTEGER NOT NULL DEFAULT 0,
+                losses INTEGER NOT NULL DEFAULT 0,
+                weight_won INTEGER NOT NULL DEFAULT 0,
+                weight_lost INTEGER NOT NULL DEFAULT 0,
+                streak INTEGER NOT NULL DEFAULT 0,
+                best_streak INTEGER NOT NULL DEFAULT 0,
+                last_fight_at TIMESTAMP
+            )
+        ''')
+        for period in _ROLLUP_PERIODS:
+            await conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS fight_rollup_{period} (
+                    bucket TIMESTAMP NOT NULL,
+                    macaco_id INTEGER NOT NULL REFERENCES macacos(macaco_id),
+                    wins INTEGER NOT NULL DEFAULT 0,
+                    losses INTEGER NOT NULL DEFAULT 0,
+                    weight_delta INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (bucket, macaco_id)
+                )
+            ''')
+        if not await conn.fetchval('SELECT EXISTS (SELECT 1 FROM fight_stats)'):
+            async with conn.transaction():
+                await _rebuild_fight_aggregates(conn)
+        # Достижения (achievements.py): счётчики, которых нет в macacos и fight_stats, и открытые достижения
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS macaco_counters (
+                macaco_id INTEGER PRIMARY KEY REFERENCES macacos(macaco_id),
+                foods_tried INTEGER NOT NULL DEFAULT 0,
+                dailies INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS macaco_foods (
+                macaco_id INTEGER NOT NULL REFERENCES macacos(macaco_id),
+                food_id INTEGER NOT NULL,
+                PRIMARY KEY (macaco_id, food_id)
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS achievements (
+                macaco_id INTEGER NOT NULL REFERENCES macacos(macaco_id),
+                code TEXT NOT NULL,
+                unlocked_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (macaco_id, code)
+            )
+        ''')
         count = await conn.fetchval('SELECT COUNT(*) FROM food_types')
         if count == 0:
-            await conn.execute('''
+            await conn.executemany('''
                 INSERT INTO food_types (food_id, name, weight_gain, happiness_gain, hunger_decrease, cooldown_hours, health_gain)
-                VALUES 
-                (1, '🍌 Банан', 1, 0, 30, 5, 10),
-                (2, '🥩 Мясо', 3, 0, 50, 8, 15),
-                (3, '🍰 Торт', 5, 0, 70, 12, 5),
-                (4, '🥗 Салат', 2, 0, 40, 6, 12)
-            ''')
-        print("✅ Таблицы созданы/проверены")
-    await load_food_cache()
+                VALUES ($1, $2, $3, $4, $5, $6, $7)
+            ''', cfg.seed_foods())
+        # Заполняем только пустые счётчики (таблица только что создана); живые счётчики журнал событий
+        # не заменяет – он теряет события при переполнении буфера и не содержит истории до своего появления
+        if not await conn.fetchval('SELECT EXISTS (SELECT 1 FROM macaco_counters)'):
+            async with conn.transaction():
+                await _backfill_achievements(conn)
+        # Любое изменение food_types рассылается всем запущенным ботам
+        await conn.execute('''
+            CREATE OR REPLACE FUNCTION notify_food_types_changed() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                PERFORM pg_notify('food_types_changed', '');
+                RETURN NULL;
+            END
+            $$
+        ''')
+        await conn.execute('DROP TRIGGER IF EXISTS food_types_changed ON food_types')
+        await conn.execute('''
+            CREATE TRIGGER food_types_changed
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON food_types
+            FOR EACH STATEMENT EXECUTE PROCEDURE notify_food_types_changed()
+        ''')
+        # Уведомления: ближайшее событие макаки хранится в next_event_at и пересчитывается при каждом изменении
+        await conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS notify_enabled BOOLEAN NOT NULL DEFAULT TRUE')
+        await conn.execute('ALTER TABLE macacos ADD COLUMN IF NOT EXISTS next_event_at TIMESTAMP')
+        await conn.execute('ALTER TABLE macacos ADD COLUMN IF NOT EXISTS last_notified_at TIMESTAMP')
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS macacos_next_event_idx
+            ON macacos (next_event_at) WHERE next_event_at IS NOT NULL
+        ''')
+        await conn.execute(_NEXT_EVENT_FUNCTION_SQL)
+        await conn.execute('''
+            UPDATE macacos
+            SET next_event_at = macaco_next_event(last_daily, last_fed, hunger, last_hunger_decay, last_notified_at)
+            WHERE next_event_at IS NULL
+        ''')
+        await conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+        await conn.execute('DELETE FROM schema_version')
+        await conn.execute('INSERT INTO schema_version (version) VALUES ($1)', SCHEMA_VERSION)
+        logger.info("✅ Таблицы созданы/проверены")
 
 async def get_or_create_user(user_data: Dict) -> bool:
     pool = await get_pool()
@@ -115,29 +508,75 @@ async def get_or_create_user(user_data: Dict) -> bool:
             ''', user_data['id'], user_data.get('username'), user_data.get('first_name'), user_data.get('last_name'))
         return True
 
+_ACTIVE_MACACO_SQL = '''
+    SELECT m.* FROM users u
+    JOIN macacos m ON m.macaco_id = u.active_macaco_id
+    WHERE u.user_id = $1
+'''
+
 async def get_or_create_macaco(user_id: int) -> Dict:
     pool = await get_pool()
     async with pool.acquire() as conn:
-        row = await conn.fetchrow('''
-            SELECT * FROM macacos 
-            WHERE user_id = $1 
-            ORDER BY macaco_id DESC 
-            LIMIT 1
-        ''', user_id)
-        if not row:
+        row = await conn.fetchrow(_ACTIVE_MACACO_SQL, user_id)
+        if row:
+            return dict(row)
+        async with conn.transaction():
+            # Строка пользователя блокируется, чтобы два параллельных апдейта не создали две макаки
+            await conn.execute('SELECT 1 FROM users WHERE user_id = $1 FOR UPDATE', user_id)
+            row = await conn.fetchrow(_ACTIVE_MACACO_SQL, user_id)
+            if row:
+                return dict(row)
             now = datetime.now()
-            await conn.execute('''
-                INSERT INTO macacos (user_id, last_fed, last_daily, last_happiness_decay, last_hunger_decay, last_health_decay, weight)
-                VALUES ($1, NULL, $2, $3, $4, $5, 10)
-            ''', user_id, now, now, now, now)
             row = await conn.fetchrow('''
-                SELECT * FROM macacos 
-                WHERE user_id = $1 
-                ORDER BY macaco_id DESC 
-                LIMIT 1
-            ''', user_id)
+                INSERT INTO macacos (user_id, last_fed, last_daily, last_happiness_decay, last_hunger_decay, last_health_decay, weight,
+                                     next_event_at)
+                VALUES ($1, NULL, $2, $3, $4, $5, 10, macaco_next_event($2, NULL, 0, $4, NULL))
+                RETURNING *
+            ''', user_id, now, now, now, now)
+            await conn.execute('UPDATE users SET active_macaco_id = $2 WHERE user_id = $1', user_id, row['macaco_id'])
+        _rank_touch([row])
         return dict(row)
 
+async def list_user_macacos(user_id: int) -> List[Dict]:
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch('''
+            SELECT m.macaco_id, m.name, m.weight, m.level, m.macaco_id = u.active_macaco_id AS active
+            FROM macacos m
+            JOIN users u ON u.user_id = m.user_id
+            WHERE m.user_id = $1
+            ORDER BY m.macaco_id DESC
+        ''', user_id)
+        return [dict(r) for r in rows]
+
+async def set_active_macaco(user_id: int, macaco_id: int) -> Optional[Dict]:
+    """Делает макаку активной; None – если она не принадлежит пользователю."""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow('''
+            WITH target AS (
+                SELECT * FROM macacos WHERE macaco_id = $2 AND user_id = $1
+            ), switched AS (
+                UPDATE users SET active_macaco_id = target.macaco_id
+                FROM target
+                WHERE users.user_id = $1
+            )
+            SELECT * FROM target
+        ''', user_id, macaco_id)
+    if row is None:
+        return None
+    _rank_index.activate(row['macaco_id'], row['user_id'], row['weight'], row['level'])
+    return dict(row)
+
+async def rename_active_macaco(user_id: int, name: str) -> Optional[int]:
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetchval('''
+            UPDATE macacos SET name = $2
+            WHERE macaco_id = (SELECT active_macaco_id FROM users WHERE user_id = $1)
+            RETURNING macaco_id
+        ''', user_id, name)
+
 async def get_macaco_with_decay(user_id: int) -> Dict:
     macaco = await get_or_create_macaco(user_id)
     await apply_happiness_decay(macaco['macaco_id'])
@@ -145,6 +584,21 @@ async def get_macaco_with_decay(user_id: int) -> Dict:
     await apply_health_decay(macaco['macaco_id'])
     return await get_or_create_macaco(user_id)
 
+async def get_user_macaco_with_decay(user_id: int, macaco_id: int) -> Optional[Dict]:
+    """Макака macaco_id (не обязательно активная) с применённым распадом; None, если она не принадлежит user_id."""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        owned = await conn.fetchval('SELECT EXISTS (SELECT 1 FROM macacos WHERE macaco_id = $1 AND user_id = $2)',
+                                    macaco_id, user_id)
+    if not owned:
+        return None
+    await apply_happiness_decay(macaco_id)
+    await apply_hunger_decay(macaco_id)
+    await apply_health_decay(macaco_id)
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow('SELECT * FROM macacos WHERE macaco_id = $1 AND user_id = $2', macaco_id, user_id)
+    return dict(row) if row else None
+
 async def apply_hunger_decay(macaco_id: int) -> int:
     pool = await get_pool()
     async with pool.acquire() as conn:
@@ -161,12 +615,12 @@ async def apply_hunger_decay(macaco_id: int) -> int:
         delta = now - last_decay
         hours_passed = int(delta.total_seconds() // 3600)
         if hours_passed > 0:
-            hunger_increase = (hours_passed // 2) * 5
-            hunger = min(100, hunger + hunger_increase)
-            new_last_decay = last_decay + timedelta(hours=hours_passed // 2 * 2)
+            hunger, consumed_hours = cfg.hunger_after_decay(hunger, hours_passed)
+            new_last_decay = last_decay + timedelta(hours=consumed_hours)
             await conn.execute('''
                 UPDATE macacos 
-                SET hunger = $1, last_hunger_decay = $2 
+                SET hunger = $1, last_hunger_decay = $2,
+                    next_event_at = macaco_next_event(last_daily, last_fed, $1, $2, last_notified_at)
                 WHERE macaco_id = $3
             ''', hunger, new_last_decay, macaco_id)
         return hunger
@@ -190,7 +644,7 @@ async def apply_health_decay(macaco_id: int) -> int:
         delta = now - last_decay
         hours_passed = int(delta.total_seconds() // 3600)
         if hours_passed > 0:
-            health = max(0, health - hours_passed * 5)
+            health = cfg.health_after_decay(health, hours_passed)
             new_last_decay = last_decay + timedelta(hours=hours_passed)
             await conn.execute('''
                 UPDATE macacos 
@@ -223,7 +677,7 @@ async def can_feed_food(macaco_id: int, food_id: int) -> Tuple[bool, Optional[st
     food = await get_food_info_cached(food_id)
     if not food:
         return False, "Нет такой еды"
-    cooldown_hours = food['cooldown_hours']
+    cooldown_hours = food.cooldown_hours
     pool = await get_pool()
     async with pool.acquire() as conn:
         last_fed = await conn.fetchval('SELECT last_fed FROM macacos WHERE macaco_id = $1', macaco_id)
@@ -243,18 +697,41 @@ async def feed_macaco_with_food(macaco_id: int, food_id: int) -> bool:
         return False
     pool = await get_pool()
     async with pool.acquire() as conn:
-        await conn.execute('''
-            UPDATE macacos 
-            SET last_fed = $1,
-                hunger = GREATEST(0, hunger - $2),
-                weight = weight + $3,
-                health = LEAST(100, health + $4)
-            WHERE macaco_id = $5
+        # foods_tried растёт, только если этой еды макака ещё не пробовала; иначе – NULL
+        row = await conn.fetchrow('''
+            WITH m AS (
+                UPDATE macacos 
+                SET last_fed = $1,
+                    hunger = GREATEST(0, hunger - $2),
+                    weight = weight + $3,
+                    health = LEAST(100, health + $4),
+                    next_event_at = macaco_next_event(last_daily, $1, GREATEST(0, hunger - $2), last_hunger_decay, last_notified_at)
+                WHERE macaco_id = $5
+                RETURNING macaco_id, user_id, weight, level
+            ),
+            tried AS (
+                INSERT INTO macaco_foods (macaco_id, food_id)
+                SELECT macaco_id, $6 FROM m
+                ON CONFLICT DO NOTHING
+                RETURNING macaco_id
+            ),
+            c AS (
+                INSERT INTO macaco_counters AS c (macaco_id, foods_tried)
+                SELECT macaco_id, 1 FROM tried
+                ON CONFLICT (macaco_id) DO UPDATE SET foods_tried = c.foods_tried + 1
+                RETURNING foods_tried
+            )
+            SELECT m.*, (SELECT foods_tried FROM c) AS foods_tried FROM m
         ''', datetime.now(),
-              food['hunger_decrease'],
-              food['weight_gain'],
-              food['health_gain'],
-              macaco_id)
+              food.hunger_decrease,
+              food.weight_gain,
+              food.health_gain,
+              macaco_id,
+              food_id)
+        _rank_touch([row])
+        if row is not None:
+            changed = ('weight',) if row['foods_tried'] is None else ('weight', 'foods_tried')
+            await _unlock_achievements(conn, macaco_id, dict(row, food_types=len(_foods)), changed)
         return True
 
 async def can_get_daily(macaco_id: int) -> Tuple[bool, Optional[str]]:
@@ -276,14 +753,28 @@ async def can_get_daily(macaco_id: int) -> Tuple[bool, Optional[str]]:
 async def give_daily_reward(macaco_id: int) -> bool:
     pool = await get_pool()
     async with pool.acquire() as conn:
-        await conn.execute('''
-            UPDATE macacos
-            SET weight = weight + 1,
-                last_daily = $1,
-                happiness = LEAST(100, happiness + 5),
-                health = LEAST(100, health + 5)
-            WHERE macaco_id = $2
-        ''', datetime.now(), macaco_id)
+        row = await conn.fetchrow('''
+            WITH m AS (
+                UPDATE macacos
+                SET weight = weight + $3,
+                    last_daily = $1,
+                    happiness = LEAST(100, happiness + $4),
+                    health = LEAST(100, health + $5),
+                    next_event_at = macaco_next_event($1, last_fed, hunger, last_hunger_decay, last_notified_at)
+                WHERE macaco_id = $2
+                RETURNING macaco_id, user_id, weight, level
+            ),
+            c AS (
+                INSERT INTO macaco_counters AS c (macaco_id, dailies)
+                SELECT macaco_id, 1 FROM m
+                ON CONFLICT (macaco_id) DO UPDATE SET dailies = c.dailies + 1
+                RETURNING dailies
+            )
+            SELECT m.*, c.dailies FROM m, c
+        ''', datetime.now(), macaco_id, cfg.DAILY_WEIGHT, cfg.DAILY_HAPPINESS, cfg.DAILY_HEALTH)
+        _rank_touch([row])
+        if row is not None:
+            await _unlock_achievements(conn, macaco_id, row, ('weight', 'dailies'))
         return True
 
 async def apply_happiness_decay(macaco_id: int) -> int:
@@ -302,7 +793,7 @@ async def apply_happiness_decay(macaco_id: int) -> int:
         delta = now - last_decay
         hours_passed = int(delta.total_seconds() // 3600)
         if hours_passed > 0:
-            happiness = max(0, happiness - hours_passed * 10)
+            happiness = cfg.happiness_after_decay(happiness, hours_passed)
             new_last_decay = last_decay + timedelta(hours=hours_passed)
             await conn.execute('''
                 UPDATE macacos 
@@ -344,23 +835,43 @@ async def can_make_bet(macaco_id: int, bet_amount: int) -> Tuple[bool, str]:
             return False, f"Недостаточно веса. У вас: {weight} кг"
         return True, "OK"
 
-async def update_weight_after_fight(winner_id: int, loser_id: int, bet_weight: int):
-    pool = await get_pool()
-    async with pool.acquire() as conn:
-        await conn.execute('UPDATE macacos SET weight = weight + $1 WHERE macaco_id = $2', bet_weight, winner_id)
-        await conn.execute('''
-            UPDATE macacos 
-            SET weight = GREATEST(1, weight - $1)
-            WHERE macaco_id = $2
-        ''', bet_weight, loser_id)
+# Итог боёв для макак: $1 – id, $2 – изменение веса, $3 – опыт, $4 и $5 – потеря настроения и здоровья, $6 – LEVEL_EXP
+_FIGHT_UPDATE_SQL = '''
+    UPDATE macacos m
+    SET weight = GREATEST(1, m.weight + r.weight_delta),
+        level = m.level + (m.experience + r.exp_gain) / $6,
+        experience = (m.experience + r.exp_gain) % $6,
+        happiness = GREATEST(0, m.happiness - r.happiness_loss),
+        health = GREATEST(0, m.health - r.health_loss)
+    FROM unnest($1::int[], $2::int[], $3::int[], $4::int[], $5::int[])
+        AS r(macaco_id, weight_delta, exp_gain, happiness_loss, health_loss)
+    WHERE m.macaco_id = r.macaco_id
+    RETURNING m.macaco_id, m.user_id, m.name, m.weight, m.level, m.happiness, m.health
+'''
 
-async def record_fight(fighter1_id: int, fighter2_id: int, winner_id: int, bet_weight: int):
+async def resolve_fight(fighter1_id: int, fighter2_id: int, winner_id: int, bet_weight: int,
+                        winner_exp: int) -> Dict[int, Dict]:
+    """
+    Бой по вызову целиком в одной транзакции: вес, опыт победителя, настроение и здоровье проигравшего,
+    запись в fights и агрегаты. Возвращает обновлённые макаки по macaco_id.
+    """
+    loser_id = fighter2_id if winner_id == fighter1_id else fighter1_id
     pool = await get_pool()
     async with pool.acquire() as conn:
-        await conn.execute('''
-            INSERT INTO fights (fighter1_id, fighter2_id, winner_id, bet_weight)
-            VALUES ($1, $2, $3, $4)
-        ''', fighter1_id, fighter2_id, winner_id, bet_weight)
+        async with conn.transaction():
+            updated = await conn.fetch(_FIGHT_UPDATE_SQL, [winner_id, loser_id], [bet_weight, -bet_weight],
+                                       [winner_exp, 0], [0, cfg.FIGHT_LOSER_HAPPINESS_LOSS],
+                                       [0, cfg.FIGHT_LOSER_HEALTH_LOSS], cfg.LEVEL_EXP)
+            await conn.execute('''
+                INSERT INTO fights (fighter1_id, fighter2_id, winner_id, bet_weight)
+                VALUES ($1, $2, $3, $4)
+            ''', fighter1_id, fighter2_id, winner_id, bet_weight)
+            await _apply_fight_aggregates(conn, [winner_id], [loser_id], [bet_weight])
+            for row in updated:
+                if row['macaco_id'] == winner_id:
+                    await _unlock_achievements(conn, winner_id, row, ('weight',))
+    _rank_touch(updated)
+    return {row['macaco_id']: dict(row) for row in updated}
 
 async def add_experience(macaco_id: int, amount: int):
     pool = await get_pool()
@@ -368,45 +879,635 @@ async def add_experience(macaco_id: int, amount: int):
         row = await conn.fetchrow('SELECT experience, level FROM macacos WHERE macaco_id = $1', macaco_id)
         if not row:
             return
-        exp = row['experience']
-        level = row['level']
-        exp += amount
-        while exp >= 100:
-            exp -= 100
-            level += 1
-        await conn.execute('UPDATE macacos SET experience = $1, level = $2 WHERE macaco_id = $3', exp, level, macaco_id)
+        level, exp = cfg.level_after_experience(row['level'], row['experience'], amount)
+        row = await conn.fetchrow('''
+            UPDATE macacos SET experience = $1, level = $2 WHERE macaco_id = $3
+            RETURNING macaco_id, user_id, weight, level
+        ''', exp, level, macaco_id)
+        _rank_touch([row])
 
 async def get_top_macacos(limit: int = 5) -> List[Tuple]:
+    rows = await _fetch_read('''
+        SELECT m.name, m.weight, m.level, u.username
+        FROM users u
+        JOIN macacos m ON m.macaco_id = u.active_macaco_id
+        ORDER BY m.weight DESC, m.level DESC
+        LIMIT $1
+    ''', limit)
+    return [(r['name'], r['weight'], r['level'], r['username']) for r in rows]
+
+async def search_macacos(query: str, limit: int = 10) -> List[Dict]:
+    # % и _ во вводе пользователя ищутся буквально, а не как шаблон
+    pattern = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    rows = await _fetch_read('''
+        SELECT m.macaco_id, m.name, m.weight, m.level, u.username
+        FROM users u
+        JOIN macacos m ON m.macaco_id = u.active_macaco_id
+        WHERE m.name ILIKE $1 OR u.username ILIKE $1
+        ORDER BY m.weight DESC
+        LIMIT $2
+    ''', f'%{pattern}%', limit)
+    return [dict(r) for r in rows]
+
+async def list_opponents(user_id: int, limit: int = 10) -> List[Dict]:
+    rows = await _fetch_read('''
+        SELECT m.macaco_id, m.name, m.weight, m.level, m.user_id
+        FROM users u
+        JOIN macacos m ON m.macaco_id = u.active_macaco_id
+        WHERE u.user_id != $1
+        LIMIT $2
+    ''', user_id, limit)
+    return [dict(r) for r in rows]
+
+async def get_macaco_card(macaco_id: int) -> Optional[Dict]:
+    rows = await _fetch_read('SELECT name, weight, level, user_id FROM macacos WHERE macaco_id = $1', macaco_id)
+    return dict(rows[0]) if rows else None
+
+# ---------- Участники групповых чатов ----------
+# Апдейты из групп отмечают пару чат–пользователь в памяти; в базу пары уходят пачкой раз в CHAT_FLUSH_SECONDS,
+# а уже записанная пара повторно пишется не чаще раза в CHAT_SEEN_REFRESH.
+CHAT_FLUSH_SECONDS = 10
+CHAT_SEEN_REFRESH = 6 * 3600
+CHAT_SEEN_SIZE = 200000
+CHAT_TOP_SIZE = 10
+CHAT_TOP_TTL = 60  # сек – топ чата пересчитывается не чаще, сколько бы раз его ни открывали
+CHAT_TOP_CACHE_SIZE = 10000
+_chat_seen: 'OrderedDict[Tuple[int, int], float]' = OrderedDict()
+_chat_pending: Dict[Tuple[int, int], datetime] = {}
+_chat_top_cache: 'OrderedDict[int, Tuple[float, List[Tuple]]]' = OrderedDict()
+_chat_flush_task = None
+
+def note_chat_member(chat_id: int, user_id: int):
+    key = (chat_id, user_id)
+    now = time.monotonic()
+    seen = _chat_seen.get(key)
+    if seen is not None and now - seen < CHAT_SEEN_REFRESH:
+        return
+    _chat_seen[key] = now
+    _chat_seen.move_to_end(key)
+    if len(_chat_seen) > CHAT_SEEN_SIZE:
+        _chat_seen.popitem(last=False)
+    _chat_pending[key] = datetime.now()
+
+async def flush_chat_members() -> int:
+    global _chat_pending
+    if not _chat_pending:
+        return 0
+    pending, _chat_pending = _chat_pending, {}
+    chats, users = (list(column) for column in zip(*pending))
+    try:
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            await conn.execute('''
+                INSERT INTO chat_members (chat_id, user_id, last_seen)
+                SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::timestamp[])
+                ON CONFLICT (chat_id, user_id) DO UPDATE SET last_seen = EXCLUDED.last_seen
+            ''', chats, users, list(pending.values()))
+    except BaseException:
+        for key, seen_at in pending.items():
+            _chat_pending.setdefault(key, seen_at)
+        raise
+    for chat_id in set(chats):
+        _chat_top_cache.pop(chat_id, None)  # в чате мог появиться новый участник
+    return len(pending)
+
+async def _run_chat_flusher():
+    while True:
+        await asyncio.sleep(CHAT_FLUSH_SECONDS)
+        try:
+            await flush_chat_members()
+        except Exception as e:
+            logger.warning("⚠️ Запись участников чатов (%s в очереди): %s", len(_chat_pending), e)
+
+def start_chat_member_flusher():
+    global _chat_flush_task
+    if _chat_flush_task is None:
+        _chat_flush_task = asyncio.create_task(_run_chat_flusher())
+
+async def stop_chat_member_flusher():
+    global _chat_flush_task
+    if _chat_flush_task is not None:
+        _chat_flush_task.cancel()
+        _chat_flush_task = None
+    try:
+        await flush_chat_members()
+    except Exception as e:
+        logger.error("⚠️ При остановке не записано участников чатов: %s (%s)", len(_chat_pending), e)
+
+async def remove_chat_member(chat_id: int, user_id: int):
+    _chat_seen.pop((chat_id, user_id), None)
+    _chat_pending.pop((chat_id, user_id), None)
+    _chat_top_cache.pop(chat_id, None)
     pool = await get_pool()
     async with pool.acquire() as conn:
-        rows = await conn.fetch('''
-            SELECT m.name, m.weight, m.level, u.username 
-            FROM macacos m
-            LEFT JOIN users u ON m.user_id = u.user_id
-            INNER JOIN (
-                SELECT user_id, MAX(macaco_id) as last_id
-                FROM macacos
-                GROUP BY user_id
-            ) latest ON m.user_id = latest.user_id AND m.macaco_id = latest.last_id
-            ORDER BY m.weight DESC, m.level DESC 
-            LIMIT $1
-        ''', limit)
-        return [(r['name'], r['weight'], r['level'], r['username']) for r in rows]
+        await conn.execute('DELETE FROM chat_members WHERE chat_id = $1 AND user_id = $2', chat_id, user_id)
 
-async def search_macacos(query: str, limit: int = 10) -> List[Dict]:
+async def forget_chat(chat_id: int):
+    """Бота удалили из чата – участники этого чата больше не нужны."""
+    for key in [key for key in _chat_seen if key[0] == chat_id]:
+        del _chat_seen[key]
+    for key in [key for key in _chat_pending if key[0] == chat_id]:
+        del _chat_pending[key]
+    _chat_top_cache.pop(chat_id, None)
     pool = await get_pool()
     async with pool.acquire() as conn:
-        rows = await conn.fetch('''
-            SELECT m.macaco_id, m.name, m.weight, m.level, u.username
-            FROM macacos m
-            LEFT JOIN users u ON m.user_id = u.user_id
-            WHERE m.name ILIKE $1 OR u.username ILIKE $1
-            ORDER BY m.weight DESC
+        await conn.execute('DELETE FROM chat_members WHERE chat_id = $1', chat_id)
+
+async def get_chat_top(chat_id: int, limit: int = CHAT_TOP_SIZE) -> List[Tuple]:
+    """Как get_top_macacos, но только среди участников чата; не больше CHAT_TOP_SIZE строк."""
+    cached = _chat_top_cache.get(chat_id)
+    if cached is not None and cached[0] > time.monotonic():
+        _chat_top_cache.move_to_end(chat_id)
+        return cached[1][:limit]
+    # Участники чата по первичному ключу, дальше пользователь и его активная макака – тоже по первичным ключам.
+    # macaco_id в конце сортировки – чтобы при равных весе и уровне порядок не менялся между запросами
+    query = '''
+        SELECT m.name, m.weight, m.level, u.username
+        FROM chat_members cm
+        JOIN users u ON u.user_id = cm.user_id
+        JOIN macacos m ON m.macaco_id = u.active_macaco_id
+        WHERE cm.chat_id = $1
+        ORDER BY m.weight DESC, m.level DESC, m.macaco_id
+        LIMIT $2
+    '''
+    if any(key[0] == chat_id for key in _chat_pending):
+        await flush_chat_members()
+        # Только что записанных участников на реплике может ещё не быть – читаем с основной базы
+        pool = await get_pool()
+        rows = await pool.fetch(query, chat_id, CHAT_TOP_SIZE)
+    else:
+        rows = await _fetch_read(query, chat_id, CHAT_TOP_SIZE)
+    top = [(r['name'], r['weight'], r['level'], r['username']) for r in rows]
+    _chat_top_cache[chat_id] = (time.monotonic() + CHAT_TOP_TTL, top)
+    _chat_top_cache.move_to_end(chat_id)
+    if len(_chat_top_cache) > CHAT_TOP_CACHE_SIZE:
+        _chat_top_cache.popitem(last=False)
+    return top[:limit]
+
+# ---------- Рейтинг: место считается по RankIndex в памяти, а не COUNT(*) по таблице ----------
+# Процесс обновляет индекс сам при каждом изменении веса или уровня; изменения из других процессов
+# (воркеры, арена) подтягиваются полной пересборкой раз в RANK_RESYNC_SECONDS.
+def _rank_touch(rows):
+    for row in rows:
+        if row is None:
+            continue
+        _rank_index.update(row['macaco_id'], row['user_id'], row['weight'], row['level'])
+        for pending in _rank_pending:
+            pending[row['macaco_id']] = row
+
+async def load_rank_index(if_missing: bool = False):
+    """Полная пересборка индекса; с if_missing=True – только если он ещё не загружен (ждёт идущую загрузку)."""
+    global _rank_loaded
+    async with _rank_load_lock:
+        if if_missing and _rank_loaded:
+            return
+        # Свой буфер у каждой загрузки: её завершение не отключает запись изменений для других
+        pending: Dict[int, Dict] = {}
+        _rank_pending.append(pending)
+        try:
+            rows = await _fetch_read('''
+                SELECT m.macaco_id, m.user_id, m.weight, m.level
+                FROM users u
+                JOIN macacos m ON m.macaco_id = u.active_macaco_id
+            ''')
+            _rank_index.load((r['macaco_id'], r['user_id'], r['weight'], r['level']) for r in rows)
+            # Пока шёл запрос, этот процесс мог успеть изменить макак – снимок их не видит
+            for row in pending.values():
+                _rank_index.update(row['macaco_id'], row['user_id'], row['weight'], row['level'])
+            _rank_loaded = True
+        finally:
+            _rank_pending.remove(pending)
+
+async def get_rank(user_id: int, radius: int = 1) -> Optional[Dict]:
+    """Место макаки пользователя и соседи сверху и снизу: {'rank', 'total', 'neighbours': [...]}."""
+    if not _rank_loaded:
+        await load_rank_index(if_missing=True)
+    macaco_id = _rank_index.macaco_of(user_id)
+    if macaco_id is None:
+        return None
+    around = _rank_index.around(macaco_id, radius)
+    rows = await _fetch_read('SELECT macaco_id, name, weight, level FROM macacos WHERE macaco_id = ANY($1::int[])',
+                             [m for _, m in around])
+    by_id = {r['macaco_id']: r for r in rows}
+    return {
+        'rank': _rank_index.rank(macaco_id),
+        'total': len(_rank_index),
+        'neighbours': [dict(by_id[m], rank=rank, me=m == macaco_id) for rank, m in around if m in by_id],
+    }
+
+async def _resync_rank_index():
+    while True:
+        await asyncio.sleep(RANK_RESYNC_SECONDS)
+        try:
+            await load_rank_index()
+        except Exception as e:
+            logger.warning("⚠️ Пересборка рейтинга: %s", e)
+
+def start_rank_resync():
+    global _rank_resync_task
+    if _rank_resync_task is None:
+        _rank_resync_task = asyncio.create_task(_resync_rank_index())
+
+def stop_rank_resync():
+    global _rank_resync_task
+    if _rank_resync_task is not None:
+        _rank_resync_task.cancel()
+        _rank_resync_task = None
+
+# ---------- Агрегаты боёв ----------
+# Строка на участника боя: $1 – победители, $2 – проигравшие, $3 – ставки
+_ROLLUP_PERIODS = ('hour', 'day')
+_FIGHT_RESULTS_CTE = '''
+    WITH r AS (
+        SELECT macaco_id, TRUE AS won, bet FROM unnest($1::int[], $3::int[]) AS w(macaco_id, bet)
+        UNION ALL
+        SELECT macaco_id, FALSE, bet FROM unnest($2::int[], $3::int[]) AS l(macaco_id, bet)
+    )
+'''
+
+async def _apply_fight_aggregates(conn, winners: List[int], losers: List[int], bets: List[int]):
+    """Вызывается в транзакции, которая пишет сами бои; макака встречается в пачке не больше одного раза."""
+    stats = await conn.fetch(_FIGHT_RESULTS_CTE + '''
+        INSERT INTO fight_stats AS s (macaco_id, wins, losses, weight_won, weight_lost, streak, best_streak, last_fight_at)
+        SELECT macaco_id, won::int, (NOT won)::int,
+               CASE WHEN won THEN bet ELSE 0 END, CASE WHEN won THEN 0 ELSE bet END,
+               CASE WHEN won THEN 1 ELSE -1 END, won::int, LOCALTIMESTAMP
+        FROM r
+        ON CONFLICT (macaco_id) DO UPDATE SET
+            wins = s.wins + EXCLUDED.wins,
+            losses = s.losses + EXCLUDED.losses,
+            weight_won = s.weight_won + EXCLUDED.weight_won,
+            weight_lost = s.weight_lost + EXCLUDED.weight_lost,
+            -- streak > 0 – серия побед, < 0 – серия поражений
+            streak = CASE WHEN EXCLUDED.wins > 0 THEN GREATEST(s.streak, 0) + 1 ELSE LEAST(s.streak, 0) - 1 END,
+            best_streak = GREATEST(s.best_streak, CASE WHEN EXCLUDED.wins > 0 THEN GREATEST(s.streak, 0) + 1 ELSE 0 END),
+            last_fight_at = EXCLUDED.last_fight_at
+        RETURNING s.macaco_id, s.wins, s.best_streak
+    ''', winners, losers, bets)
+    # У проигравших wins и best_streak не меняются – их правила не проверяем
+    won = set(winners)
+    for row in stats:
+        if row['macaco_id'] in won:
+            await _unlock_achievements(conn, row['macaco_id'], row, ('wins', 'best_streak'))
+    for period in _ROLLUP_PERIODS:
+        await conn.execute(_FIGHT_RESULTS_CTE + f'''
+            INSERT INTO fight_rollup_{period} AS t (bucket, macaco_id, wins, losses, weight_delta)
+            SELECT date_trunc('{period}', LOCALTIMESTAMP), macaco_id,
+                   COUNT(*) FILTER (WHERE won), COUNT(*) FILTER (WHERE NOT won),
+                   SUM(CASE WHEN won THEN bet ELSE -bet END)
+            FROM r
+            GROUP BY macaco_id
+            ON CONFLICT (bucket, macaco_id) DO UPDATE SET
+                wins = t.wins + EXCLUDED.wins,
+                losses = t.losses + EXCLUDED.losses,
+                weight_delta = t.weight_delta + EXCLUDED.weight_delta
+        ''', winners, losers, bets)
+
+# Те же строки участников, но из всей таблицы fights
+_ALL_FIGHT_RESULTS_CTE = '''
+    WITH r AS (
+        SELECT winner_id AS macaco_id, TRUE AS won, bet_weight AS bet, fight_id, fight_time
+        FROM fights WHERE winner_id IS NOT NULL
+        UNION ALL
+        SELECT CASE WHEN winner_id = fighter1_id THEN fighter2_id ELSE fighter1_id END, FALSE, bet_weight, fight_id, fight_time
+        FROM fights WHERE winner_id IS NOT NULL
+    )
+'''
+
+async def _rebuild_fight_aggregates(conn):
+    await conn.execute('TRUNCATE fight_stats, ' + ', '.join(f'fight_rollup_{p}' for p in _ROLLUP_PERIODS))
+    # Серии: у подряд идущих одинаковых исходов разность двух ROW_NUMBER постоянна
+    await conn.execute(_ALL_FIGHT_RESULTS_CTE + ''',
+    numbered AS (
+        SELECT r.*,
+               ROW_NUMBER() OVER (PARTITION BY macaco_id ORDER BY fight_id)
+             - ROW_NUMBER() OVER (PARTITION BY macaco_id, won ORDER BY fight_id) AS run
+        FROM r
+    ),
+    runs AS (
+        SELECT macaco_id, won, run, COUNT(*) AS length, MAX(fight_id) AS last_fight_id
+        FROM numbered
+        GROUP BY macaco_id, won, run
+    ),
+    current_run AS (
+        SELECT DISTINCT ON (macaco_id) macaco_id, CASE WHEN won THEN length ELSE -length END AS streak
+        FROM runs
+        ORDER BY macaco_id, last_fight_id DESC
+    ),
+    best_run AS (
+        SELECT macaco_id, COALESCE(MAX(length) FILTER (WHERE won), 0) AS best_streak
+        FROM runs
+        GROUP BY macaco_id
+    ),
+    totals AS (
+        SELECT macaco_id,
+               COUNT(*) FILTER (WHERE won) AS wins, COUNT(*) FILTER (WHERE NOT won) AS losses,
+               COALESCE(SUM(bet) FILTER (WHERE won), 0) AS weight_won,
+               COALESCE(SUM(bet) FILTER (WHERE NOT won), 0) AS weight_lost,
+               MAX(fight_time) AS last_fight_at
+        FROM r
+        GROUP BY macaco_id
+    )
+    INSERT INTO fight_stats (macaco_id, wins, losses, weight_won, weight_lost, streak, best_streak, last_fight_at)
+    SELECT t.macaco_id, t.wins, t.losses, t.weight_won, t.weight_lost, c.streak, b.best_streak, t.last_fight_at
+    FROM totals t
+    JOIN current_run c USING (macaco_id)
+    JOIN best_run b USING (macaco_id)
+    ''')
+    for period in _ROLLUP_PERIODS:
+        await conn.execute(_ALL_FIGHT_RESULTS_CTE + f'''
+            INSERT INTO fight_rollup_{period} (bucket, macaco_id, wins, losses, weight_delta)
+            SELECT date_trunc('{period}', fight_time), macaco_id,
+                   COUNT(*) FILTER (WHERE won), COUNT(*) FILTER (WHERE NOT won),
+                   SUM(CASE WHEN won THEN bet ELSE -bet END)
+            FROM r
+            GROUP BY 1, macaco_id
+        ''')
+
+async def rebuild_fight_aggregates():
+    """
+    Пересобирает fight_stats и роллапы из fights одной транзакцией. TRUNCATE берёт ACCESS EXCLUSIVE:
+    чтение этих таблиц (статистика, достижения, бои) ждёт коммита пересборки.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await _rebuild_fight_aggregates(conn)
+
+# ---------- Достижения ----------
+async def _unlock_achievements(conn, macaco_id: int, counters, changed) -> List[str]:
+    """
+    Проверяет правила, зависящие от changed, и записывает выполненные. Возвращает новые коды.
+    Вызывается в том же соединении (и транзакции), что изменило счётчики.
+    """
+    codes = [code for code in achievements.evaluate(counters, changed) if (macaco_id, code) not in _achievements_seen]
+    if not codes:
+        return []
+    rows = await conn.fetch('''
+        INSERT INTO achievements (macaco_id, code)
+        SELECT $1, unnest($2::text[])
+        ON CONFLICT DO NOTHING
+        RETURNING code
+    ''', macaco_id, codes)
+    new = [r['code'] for r in rows]
+    # Запомнить можно только уже существовавшие: новая запись ещё может откатиться вместе с транзакцией
+    for code in set(codes) - set(new):
+        _achievements_seen[(macaco_id, code)] = True
+        if len(_achievements_seen) > ACHIEVEMENT_SEEN_SIZE:
+            _achievements_seen.popitem(last=False)
+    return new
+
+async def _backfill_achievements(conn):
+    """
+    Первичное заполнение пустых счётчиков из журнала событий и проверка всех правил по всем макакам.
+    Существующие строки не трогает: вызывается, только пока macaco_counters пуста.
+    """
+    await conn.execute('''
+        INSERT INTO macaco_foods (macaco_id, food_id)
+        SELECT DISTINCT e.macaco_id, (e.payload->>'food_id')::int
+        FROM game_events e
+        JOIN macacos m ON m.macaco_id = e.macaco_id
+        WHERE e.kind = 'feed'
+        ON CONFLICT DO NOTHING
+    ''')
+    await conn.execute('''
+        INSERT INTO macaco_counters (macaco_id, foods_tried, dailies)
+        SELECT m.macaco_id,
+               (SELECT COUNT(*) FROM macaco_foods f WHERE f.macaco_id = m.macaco_id),
+               (SELECT COUNT(*) FROM game_events e WHERE e.macaco_id = m.macaco_id AND e.kind = 'daily')
+        FROM macacos m
+        ON CONFLICT DO NOTHING
+    ''')
+    food_types = await conn.fetchval('SELECT COUNT(*) FROM food_types')
+    rows = await conn.fetch('''
+        SELECT m.macaco_id, m.weight, COALESCE(s.wins, 0) AS wins, COALESCE(s.best_streak, 0) AS best_streak,
+               c.foods_tried, c.dailies
+        FROM macacos m
+        JOIN macaco_counters c USING (macaco_id)
+        LEFT JOIN fight_stats s USING (macaco_id)
+    ''')
+    unlocked = [(row['macaco_id'], code) for row in rows
+                for code in achievements.evaluate(dict(row, food_types=food_types))]
+    await conn.execute('''
+        INSERT INTO achievements (macaco_id, code)
+        SELECT * FROM unnest($1::int[], $2::text[])
+        ON CONFLICT DO NOTHING
+    ''', [u[0] for u in unlocked], [u[1] for u in unlocked])
+    _achievements_seen.clear()
+
+async def get_achievements(macaco_id: int) -> List[str]:
+    rows = await _fetch_read('SELECT code FROM achievements WHERE macaco_id = $1 ORDER BY unlocked_at', macaco_id)
+    return [r['code'] for r in rows]
+
+async def get_fight_stats(macaco_id: int) -> Optional[Dict]:
+    rows = await _fetch_read('SELECT * FROM fight_stats WHERE macaco_id = $1', macaco_id)
+    return dict(rows[0]) if rows else None
+
+async def get_fight_period_stats(macaco_id: int, hours: int) -> Dict:
+    """Итоги за последние hours часов из часового роллапа."""
+    rows = await _fetch_read('''
+        SELECT COALESCE(SUM(wins), 0) AS wins, COALESCE(SUM(losses), 0) AS losses,
+               COALESCE(SUM(weight_delta), 0) AS weight_delta
+        FROM fight_rollup_hour
+        WHERE macaco_id = $1 AND bucket > date_trunc('hour', LOCALTIMESTAMP) - $2::int * INTERVAL '1 hour'
+    ''', macaco_id, hours)
+    return dict(rows[0])
+
+async def get_top_gainers(days: int, limit: int = 5) -> List[Dict]:
+    """Наибольший прирост веса в боях за последние days дней (включая сегодня) – из дневного роллапа."""
+    rows = await _fetch_read('''
+        SELECT t.macaco_id, m.name, t.weight_delta, t.wins, t.losses
+        FROM (
+            SELECT macaco_id, SUM(weight_delta) AS weight_delta, SUM(wins) AS wins, SUM(losses) AS losses
+            FROM fight_rollup_day
+            WHERE bucket > date_trunc('day', LOCALTIMESTAMP) - $1::int * INTERVAL '1 day'
+            GROUP BY macaco_id
+            ORDER BY SUM(weight_delta) DESC
             LIMIT $2
-        ''', f'%{query}%', limit)
+        ) t
+        JOIN macacos m ON m.macaco_id = t.macaco_id
+        ORDER BY t.weight_delta DESC
+    ''', days, limit)
+    return [dict(r) for r in rows]
+
+# ---------- Уведомления ----------
+async def claim_due_events(now: datetime, limit: int) -> List[Dict]:
+    """Забирает пачку наступивших событий и сразу переносит next_event_at на следующее."""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch('''
+            WITH due AS (
+                SELECT macaco_id, next_event_at
+                FROM macacos
+                WHERE next_event_at <= $1
+                ORDER BY next_event_at
+                LIMIT $2
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE macacos m
+            SET last_notified_at = $1,
+                next_event_at = macaco_next_event(m.last_daily, m.last_fed, m.hunger, m.last_hunger_decay, $1)
+            FROM due, users u
+            WHERE m.macaco_id = due.macaco_id AND u.user_id = m.user_id
+            RETURNING m.macaco_id, m.user_id, m.name, m.last_daily, m.last_fed, due.next_event_at AS event_at,
+                      u.notify_enabled AND u.active_macaco_id = m.macaco_id AS notify_enabled
+        ''', now, limit)
         return [dict(r) for r in rows]
 
-async def init_db():
-    """Вызывается при старте бота для создания таблиц и кэша."""
-    await get_pool()
-    await create_tables()
+async def toggle_notifications(user_id: int) -> Optional[bool]:
+    """Переключает уведомления и возвращает новое значение; None – пользователя ещё нет в базе."""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetchval('''
+            UPDATE users SET notify_enabled = NOT notify_enabled WHERE user_id = $1 RETURNING notify_enabled
+        ''', user_id)
+
+# ---------- Арена ----------
+async def arena_join(macaco_id: int, user_id: int, bet: int):
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        await conn.execute('''
+            INSERT INTO arena_queue (macaco_id, user_id, bet)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (macaco_id) DO UPDATE SET bet = EXCLUDED.bet
+        ''', macaco_id, user_id, bet)
+
+async def arena_leave(macaco_id: int) -> bool:
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        result = await conn.execute('DELETE FROM arena_queue WHERE macaco_id = $1', macaco_id)
+        return result != 'DELETE 0'
+
+async def arena_queue_info(macaco_id: int) -> Tuple[Optional[int], int]:
+    """Ставка макаки в очереди арены (None – не в очереди) и размер очереди."""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow('''
+            SELECT (SELECT bet FROM arena_queue WHERE macaco_id = $1) AS bet,
+                   (SELECT COUNT(*) FROM arena_queue) AS size
+        ''', macaco_id)
+        return row['bet'], row['size']
+
+def _decay_row(row: Dict, now: datetime) -> bool:
+    """
+    Тот же распад, что apply_happiness_decay, apply_hunger_decay и apply_health_decay (в том же порядке),
+    но над уже прочитанной строкой. Меняет row на месте; True – что-то изменилось и строку надо записать.
+    """
+    changed = False
+    hours = int((now - (row['last_happiness_decay'] or now)).total_seconds() // 3600)
+    if hours > 0:
+        row['happiness'] = cfg.happiness_after_decay(row['happiness'], hours)
+        row['last_happiness_decay'] += timedelta(hours=hours)
+        changed = True
+    hours = int((now - (row['last_hunger_decay'] or now)).total_seconds() // 3600)
+    if hours > 0:
+        row['hunger'], consumed = cfg.hunger_after_decay(row['hunger'], hours)
+        row['last_hunger_decay'] += timedelta(hours=consumed)
+        changed = True
+    if row['hunger'] >= 100:
+        hours = int((now - (row['last_health_decay'] or now)).total_seconds() // 3600)
+        if hours > 0:
+            row['health'] = cfg.health_after_decay(row['health'], hours)
+            row['last_health_decay'] += timedelta(hours=hours)
+            changed = True
+    return changed
+
+async def arena_tick(plan, limit: int) -> Tuple[List[Dict], List[Tuple[int, int, int]], List[Dict]]:
+    """
+    Один тик арены в одной транзакции.
+    plan(rows) -> (исключённые macaco_id, [(winner_id, loser_id, bet), ...]).
+    Возвращает (исключённые записи очереди, бои, обновлённые макаки).
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            rows = await conn.fetch('''
+                SELECT q.macaco_id, q.user_id, q.bet, m.name, m.weight, m.level, m.health, m.hunger,
+                       m.happiness, m.last_happiness_decay, m.last_hunger_decay, m.last_health_decay
+                FROM arena_queue q
+                JOIN macacos m ON m.macaco_id = q.macaco_id
+                ORDER BY q.joined_at
+                LIMIT $1
+                FOR UPDATE OF q, m SKIP LOCKED
+            ''', limit)
+            rows = [dict(r) for r in rows]
+            # Сохранённые голод и здоровье – на момент последнего действия; макака, простоявшая в очереди
+            # несколько дней, без распада выглядела бы сытой и здоровой. Распад записывается в той же транзакции
+            now = datetime.now()
+            decayed = [r for r in rows if _decay_row(r, now)]
+            if decayed:
+                await conn.execute('''
+                    UPDATE macacos m
+                    SET happiness = r.happiness, last_happiness_decay = r.last_happiness_decay,
+                        hunger = r.hunger, last_hunger_decay = r.last_hunger_decay,
+                        health = r.health, last_health_decay = r.last_health_decay,
+                        next_event_at = macaco_next_event(m.last_daily, m.last_fed, r.hunger, r.last_hunger_decay,
+                                                          m.last_notified_at)
+                    FROM unnest($1::int[], $2::int[], $3::timestamp[], $4::int[], $5::timestamp[],
+                                $6::int[], $7::timestamp[])
+                        AS r(macaco_id, happiness, last_happiness_decay, hunger, last_hunger_decay,
+                             health, last_health_decay)
+                    WHERE m.macaco_id = r.macaco_id
+                ''', *([r[c] for r in decayed] for c in ('macaco_id', 'happiness', 'last_happiness_decay', 'hunger',
+                                                         'last_hunger_decay', 'health', 'last_health_decay')))
+            kicked_ids, fights = plan(rows)
+            if not kicked_ids and not fights:
+                return [], [], []
+
+            fighter_ids = [mid for w, l, _ in fights for mid in (w, l)]
+            await conn.execute('DELETE FROM arena_queue WHERE macaco_id = ANY($1::int[])',
+                               list(kicked_ids) + fighter_ids)
+            if not fights:
+                kicked = set(kicked_ids)
+                return [r for r in rows if r['macaco_id'] in kicked], [], []
+
+            ids, weight_delta, exp_gain, happiness_loss, health_loss = [], [], [], [], []
+            for winner_id, loser_id, bet in fights:
+                ids += [winner_id, loser_id]
+                weight_delta += [bet, -bet]
+                exp_gain += [cfg.FIGHT_WIN_EXP, cfg.FIGHT_LOSE_EXP]
+                happiness_loss += [0, cfg.FIGHT_LOSER_HAPPINESS_LOSS]
+                health_loss += [0, cfg.FIGHT_LOSER_HEALTH_LOSS]
+            updated = await conn.fetch(_FIGHT_UPDATE_SQL, ids, weight_delta, exp_gain, happiness_loss, health_loss,
+                                       cfg.LEVEL_EXP)
+            await conn.execute('''
+                INSERT INTO fights (fighter1_id, fighter2_id, winner_id, bet_weight)
+                SELECT * FROM unnest($1::int[], $2::int[], $3::int[], $4::int[])
+            ''', [f[0] for f in fights], [f[1] for f in fights], [f[0] for f in fights], [f[2] for f in fights])
+            await _apply_fight_aggregates(conn, [f[0] for f in fights], [f[1] for f in fights], [f[2] for f in fights])
+            won = {f[0] for f in fights}
+            for row in updated:
+                if row['macaco_id'] in won:
+                    await _unlock_achievements(conn, row['macaco_id'], row, ('weight',))
+
+    _rank_touch(updated)
+    kicked = set(kicked_ids)
+    return [r for r in rows if r['macaco_id'] in kicked], fights, [dict(r) for r in updated]
+
+async def init_db() -> Dict[str, float]:
+    """Вызывается при старте бота. Схема проверяется одним запросом, кэши грузятся лениво или в warm_up()."""
+    timings = {}
+    started = time.perf_counter()
+    pool = await get_pool()
+    timings['pool'] = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    try:
+        version = await pool.fetchval('SELECT MAX(version) FROM schema_version')
+    except asyncpg.UndefinedTableError:
+        version = None
+    if version is None or version < SCHEMA_VERSION:
+        await create_tables()
+    timings['schema'] = (time.perf_counter() - started) * 1000
+    return timings
+
+async def warm_up():
+    """Фоновый прогрев после старта: соединения пула, кэш еды и рейтинг."""
+    pool = await get_pool()
+    # Открытие новых соединений – не перегрузка, ждём его дольше обычного
+    conns = await asyncio.gather(*(pool.acquire(timeout=60) for _ in range(POOL_WARM_SIZE - 1)), return_exceptions=True)
+    for conn in conns:
+        if not isinstance(conn, BaseException):
+            await pool.release(conn)
+    await load_food_cache()
+    await load_rank_index(if_missing=True)
@@ -0,0 +1,155 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import asyncpg
+
+import database as db
+
+logger = logging.getLogger(__name__)
+
+# Журнал игровых событий: обработчики кладут события в буфер процесса,
+# фоновая задача сбрасывает его в game_events одним COPY на пачку.
+EVENT_FLUSH_SECONDS = float(os.getenv('EVENT_FLUSH_SECONDS', '2'))
+EVENT_BATCH = 1000  # при таком размере буфера сброс запускается сразу, не дожидаясь таймера
+EVENT_BUFFER_LIMIT = 50000  # если база недоступна, дольше копить не будем: старые события отбрасываются
+REPLAY_BATCH = 5000
+
+# Тип события -> обязательные поля payload
+EVENT_FIELDS: Dict[str, Tuple[str, ...]] = {
+    'feed': ('food_id', 'weight_gain', 'hunger_decrease', 'health_gain', 'weight'),
+    'daily': ('weight_gain', 'happiness_gain', 'health_gain', 'weight'),
+    'walk': ('happiness',),
+    'rename': ('name',),
+    'fight': ('winner_id', 'loser_id', 'bet', 'arena'),
+}
+
+COLUMNS = ('created_at', 'kind', 'user_id', 'macaco_id', 'payload')
+
+
+class Event(NamedTuple):
+    created_at: datetime
+    kind: str
+    user_id: Optional[int]
+    macaco_id: Optional[int]
+    payload: Dict[str, Any]
+
+
+_buffer: List[Tuple] = []
+_wakeup: Optional[asyncio.Event] = None
+_flusher_task = None
+_stopping = False
+_flush_lock = asyncio.Lock()
+dropped = 0
+
+
+# ---------- Запись ----------
+def emit(kind: str, user_id: Optional[int], macaco_id: Optional[int], **payload):
+    """Кладёт событие в буфер; не ждёт базу и не бросает исключений из-за неё."""
+    global dropped
+    fields = EVENT_FIELDS[kind]
+    if set(payload) != set(fields):
+        raise ValueError(f"Событие {kind}: ожидаются поля {fields}, получены {tuple(payload)}")
+    if len(_buffer) >= EVENT_BUFFER_LIMIT:
+        del _buffer[:EVENT_BATCH]
+        dropped += EVENT_BATCH
+        logger.warning("Буфер событий переполнен, отброшено %s старейших", EVENT_BATCH)
+    _buffer.append((datetime.now(), kind, user_id, macaco_id, json.dumps(payload, ensure_ascii=False)))
+    if len(_buffer) >= EVENT_BATCH and _wakeup is not None:
+        _wakeup.set()
+
+
+async def flush() -> int:
+    # Один сброс за раз: иначе пачки могли бы уйти в базу не в порядке событий
+    async with _flush_lock:
+        written = 0
+        while _buffer:
+            batch = _buffer[:EVENT_BATCH]
+            del _buffer[:len(batch)]
+            copied = False
+            try:
+                pool = await db.get_pool()
+                async with pool.acquire() as conn:
+                    await conn.copy_records_to_table('game_events', records=batch, columns=COLUMNS)
+                    copied = True
+            except BaseException:
+                # Пачка возвращается в начало буфера и уйдёт при следующем сбросе – но только если COPY
+                # не завершился: ошибка при возврате соединения в пул не должна записать события дважды
+                if not copied:
+                    _buffer[:0] = batch
+                raise
+            written += len(batch)
+        return written
+
+
+async def _run_flusher():
+    while not _stopping:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), EVENT_FLUSH_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+        try:
+            await flush()
+        except Exception as e:
+            logger.error("Ошибка записи событий (%s в буфере): %s", len(_buffer), e)
+
+
+def start():
+    global _flusher_task, _wakeup, _stopping
+    if _flusher_task is None:
+        _stopping = False
+        _wakeup = asyncio.Event()
+        _flusher_task = asyncio.create_task(_run_flusher())
+
+
+async def stop():
+    """Останавливает фоновый сброс и дописывает остаток буфера."""
+    global _flusher_task, _stopping
+    if _flusher_task is not None:
+        # Не отменяем задачу посреди COPY: будим её, она дописывает текущий сброс и выходит из цикла
+        _stopping = True
+        _wakeup.set()
+        await _flusher_task
+        _flusher_task = None
+    try:
+        await flush()
+    except Exception as e:
+        logger.error("При остановке не записано событий: %s (%s)", len(_buffer), e)
+
+
+# ---------- Воспроизведение ----------
+async def replay(apply: Callable[[asyncpg.Connection, List[Event]], Awaitable[None]],
+                 kinds: Optional[Iterable[str]] = None, since_id: int = 0,
+                 prepare: Optional[Callable[[asyncpg.Connection], Awaitable[None]]] = None) -> int:
+    """
+    Прогоняет события по порядку event_id через apply(conn, batch) в одной транзакции.
+    prepare(conn) вызывается в той же транзакции до первой пачки – например, чтобы очистить производную таблицу.
+    """
+    kinds = list(kinds) if kinds is not None else list(EVENT_FIELDS)
+    total = 0
+    pool = await db.get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if prepare is not None:
+                await prepare(conn)
+            batch: List[Event] = []
+            async for row in conn.cursor('''
+                SELECT created_at, kind, user_id, macaco_id, payload
+                FROM game_events
+                WHERE event_id > $1 AND kind = ANY($2::text[])
+                ORDER BY event_id
+            ''', since_id, kinds, prefetch=REPLAY_BATCH):
+                batch.append(Event(row['created_at'], row['kind'], row['user_id'], row['macaco_id'],
+                                   json.loads(row['payload'])))
+                if len(batch) >= REPLAY_BATCH:
+                    await apply(conn, batch)
+                    total += len(batch)
+                    batch = []
+            if batch:
+                await apply(conn, batch)
+                total += len(batch)
+    return total
@@ -0,0 +1,135 @@
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import asyncpg
+
+# Выгрузка таблиц для аналитики и бэкапов: COPY ... TO STDOUT идёт в gzip-файл кусками,
+# в памяти не больше одного куска при любом размере таблицы.
+#   python export.py                          – users, macacos и fights целиком, CSV
+#   python export.py fights --format jsonl    – только бои, по JSON-объекту на строку
+#   python export.py --incremental            – только строки новее отметки прошлой выгрузки
+# Отметки (watermarks.json в каталоге выгрузки) – максимум столбца-отметки на момент выгрузки.
+# Строка, вставленная транзакцией, которая началась до выгрузки, а закончилась после, может получить
+# отметку меньше сохранённой и в следующую инкрементальную выгрузку не попадёт – раз в сутки стоит делать полную.
+
+
+class ExportTable(NamedTuple):
+    name: str
+    watermark: str  # монотонно растущий столбец
+    columns: str
+
+
+TABLES: Dict[str, ExportTable] = {t.name: t for t in (
+    # user_id – id из Telegram, новые пользователи не обязательно больше старых
+    ExportTable('users', 'created_at', 'user_id, username, first_name, last_name, created_at, active_macaco_id'),
+    ExportTable('macacos', 'macaco_id', 'macaco_id, user_id, name, health, hunger, happiness, level, experience, weight, '
+                                        'last_fed, last_daily'),
+    ExportTable('fights', 'fight_id', 'fight_id, fighter1_id, fighter2_id, winner_id, bet_weight, fight_time'),
+)}
+FORMATS = ('csv', 'jsonl')
+WATERMARKS_FILE = 'watermarks.json'
+# JSONL отдаёт сам Postgres (row_to_json): CSV-режим COPY с символами-разделителями, которых в JSON
+# быть не может (управляющие символы JSON экранирует), выводит строку как есть, без экранирования
+_RAW_LINES = {'quote': '\x01', 'delimiter': '\x02'}
+
+
+def load_watermarks(out_dir: str) -> Dict[str, Any]:
+    try:
+        with open(os.path.join(out_dir, WATERMARKS_FILE), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_watermarks(out_dir: str, watermarks: Dict[str, Any]):
+    path = os.path.join(out_dir, WATERMARKS_FILE)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(watermarks, f, ensure_ascii=False, indent=2, default=str)
+    os.replace(path + '.tmp', path)  # отметка меняется только после того, как файлы выгрузки записаны
+
+
+def _parse_watermark(table: ExportTable, value: Any) -> Any:
+    if value is None or table.watermark.endswith('_id'):
+        return value
+    return datetime.fromisoformat(value)
+
+
+async def export_table(conn: asyncpg.Connection, table: ExportTable, fmt: str, out_dir: str,
+                       since: Any = None) -> Optional[Dict[str, Any]]:
+    """
+    Выгружает строки table с отметкой > since (None – все) в gzip-файл. Вызывать в транзакции REPEATABLE READ:
+    верхняя граница и сами строки берутся из одного снимка. Возвращает новую отметку и число строк или None, если новых нет.
+    """
+    upper = await conn.fetchval(f'SELECT MAX({table.watermark}) FROM {table.name}')
+    if upper is None or (since is not None and upper <= since):
+        return None
+    args = [upper]
+    where = f'{table.watermark} <= $1'
+    if since is not None:
+        args.append(since)
+        where += f' AND {table.watermark} > $2'
+    query = f'SELECT {table.columns} FROM {table.name} WHERE {where} ORDER BY {table.watermark}'
+    if fmt == 'jsonl':
+        query = f'SELECT row_to_json(t) FROM ({query}) t'
+        options = dict(format='csv', **_RAW_LINES)
+    else:
+        options = dict(format='csv', header=True)
+
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(out_dir, f"{table.name}-{stamp}{'-since' if since is not None else ''}.{fmt}.gz")
+    with open(path + '.tmp', 'wb') as raw, gzip.GzipFile(path, 'wb', fileobj=raw) as f:
+        async def write(chunk: bytes):
+            f.write(chunk)
+        status = await conn.copy_from_query(query, *args, output=write, **options)
+    os.replace(path + '.tmp', path)
+    return {'path': path, 'rows': int(status.split()[-1]), 'watermark': upper}
+
+
+async def export(dsn: str, tables: List[str], fmt: str, out_dir: str, incremental: bool):
+    os.makedirs(out_dir, exist_ok=True)
+    watermarks = load_watermarks(out_dir) if incremental else {}
+    conn = await asyncpg.connect(dsn)
+    try:
+        async with conn.transaction(isolation='repeatable_read', readonly=True):
+            results = {}
+            for name in tables:
+                table = TABLES[name]
+                started = time.perf_counter()
+                result = await export_table(conn, table, fmt, out_dir, _parse_watermark(table, watermarks.get(name)))
+                if result is None:
+                    print(f"⏭ {name}: новых строк нет")
+                    continue
+                results[name] = result
+                print(f"✅ {name}: {result['rows']} строк → {result['path']} ({time.perf_counter() - started:.1f} с)")
+    finally:
+        await conn.close()
+    if results:
+        saved = load_watermarks(out_dir)
+        saved.update({name: result['watermark'] for name, result in results.items()})
+        save_watermarks(out_dir, saved)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Потоковая выгрузка users, macacos и fights в gzip CSV/JSONL через COPY")
+    parser.add_argument('tables', nargs='*', help=f"таблицы: {', '.join(TABLES)} (по умолчанию все)")
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--out', default='exports', help="каталог для файлов и watermarks.json (по умолчанию exports)")
+    parser.add_argument('--incremental', action='store_true', help="только строки новее отметки прошлой выгрузки")
+    parser.add_argument('--dsn', default=os.getenv('DATABASE_URL'), help="по умолчанию DATABASE_URL; лучше – реплика")
+    args = parser.parse_args()
+    unknown = [name for name in args.tables if name not in TABLES]
+    if unknown:
+        parser.error(f"неизвестные таблицы: {', '.join(unknown)}")
+    if not args.dsn:
+        parser.error("нужен DATABASE_URL или --dsn")
+    asyncio.run(export(args.dsn, args.tables or list(TABLES), args.format, args.out, args.incremental))
+
+
+if __name__ == "__main__":
+    main()
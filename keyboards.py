@@ -1,39 +1,42 @@
+from typing import Dict, Sequence, Tuple
+
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
+import callbacks as cb
+from config import Food
+
 def main_menu_kb(user_id: int) -> InlineKeyboardMarkup:
     keyboard = [
-        [InlineKeyboardButton(text="🐒 Моя макака", callback_data=f"my_macaco:{user_id}")],
+        [InlineKeyboardButton(text="🐒 Моя макака", callback_data=cb.encode("my_macaco", user_id))],
         [
-            InlineKeyboardButton(text="🍌 Покормить", callback_data=f"select_food:{user_id}"),
-            InlineKeyboardButton(text="🎁 Ежедневная награда", callback_data=f"daily_reward:{user_id}")
+            InlineKeyboardButton(text="🍌 Покормить", callback_data=cb.encode("select_food", user_id)),
+            InlineKeyboardButton(text="🎁 Ежедневная награда", callback_data=cb.encode("daily_reward", user_id))
         ],
         [
-            InlineKeyboardButton(text="⚔️ Вызвать на бой", callback_data=f"challenge_fight:{user_id}"),
-            InlineKeyboardButton(text="🚶 Выгулять", callback_data=f"walk_macaco:{user_id}")
+            InlineKeyboardButton(text="⚔️ Вызвать на бой", callback_data=cb.encode("challenge_fight", user_id)),
+            InlineKeyboardButton(text="🚶 Выгулять", callback_data=cb.encode("walk_macaco", user_id))
         ],
-        [InlineKeyboardButton(text="🏆 Топ по весу", callback_data=f"top_weight:{user_id}")],
-        [InlineKeyboardButton(text="ℹ️ Помощь", callback_data=f"help_info:{user_id}")]
+        [
+            InlineKeyboardButton(text="🏟 Арена", callback_data=cb.encode("arena", user_id)),
+            InlineKeyboardButton(text="🏆 Топ по весу", callback_data=cb.encode("top_weight", user_id))
+        ],
+        [InlineKeyboardButton(text="ℹ️ Помощь", callback_data=cb.encode("help_info", user_id))]
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
-def food_selection_kb(user_id: int) -> InlineKeyboardMarkup:
-    keyboard = [
-        [
-            InlineKeyboardButton(text="🍌 Банан (+1 кг)", callback_data=f"food_1:{user_id}"),
-            InlineKeyboardButton(text="🥩 Мясо (+3 кг)", callback_data=f"food_2:{user_id}")
-        ],
-        [
-            InlineKeyboardButton(text="🍰 Торт (+5 кг)", callback_data=f"food_3:{user_id}"),
-            InlineKeyboardButton(text="🥗 Салат (+2 кг)", callback_data=f"food_4:{user_id}")
-        ],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"main_menu:{user_id}")]
+def food_selection_kb(user_id: int, foods: Sequence[Food]) -> InlineKeyboardMarkup:
+    buttons = [
+        InlineKeyboardButton(text=f"{food.name} (+{food.weight_gain} кг)", callback_data=cb.encode("food", user_id, food.food_id))
+        for food in foods
     ]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    keyboard.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=cb.encode("main_menu", user_id))])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 def food_info_kb(food_id: int, user_id: int) -> InlineKeyboardMarkup:
     keyboard = [
-        [InlineKeyboardButton(text="✅ Покормить этой едой", callback_data=f"feed_{food_id}:{user_id}")],
-        [InlineKeyboardButton(text="⬅️ Выбрать другую еду", callback_data=f"select_food:{user_id}")]
+        [InlineKeyboardButton(text="✅ Покормить этой едой", callback_data=cb.encode("feed", user_id, food_id))],
+        [InlineKeyboardButton(text="⬅️ Выбрать другую еду", callback_data=cb.encode("select_food", user_id))]
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
@@ -41,36 +44,63 @@ def bet_selection_challenge_kb(user_id: int, opponent_id: int) -> InlineKeyboard
     # Здесь opponent_id не нужно проверять на владельца, но для единообразия добавим user_id владельца вызова
     keyboard = [
         [
-            InlineKeyboardButton(text="1 кг", callback_data=f"challenge_bet_1:{user_id}:{opponent_id}"),
-            InlineKeyboardButton(text="3 кг", callback_data=f"challenge_bet_3:{user_id}:{opponent_id}")
+            InlineKeyboardButton(text="1 кг", callback_data=cb.encode("challenge_bet", user_id, 1, opponent_id)),
+            InlineKeyboardButton(text="3 кг", callback_data=cb.encode("challenge_bet", user_id, 3, opponent_id))
         ],
         [
-            InlineKeyboardButton(text="5 кг", callback_data=f"challenge_bet_5:{user_id}:{opponent_id}"),
-            InlineKeyboardButton(text="10 кг", callback_data=f"challenge_bet_10:{user_id}:{opponent_id}")
+            InlineKeyboardButton(text="5 кг", callback_data=cb.encode("challenge_bet", user_id, 5, opponent_id)),
+            InlineKeyboardButton(text="10 кг", callback_data=cb.encode("challenge_bet", user_id, 10, opponent_id))
         ],
-        [InlineKeyboardButton(text="❌ Отмена", callback_data=f"cancel_fight:{user_id}")]
+        [InlineKeyboardButton(text="❌ Отмена", callback_data=cb.encode("cancel_fight", user_id))]
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
-def challenge_response_kb(challenge_id: str, bet: int) -> InlineKeyboardMarkup:
+def challenge_response_kb(challenge_id: Tuple[int, int, int]) -> InlineKeyboardMarkup:
     # Кнопки для ответа на вызов – отправляются в личку, владелец один, проверка не нужна
     keyboard = [
         [
-            InlineKeyboardButton(text="🥊 Принять бой", callback_data=f"accept_fight_{challenge_id}"),
-            InlineKeyboardButton(text="❌ Отклонить", callback_data=f"decline_fight_{challenge_id}")
+            InlineKeyboardButton(text="🥊 Принять бой", callback_data=cb.encode("accept_fight", *challenge_id)),
+            InlineKeyboardButton(text="❌ Отклонить", callback_data=cb.encode("decline_fight", *challenge_id))
         ]
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
+def challenge_link_kb(bot_username: str, macaco_id: int) -> InlineKeyboardMarkup:
+    # Карточка из inline-режима: нажавший заранее неизвестен, поэтому вызов идёт через /start в личке
+    keyboard = [
+        [InlineKeyboardButton(text="⚔️ Вызвать на бой", url=f"https://t.me/{bot_username}?start=fight_{macaco_id}")]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def arena_kb(user_id: int, in_queue: bool) -> InlineKeyboardMarkup:
+    bets = [
+        InlineKeyboardButton(text=f"{bet} кг", callback_data=cb.encode("arena_bet", user_id, bet))
+        for bet in (1, 3, 5, 10)
+    ]
+    keyboard = [bets[:2], bets[2:]]
+    if in_queue:
+        keyboard.append([InlineKeyboardButton(text="🚪 Покинуть арену", callback_data=cb.encode("arena_leave", user_id))])
+    keyboard.append([InlineKeyboardButton(text="⬅️ В меню", callback_data=cb.encode("main_menu", user_id))])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
 def after_fight_kb(user_id: int) -> InlineKeyboardMarkup:
     keyboard = [
-        [InlineKeyboardButton(text="⚔️ Новый бой", callback_data=f"challenge_fight:{user_id}")],
-        [InlineKeyboardButton(text="⬅️ В меню", callback_data=f"main_menu:{user_id}")]
+        [InlineKeyboardButton(text="⚔️ Новый бой", callback_data=cb.encode("challenge_fight", user_id))],
+        [InlineKeyboardButton(text="⬅️ В меню", callback_data=cb.encode("main_menu", user_id))]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def switch_macaco_kb(user_id: int, macacos: Sequence[Dict]) -> InlineKeyboardMarkup:
+    keyboard = [
+        [InlineKeyboardButton(text=f"{'✅ ' if m['active'] else ''}{m['name']} | 🏋️ {m['weight']} кг | ⭐ {m['level']}",
+                              callback_data=cb.encode("switch_macaco", user_id, m['macaco_id']))]
+        for m in macacos
     ]
+    keyboard.append([InlineKeyboardButton(text="⬅️ В меню", callback_data=cb.encode("main_menu", user_id))])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 def back_to_menu_kb(user_id: int) -> InlineKeyboardMarkup:
     keyboard = [
-        [InlineKeyboardButton(text="⬅️ В меню", callback_data=f"main_menu:{user_id}")]
+        [InlineKeyboardButton(text="⬅️ В меню", callback_data=cb.encode("main_menu", user_id))]
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
@@ -0,0 +1,315 @@
+import argparse
+import asyncio
+import gzip
+import itertools
+import json
+import logging
+import os
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+import asyncpg
+from aiogram import methods
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Animation, Chat, Message, User
+from aiohttp import web
+
+import callbacks as cb
+
+logger = logging.getLogger(__name__)
+
+# Воспроизведение реального трафика, записанного recorder.py (RECORD_UPDATES в окружении бота).
+# Воспроизведение: python loadtest.py updates.jsonl.gz [--speed 10 | --max] – апдейты идут через тот же
+# Dispatcher, Bot API подменён заглушкой, база – из DATABASE_URL (локальная!).
+# Заглушка Bot API по HTTP: python loadtest.py --fake-api 8081, у бота BOT_API_URL=http://127.0.0.1:8081 –
+# бот работает целиком, с настоящей сессией и пулом соединений, но без Telegram.
+
+
+# ---------- Счётчик запросов к базе ----------
+class QueryStats:
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# Счётчик апдейта, в контексте которого выполняется запрос; задачи, созданные обработчиком, наследуют его
+query_stats: ContextVar[Optional[QueryStats]] = ContextVar('query_stats', default=None)
+
+
+def _counted(name: str):
+    method = getattr(asyncpg.Connection, name)
+
+    async def wrapper(self, *args, **kwargs):
+        stats = query_stats.get()
+        if stats is None:
+            return await method(self, *args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            stats.count += 1
+            stats.seconds += time.perf_counter() - started
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+class CountingConnection(asyncpg.Connection):
+    """Соединение пула, которое считает запросы и время в базе для текущего апдейта (см. query_stats)."""
+
+    execute = _counted('execute')
+    executemany = _counted('executemany')
+    fetch = _counted('fetch')
+    fetchrow = _counted('fetchrow')
+    fetchval = _counted('fetchval')
+    copy_records_to_table = _counted('copy_records_to_table')
+
+
+# ---------- Заглушка Bot API ----------
+class UnsupportedMethod(Exception):
+    """Заглушка не знает, что ответить на этот метод Bot API."""
+
+
+class FakeSession(BaseSession):
+    """Отвечает на методы Bot API правдоподобными объектами без сети; latency – искусственная задержка ответа."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout: Optional[int] = None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        try:
+            result = self.result_for(method, bot.id)
+        except UnsupportedMethod as e:
+            # Для бота – как отказ настоящего Bot API, его обработчики это уже умеют
+            raise TelegramBadRequest(method=method, message=f"Bad Request: {e}") from None
+        return result.as_(bot) if isinstance(result, Message) else result
+
+    def result_for(self, method, bot_id: int) -> Any:
+        returning = method.__returning__
+        types = getattr(returning, '__args__', (returning,))
+        if getattr(returning, '__origin__', None) is list:
+            return []  # getUpdates и подобные: новых данных нет
+        if Message in types and not getattr(method, 'inline_message_id', None):
+            return self._message(method)
+        if User in types:
+            return User(id=bot_id, is_bot=True, first_name='Macaco', username='macaco_loadtest_bot')
+        if bool in types:
+            return True
+        raise UnsupportedMethod(f"FakeSession не умеет отвечать на {type(method).__name__}")
+
+    def _message(self, method) -> Message:
+        chat_id = getattr(method, 'chat_id', None) or 0
+        chat_id = chat_id if isinstance(chat_id, int) else 0
+        animation = None
+        if type(method).__name__ == 'SendAnimation':
+            animation = Animation(file_id='loadtest', file_unique_id='loadtest', width=1, height=1, duration=1)
+        return Message(
+            message_id=getattr(method, 'message_id', None) or next(self._message_ids),
+            date=datetime.now(),
+            chat=Chat(id=chat_id, type='private' if chat_id > 0 else 'supergroup'),
+            text=getattr(method, 'text', None),
+            caption=getattr(method, 'caption', None),
+            animation=animation,
+        )
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        return
+        yield
+
+
+# ---------- Заглушка Bot API по HTTP ----------
+_INT_FIELDS = ('chat_id', 'message_id', 'timeout')
+
+
+def fake_api_app(latency: float = 0.0) -> web.Application:
+    """Отвечает на POST /bot<token>/<method> так же, как FakeSession; getUpdates держит длинный опрос и отдаёт []."""
+    fake = FakeSession(latency)
+
+    async def handle(request: web.Request) -> web.Response:
+        name = request.match_info['method']
+        method_class = getattr(methods, name[:1].upper() + name[1:], None)
+        if method_class is None:
+            return web.json_response({'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'})
+        fields = {}
+        for key, value in (await request.post()).items():
+            if isinstance(value, str):
+                fields[key] = int(value) if key in _INT_FIELDS and value.lstrip('-').isdigit() else value
+        fake.calls[method_class.__name__] += 1
+        if latency:
+            await asyncio.sleep(latency)
+        # Без валидации: заглушке нужны только chat_id, message_id, text и тип ответа
+        method = method_class.model_construct(**fields)
+        try:
+            result = fake.result_for(method, int(request.match_info['token'].split(':')[0]))
+        except UnsupportedMethod as e:
+            return web.json_response({'ok': False, 'error_code': 400, 'description': f"Bad Request: {e}"})
+        if name == 'getUpdates':
+            await asyncio.sleep(fields.get('timeout') or 0)
+        if hasattr(result, 'model_dump'):
+            result = result.model_dump(mode='json', exclude_none=True)
+        return web.json_response({'ok': True, 'result': result})
+
+    app = web.Application(client_max_size=50 * 1024 * 1024)
+    app.router.add_post('/bot{token}/{method}', handle)
+    app['fake'] = fake
+    return app
+
+
+# ---------- Воспроизведение ----------
+def load_records(paths: List[str]) -> List[Tuple[float, Dict]]:
+    records = []
+    for path in paths:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            try:
+                for line in f:
+                    r = json.loads(line)
+                    records.append((r['t'], r['u']))
+            except (EOFError, json.JSONDecodeError):
+                # Бот упал или ещё пишет: последний gzip-член не закрыт, читаем до последнего сброса
+                print(f"⚠️ {path}: файл оборван, прочитано до последнего сброса")
+    # Логи нескольких воркеров сливаются по времени прихода
+    records.sort(key=lambda r: r[0])
+    return records
+
+
+def action_of(update: Dict) -> str:
+    if 'callback_query' in update:
+        decoded = cb.decode(update['callback_query'].get('data'))
+        return decoded.action.name if decoded else 'callback?'
+    if 'message' in update:
+        text = update['message'].get('text') or ''
+        return text.split(maxsplit=1)[0].split('@')[0] if text.startswith('/') else 'message'
+    if 'inline_query' in update:
+        return 'inline'
+    return next((name for name in update if name != 'update_id'), 'unknown')
+
+
+def user_of(update: Dict) -> Optional[int]:
+    for event in update.values():
+        if isinstance(event, dict):
+            user = event.get('from') or event.get('user')
+            if user and not user.get('is_bot'):
+                return user['id']
+    return None
+
+
+async def seed_users(db, user_ids: List[int]):
+    # Игроки из лога давно зарегистрированы и назвали макак – иначе всё ушло бы в /start и /rename
+    for user_id in user_ids:
+        await db.get_or_create_user({'id': user_id, 'username': f"u{user_id}"})
+        macaco = await db.get_or_create_macaco(user_id)
+        if macaco['name'] == 'Макака':
+            await db.rename_active_macaco(user_id, f"Макака{user_id % 100000}")
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+async def replay(paths: List[str], speed: Optional[float], concurrency: int, api_latency: float, seed: bool):
+    os.environ.setdefault('BOT_TOKEN', '123456:loadtest')
+    import database as db
+    db.POOL_CONNECTION_CLASS = CountingConnection
+    import bot as app  # импорт после подмены: пул создаётся уже со считающими соединениями
+
+    session = FakeSession(api_latency)
+    session.middleware(app.edit_dedup)
+    app.bot.session = session
+
+    records = load_records(paths)
+    if not records:
+        print("❌ Лог пуст")
+        return
+    await db.init_db()
+    if seed:
+        users = sorted({u for u in map(user_of, (update for _, update in records)) if u is not None})
+        await seed_users(db, users)
+        print(f"👥 Подготовлено игроков: {len(users)}")
+    await app.dp.emit_startup(bot=app.bot)
+
+    samples: Dict[str, List[Tuple[float, int, float]]] = defaultdict(list)
+    errors: Counter = Counter()
+    slots = asyncio.Semaphore(concurrency)
+
+    async def run_one(update: Dict):
+        action = action_of(update)
+        async with slots:
+            stats = QueryStats()
+            query_stats.set(stats)
+            started = time.perf_counter()
+            try:
+                await app.dp.feed_raw_update(app.bot, update)
+            except Exception as e:
+                errors[f"{action}: {type(e).__name__}"] += 1
+            samples[action].append((time.perf_counter() - started, stats.count, stats.seconds))
+
+    print(f"▶️ {len(records)} апдейтов, скорость: {'максимальная' if speed is None else f'x{speed:g}'}")
+    first_t = records[0][0]
+    started = time.perf_counter()
+    tasks = []
+    for t, update in records:
+        if speed is not None:
+            delay = (t - first_t) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(run_one(update)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    await app.dp.emit_shutdown(bot=app.bot)
+
+    total = sum(len(s) for s in samples.values())
+    print(f"\n⏱ {total} апдейтов за {elapsed:.1f} с – {total / elapsed:.1f} апд/с")
+    print(f"{'действие':<18}{'кол-во':>8}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}{'max мс':>9}{'запр/апд':>10}{'БД мс/апд':>11}")
+    for action, rows in sorted(samples.items(), key=lambda item: -len(item[1])):
+        latencies = sorted(r[0] * 1000 for r in rows)
+        queries = sum(r[1] for r in rows) / len(rows)
+        db_ms = sum(r[2] for r in rows) * 1000 / len(rows)
+        print(f"{action:<18}{len(rows):>8}{percentile(latencies, 0.5):>9.1f}{percentile(latencies, 0.95):>9.1f}"
+              f"{percentile(latencies, 0.99):>9.1f}{latencies[-1]:>9.1f}{queries:>10.1f}{db_ms:>11.1f}")
+    print(f"\n📡 Вызовы Bot API: {dict(session.calls.most_common())}")
+    if errors:
+        print(f"❌ Ошибки: {dict(errors.most_common())}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных апдейтов (RECORD_UPDATES) на локальной базе")
+    parser.add_argument('logs', nargs='*', help="файлы gzip-JSONL, записанные ботом")
+    parser.add_argument('--fake-api', type=int, metavar='PORT',
+                        help="вместо воспроизведения – заглушка Bot API по HTTP на этом порту (для BOT_API_URL)")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--speed', type=float, default=1.0, help="во сколько раз быстрее реального времени (по умолчанию 1)")
+    mode.add_argument('--max', action='store_true', help="без пауз, настолько быстро, насколько успевает бот")
+    parser.add_argument('--concurrency', type=int, default=1000, help="апдейтов в обработке одновременно")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="искусственная задержка Bot API, мс")
+    parser.add_argument('--no-seed', action='store_true', help="не создавать игроков из лога заранее")
+    args = parser.parse_args()
+    if args.fake_api:
+        print(f"🧪 Заглушка Bot API: BOT_API_URL=http://127.0.0.1:{args.fake_api}")
+        web.run_app(fake_api_app(args.api_latency / 1000), host='127.0.0.1', port=args.fake_api, print=None)
+        return
+    if not args.logs:
+        parser.error("нужны файлы с записанными апдейтами")
+    if not os.getenv('DATABASE_URL'):
+        parser.error("нужен DATABASE_URL локальной базы – воспроизведение пишет в неё")
+    asyncio.run(replay(args.logs, None if args.max else args.speed, args.concurrency,
+                       args.api_latency / 1000, not args.no_seed))
+
+
+if __name__ == "__main__":
+    main()
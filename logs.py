@@ -0,0 +1,168 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import time
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Optional, Tuple
+
+# Логи не пишутся из event loop: обработчик только кладёт запись в очередь, а форматирует и пишет
+# в stderr отдельный поток. Поэтому в вызовах logger – %-шаблоны, а не f-строки: аргументы
+# подставляются уже в потоке записи, а одинаковые ошибки узнаются по шаблону.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # text | json
+LOG_QUEUE_SIZE = 10000  # если поток записи не успевает – записи отбрасываются, а не копятся в памяти
+REPEAT_WINDOW = 10.0  # одинаковых предупреждений и ошибок за окно пропускается не больше REPEAT_BURST
+REPEAT_BURST = 5
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Контекст апдейта выставляет LogContextMiddleware; фоновые задачи пишут без него
+update_id_var: ContextVar[Optional[int]] = ContextVar('log_update_id', default=None)
+user_id_var: ContextVar[Optional[int]] = ContextVar('log_user_id', default=None)
+
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional['_NonBlockingQueueHandler'] = None
+_repeat_filter: Optional['RepeatFilter'] = None
+
+
+# ---------- Фильтры (в потоке вызова) ----------
+class ContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.update_id = update_id_var.get()
+        record.user_id = user_id_var.get()
+        return True
+
+
+class RepeatFilter(logging.Filter):
+    """Из одинаковых (логгер, уровень, шаблон) записей за REPEAT_WINDOW пропускает первые REPEAT_BURST."""
+
+    def __init__(self, window: float = REPEAT_WINDOW, burst: int = REPEAT_BURST, level: int = logging.WARNING):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.level = level
+        self.suppressed = 0
+        # ключ -> [начало окна, пропущено в окне, подавлено в окне]
+        self._windows: Dict[Tuple[str, int, str], List] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < self.level:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.window:
+            # Первая запись нового окна сообщает, сколько было подавлено в прошлом
+            record.repeats = window[2] if window is not None else 0
+            self._windows[key] = [now, 1, 0]
+            return True
+        if window[1] < self.burst:
+            window[1] += 1
+            return True
+        window[2] += 1
+        self.suppressed += 1
+        return False
+
+    def pending(self) -> Dict[Tuple[str, int, str], int]:
+        return {key: window[2] for key, window in self._windows.items() if window[2]}
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Стандартный prepare форматирует сообщение в потоке вызова – это и есть работа, которую уносим из loop
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# ---------- Форматирование (в потоке записи) ----------
+def _suffix(record: logging.LogRecord) -> str:
+    parts = []
+    if getattr(record, 'update_id', None) is not None:
+        parts.append(f"update={record.update_id}")
+    if getattr(record, 'user_id', None) is not None:
+        parts.append(f"user={record.user_id}")
+    suffix = f" [{' '.join(parts)}]" if parts else ""
+    repeats = getattr(record, 'repeats', 0)
+    if repeats:
+        suffix += f" (ещё {repeats} таких же подавлено)"
+    return suffix
+
+
+class ContextFormatter(logging.Formatter):
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        return super().formatMessage(record) + _suffix(record)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in ('update_id', 'user_id', 'repeats'):
+            value = getattr(record, field, None)
+            if value:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# ---------- Запуск и остановка ----------
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT):
+    """Ставит на корневой логгер очередь с фоновой записью; повторный вызов ничего не делает."""
+    global _listener, _queue_handler, _repeat_filter
+    if _listener is not None:
+        return
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter() if fmt == 'json' else ContextFormatter(TEXT_FORMAT))
+
+    _repeat_filter = RepeatFilter()
+    _queue_handler = _NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _queue_handler.addFilter(_repeat_filter)
+    _queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers = [_queue_handler]
+    root.setLevel(level)
+    _listener = QueueListener(_queue_handler.queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописывает очередь и останавливает поток записи (вызывать при выходе процесса)."""
+    global _listener
+    if _listener is None:
+        return
+    # Итоги – мимо фильтра повторов, иначе их самих могло бы подавить
+    logger = logging.getLogger(__name__)
+    summary = [("%s: ещё %s повторов «%s» подавлено", (name, count, msg))
+               for (name, _, msg), count in _repeat_filter.pending().items()]
+    if _queue_handler.dropped:
+        summary.append(("Очередь логов переполнялась, потеряно записей: %s", (_queue_handler.dropped,)))
+    for msg, args in summary:
+        _queue_handler.enqueue(logger.makeRecord(logger.name, logging.WARNING, __file__, 0, msg, args, None))
+    listener, _listener = _listener, None
+    listener.stop()
+
+
+def stats() -> Dict[str, int]:
+    if _queue_handler is None:
+        return {}
+    return {'queued': _queue_handler.queue.qsize(), 'dropped': _queue_handler.dropped,
+            'suppressed': _repeat_filter.suppressed}
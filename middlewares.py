@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import (
+    DeleteMessage, EditMessageCaption, EditMessageMedia, EditMessageReplyMarkup, EditMessageText, SendMessage,
+)
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
+
+import logs
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]
+
+
+def _is_inline_query(event: TelegramObject) -> bool:
+    # Inline-запросы приходят на каждое нажатие клавиши, ничего не меняют и вытесняют друг друга:
+    # ни очередь, ни троттлинг им не нужны – их схлопывает debounce в обработчике
+    return isinstance(event, Update) and event.inline_query is not None
+
+
+# ---------- Контекст логов ----------
+class LogContextMiddleware(BaseMiddleware):
+    """Все записи логов за время обработки апдейта помечаются его update_id и пользователем."""
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get('event_from_user')
+        update_token = logs.update_id_var.set(event.update_id if isinstance(event, Update) else None)
+        user_token = logs.user_id_var.set(user.id if user is not None else None)
+        try:
+            return await handler(event, data)
+        finally:
+            logs.user_id_var.reset(user_token)
+            logs.update_id_var.reset(update_token)
+
+
+# ---------- Порядок апдейтов одного пользователя ----------
+class _UserSlot:
+    __slots__ = ('lock', 'depth')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0
+
+
+class UserOrderMiddleware(BaseMiddleware):
+    """Апдейты одного пользователя выполняются строго по очереди, разных – параллельно."""
+
+    def __init__(self, max_pending_per_user: int = 20, max_users: int = 50000):
+        self.max_pending_per_user = max_pending_per_user
+        self.max_users = max_users
+        self._slots: Dict[int, _UserSlot] = {}
+        self.dropped = 0
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get('event_from_user')
+        if user is None or _is_inline_query(event):
+            return await handler(event, data)
+
+        slot = self._slots.get(user.id)
+        if slot is None:
+            if len(self._slots) >= self.max_users:
+                self.dropped += 1
+                logger.warning("Очередь пользователей переполнена, апдейт от %s отброшен", user.id)
+                return None
+            slot = self._slots[user.id] = _UserSlot()
+        if slot.depth >= self.max_pending_per_user:
+            self.dropped += 1
+            logger.warning("У пользователя %s слишком много апдейтов в очереди, апдейт отброшен", user.id)
+            return None
+
+        slot.depth += 1
+        try:
+            # asyncio.Lock будит ожидающих в порядке FIFO – порядок прихода сохраняется
+            async with slot.lock:
+                return await handler(event, data)
+        finally:
+            slot.depth -= 1
+            if slot.depth == 0:
+                # Ключ без ожидающих апдейтов больше не нужен
+                del self._slots[user.id]
+
+    def depth(self, user_id: int) -> int:
+        slot = self._slots.get(user_id)
+        return slot.depth if slot else 0
+
+    def depths(self) -> Dict[int, int]:
+        return {user_id: slot.depth for user_id, slot in self._slots.items()}
+
+
+# ---------- Троттлинг и схлопывание повторных нажатий ----------
+class ThrottlingMiddleware(BaseMiddleware):
+    """Token bucket на пользователя + подавление одинаковых callback_data, пока предыдущий ещё обрабатывается."""
+
+    def __init__(self, rate: float = 2.0, burst: int = 6, duplicate_window: float = 1.0, max_entries: int = 50000):
+        self.rate = rate
+        self.burst = burst
+        self.duplicate_window = duplicate_window
+        self.max_entries = max_entries
+        self._buckets: Dict[int, List[float]] = {}  # user_id -> [токены, время последнего пополнения]
+        self._in_flight: Set[Tuple[int, str]] = set()
+        self._recent: Dict[Tuple[int, str], float] = {}
+        self.passed = 0
+        self.throttled = 0
+        self.coalesced = 0
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get('event_from_user')
+        if user is None or _is_inline_query(event):
+            return await handler(event, data)
+
+        callback = event.callback_query if isinstance(event, Update) else None
+        now = time.monotonic()
+        key = None
+        if callback is not None and callback.data:
+            key = (user.id, callback.data)
+            finished_at = self._recent.get(key)
+            if key in self._in_flight or (finished_at is not None and now - finished_at < self.duplicate_window):
+                self.coalesced += 1
+                await self._answer(callback)
+                return None
+
+        if not self._take_token(user.id, now):
+            self.throttled += 1
+            if callback is not None:
+                await self._answer(callback)
+            return None
+
+        self.passed += 1
+        if key is None:
+            return await handler(event, data)
+        self._in_flight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self._in_flight.discard(key)
+            self._recent[key] = time.monotonic()
+            if len(self._recent) > self.max_entries:
+                self._prune()
+
+    def _take_token(self, user_id: int, now: float) -> bool:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= self.max_entries:
+                self._prune()
+            bucket = self._buckets[user_id] = [float(self.burst), now]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def _prune(self):
+        now = time.monotonic()
+        self._recent = {k: t for k, t in self._recent.items() if now - t < self.duplicate_window}
+        # Полностью восстановившиеся корзины ничем не отличаются от новых
+        refill_time = self.burst / self.rate
+        self._buckets = {u: b for u, b in self._buckets.items() if now - b[1] < refill_time}
+
+    @staticmethod
+    async def _answer(callback: CallbackQuery):
+        try:
+            await callback.answer()
+        except TelegramAPIError:
+            pass
+
+    def stats(self) -> Dict[str, int]:
+        return {'passed': self.passed, 'throttled': self.throttled, 'coalesced': self.coalesced}
+
+
+# ---------- Ограничение нагрузки ----------
+class AdmissionMiddleware(BaseMiddleware):
+    """
+    Не больше max_in_flight апдейтов в обработке одновременно, считая ждущих в очереди пользователя.
+    Лишние апдейты, а также упёршиеся в busy_errors, отдаются обработчику перегрузки: он показывает
+    сохранённый экран и возвращает True (degraded) либо отвечает «занято» и возвращает False (shed).
+    После 429 от Bot API новые апдейты до конца retry_after отбрасываются молча.
+    """
+
+    def __init__(self, busy_errors: Tuple[type, ...] = (), max_in_flight: int = 200):
+        self.busy_errors = busy_errors
+        self.max_in_flight = max_in_flight
+        self._overload_handler: Optional[Callable[[TelegramObject], Awaitable[bool]]] = None
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.admitted = 0
+        self.shed = 0
+        self.degraded = 0
+
+    def overload_handler(self, func: Callable[[TelegramObject], Awaitable[bool]]):
+        self._overload_handler = func
+        return func
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        if self.in_flight >= self.max_in_flight or time.monotonic() < self.paused_until:
+            return await self._shed(event)
+
+        self.in_flight += 1
+        self.admitted += 1
+        try:
+            return await handler(event, data)
+        except TelegramRetryAfter as e:
+            self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+            logger.warning("Bot API просит подождать %s с – приём апдейтов приостановлен", e.retry_after)
+            self.shed += 1
+            return None
+        except self.busy_errors as e:
+            logger.warning("Перегрузка при обработке апдейта: %s", e)
+            return await self._shed(event)
+        finally:
+            self.in_flight -= 1
+
+    async def _shed(self, event: TelegramObject) -> None:
+        served = False
+        # Во время паузы любой вызов Bot API тоже получит 429 – не отвечаем вовсе
+        if self._overload_handler is not None and time.monotonic() >= self.paused_until:
+            try:
+                served = await self._overload_handler(event)
+            except TelegramAPIError as e:
+                logger.warning("Не удалось ответить на апдейт при перегрузке: %s", e)
+        if served:
+            self.degraded += 1
+        else:
+            self.shed += 1
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        return {'admitted': self.admitted, 'shed': self.shed, 'degraded': self.degraded, 'in_flight': self.in_flight}
+
+
+# ---------- Пропуск одинаковых правок сообщений ----------
+MessageKey = Union[Tuple[Union[int, str], int], str]  # (chat_id, message_id) или inline_message_id
+
+
+class EditDedupMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: помнит, что показано в сообщении, и не отправляет правку, которая ничего не меняет."""
+
+    # Эти методы меняют сообщение в обход edit_text – после них содержимое неизвестно
+    _INVALIDATING = (EditMessageCaption, EditMessageReplyMarkup, EditMessageMedia, DeleteMessage)
+
+    def __init__(self, max_entries: int = 50000):
+        self.max_entries = max_entries
+        self._rendered: 'OrderedDict[MessageKey, int]' = OrderedDict()
+        self.sent = 0
+        self.skipped = 0
+
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, EditMessageText):
+            key = self._key(method.chat_id, method.message_id, method.inline_message_id)
+            rendered = self._render_hash(method)
+            if key is not None and self._rendered.get(key) == rendered:
+                self._rendered.move_to_end(key)
+                self.skipped += 1
+                return True
+            try:
+                result = await make_request(bot, method)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    raise
+                # Содержимое уже такое – запоминаем, чтобы следующий повтор не дошёл до API
+                result = True
+            self.sent += 1
+            self._remember(key, rendered)
+            return result
+
+        result = await make_request(bot, method)
+        if isinstance(method, SendMessage) and isinstance(result, Message):
+            self._remember((result.chat.id, result.message_id), self._render_hash(method))
+        elif isinstance(method, self._INVALIDATING):
+            self._rendered.pop(self._key(method.chat_id, method.message_id, getattr(method, 'inline_message_id', None)), None)
+        return result
+
+    @staticmethod
+    def _key(chat_id, message_id: Optional[int], inline_message_id: Optional[str]) -> Optional[MessageKey]:
+        if inline_message_id:
+            return inline_message_id
+        if chat_id is None or message_id is None:
+            return None
+        return chat_id, message_id
+
+    @staticmethod
+    def _render_hash(method: Union[SendMessage, EditMessageText]) -> int:
+        markup = method.reply_markup.model_dump_json() if method.reply_markup is not None else None
+        return hash((method.text, repr(method.parse_mode), repr(method.entities), repr(method.link_preview_options), markup))
+
+    def _remember(self, key: Optional[MessageKey], rendered: int):
+        if key is None:
+            return
+        self._rendered[key] = rendered
+        self._rendered.move_to_end(key)
+        if len(self._rendered) > self.max_entries:
+            self._rendered.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {'sent': self.sent, 'skipped': self.skipped}
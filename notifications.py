@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import database as db
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_POLL_SECONDS = int(os.getenv('NOTIFY_POLL_SECONDS', '30'))
+NOTIFY_BATCH = 500
+NOTIFY_PER_SECOND = 25  # лимит Bot API на рассылку ~30 сообщений в секунду
+NOTIFY_MAX_AGE = timedelta(hours=6)  # про давно прошедшие события (бот был выключен) не пишем
+
+
+# ---------- Рассылка с ограничением скорости ----------
+async def send_batch(bot, messages: List[Tuple[int, str]]):
+    for start in range(0, len(messages), NOTIFY_PER_SECOND):
+        chunk = messages[start:start + NOTIFY_PER_SECOND]
+        results = await asyncio.gather(
+            *(bot.send_message(chat_id, text, parse_mode=None) for chat_id, text in chunk),
+            return_exceptions=True
+        )
+        failed = sum(isinstance(r, Exception) for r in results)
+        if failed:
+            logger.warning("Не доставлено уведомлений: %s", failed)
+        if start + NOTIFY_PER_SECOND < len(messages):
+            await asyncio.sleep(1)
+
+
+# ---------- События ----------
+def event_text(row: Dict, food_cooldown: Optional[int]) -> str:
+    event_at = row['event_at']
+    if row['last_daily'] and event_at == datetime.combine(row['last_daily'].date() + timedelta(days=1), datetime.min.time()):
+        return f"🎁 Ежедневная награда для {row['name']} снова доступна!"
+    if row['last_fed'] and food_cooldown is not None and event_at == row['last_fed'] + timedelta(hours=food_cooldown):
+        return f"🍌 {row['name']} проголодалась – можно снова покормить!"
+    return f"🆘 {row['name']} очень голодна и начинает терять здоровье! Покормите её."
+
+
+async def deliver_due(bot) -> int:
+    # Тот же минимальный КД, что берёт macaco_next_event из food_types; без еды там NULL – события «покормить» нет.
+    # Считается до захвата событий: ошибка здесь не должна терять уже отмеченные как отправленные
+    food_cooldown = min((food.cooldown_hours for food in await db.get_foods()), default=None)
+    now = datetime.now()
+    rows = await db.claim_due_events(now, NOTIFY_BATCH)
+    messages = [
+        (row['user_id'], event_text(row, food_cooldown) + "\n\n🔕 Отключить уведомления: /notify")
+        for row in rows
+        if row['notify_enabled'] and now - row['event_at'] <= NOTIFY_MAX_AGE
+    ]
+    await send_batch(bot, messages)
+    return len(rows)
+
+
+async def run_notifications(bot):
+    while True:
+        try:
+            claimed = await deliver_due(bot)
+        except Exception as e:
+            logger.error("Ошибка рассылки уведомлений: %s", e)
+            claimed = 0
+        # Полная пачка – скорее всего, есть ещё: забираем сразу
+        if claimed < NOTIFY_BATCH:
+            await asyncio.sleep(NOTIFY_POLL_SECONDS)
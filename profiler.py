@@ -0,0 +1,238 @@
+import asyncio
+import functools
+import heapq
+import inspect
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiogram.types import TelegramObject, Update
+
+import callbacks as cb
+
+logger = logging.getLogger(__name__)
+
+# Профилирование по запросу (/profile у админа или SIGUSR1). Пока выключено – ни потока, ни middleware,
+# ни обёрток: всё ставится в start() и снимается в stop().
+#   wall  – поток раз в SAMPLE_INTERVAL снимает стек потока event loop (видно и CPU, и простой в select)
+#   async – сам event loop раз в SAMPLE_INTERVAL обходит задачи и снимает цепочки await (видно, чего ждут апдейты)
+# Результат – collapsed stacks (flamegraph.pl, speedscope) и top-K самых медленных апдейтов с разбивкой по database.py.
+MODES = ('wall', 'async')
+SAMPLE_INTERVAL = 0.005
+TOP_K = 20
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+_NOT_TIMED = {'get_pool', 'get_read_pool'}  # вызываются отовсюду и ничего не стоят – только шум в разбивке
+
+# Разбивка текущего апдейта: функция database.py -> [вызовов, секунд]
+_breakdown: ContextVar[Optional[Dict[str, List]]] = ContextVar('profile_breakdown', default=None)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse_frame(frame) -> str:
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+def _collapse_task(task: asyncio.Task) -> Optional[str]:
+    labels = [f"task {task.get_name()}"]
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        labels.append(_frame_label(frame))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return ';'.join(labels) if len(labels) > 1 else None
+
+
+def update_label(update: Update) -> str:
+    if update.callback_query is not None:
+        decoded = cb.decode(update.callback_query.data)
+        return f"callback {decoded.action.name}" if decoded else "callback ?"
+    if update.message is not None:
+        text = update.message.text or ''
+        return text.split(maxsplit=1)[0].split('@')[0] if text.startswith('/') else "message"
+    if update.inline_query is not None:
+        return "inline"
+    return update.event_type
+
+
+class Profiler:
+    def __init__(self, dp, db_module, out_dir: str = PROFILE_DIR, top_k: int = TOP_K, interval: float = SAMPLE_INTERVAL):
+        self.dp = dp
+        self.db = db_module
+        self.out_dir = out_dir
+        self.top_k = top_k
+        self.interval = interval
+        self.mode: Optional[str] = None
+        self.finished: Optional[asyncio.Future] = None
+        self._stacks: Counter = Counter()
+        self._slowest: List[Tuple[float, int, str, Dict[str, List]]] = []
+        self._seq = itertools.count()
+        self._updates = 0
+        self._max_updates: Optional[int] = None
+        self._started_at = 0.0
+        self._originals: Dict[str, Any] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._thread_stop = threading.Event()
+        self._sample_handle: Optional[asyncio.TimerHandle] = None
+        self._deadline: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def active(self) -> bool:
+        return self.mode is not None
+
+    def start(self, mode: str = 'wall', seconds: Optional[float] = None, updates: Optional[int] = None) -> asyncio.Future:
+        """Запускает профилирование до истечения seconds или до updates апдейтов; future вернёт пути к файлам."""
+        if self.active:
+            raise RuntimeError("Профилирование уже идёт")
+        if mode not in MODES:
+            raise ValueError(f"Режим {mode!r}, ожидается один из {MODES}")
+        loop = asyncio.get_running_loop()
+        self.mode = mode
+        self.finished = loop.create_future()
+        self._stacks = Counter()
+        self._slowest = []
+        self._updates = 0
+        self._max_updates = updates
+        self._started_at = time.perf_counter()
+
+        self._wrap_database()
+        self.dp.update.outer_middleware.register(self._middleware)
+        if mode == 'wall':
+            self._thread_stop.clear()
+            self._thread = threading.Thread(target=self._sample_thread, args=(threading.get_ident(),),
+                                            name='profiler', daemon=True)
+            self._thread.start()
+        else:
+            self._sample_handle = loop.call_later(self.interval, self._sample_tasks)
+        if seconds is not None:
+            self._deadline = loop.call_later(seconds, lambda: asyncio.ensure_future(self.stop()))
+        logger.info("🔬 Профилирование (%s) запущено: %s с / %s апдейтов", mode, seconds or '∞', updates or '∞')
+        return self.finished
+
+    async def stop(self) -> List[str]:
+        if not self.active:
+            return []
+        mode, finished = self.mode, self.finished
+        self.mode = None
+        if self._deadline is not None:
+            self._deadline.cancel()
+            self._deadline = None
+        if self._thread is not None:
+            self._thread_stop.set()
+            self._thread.join()
+            self._thread = None
+        if self._sample_handle is not None:
+            self._sample_handle.cancel()
+            self._sample_handle = None
+        self.dp.update.outer_middleware.unregister(self._middleware)
+        self._unwrap_database()
+
+        paths = self._write(mode)
+        logger.info("🔬 Профилирование остановлено: %s", ', '.join(paths))
+        if not finished.done():
+            finished.set_result(paths)
+        return paths
+
+    # ---------- Сэмплирование ----------
+    def _sample_thread(self, loop_thread_id: int):
+        while not self._thread_stop.wait(self.interval):
+            frame = sys._current_frames().get(loop_thread_id)
+            if frame is not None:
+                self._stacks[_collapse_frame(frame)] += 1
+
+    def _sample_tasks(self):
+        for task in asyncio.all_tasks():
+            stack = _collapse_task(task)
+            if stack is not None:
+                self._stacks[stack] += 1
+        self._sample_handle = asyncio.get_running_loop().call_later(self.interval, self._sample_tasks)
+
+    # ---------- Апдейты и разбивка по database.py ----------
+    async def _middleware(self, handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        breakdown: Dict[str, List] = {}
+        token = _breakdown.set(breakdown)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            _breakdown.reset(token)
+            if self.active:
+                self._record(elapsed, update_label(event), breakdown)
+
+    def _record(self, elapsed: float, label: str, breakdown: Dict[str, List]):
+        item = (elapsed, next(self._seq), label, breakdown)
+        if len(self._slowest) < self.top_k:
+            heapq.heappush(self._slowest, item)
+        elif elapsed > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, item)
+        self._updates += 1
+        if self._max_updates is not None and self._updates >= self._max_updates:
+            asyncio.ensure_future(self.stop())
+
+    def _wrap_database(self):
+        # Обработчики и сам database.py вызывают функции через глобальные имена модуля – подмена видна везде
+        for name, func in vars(self.db).items():
+            if inspect.iscoroutinefunction(func) and func.__module__ == self.db.__name__ and name not in _NOT_TIMED:
+                self._originals[name] = func
+                setattr(self.db, name, self._timed(name, func))
+
+    def _unwrap_database(self):
+        for name, func in self._originals.items():
+            setattr(self.db, name, func)
+        self._originals = {}
+
+    @staticmethod
+    def _timed(name: str, func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            breakdown = _breakdown.get()
+            if breakdown is None:
+                return await func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                entry = breakdown.setdefault(name, [0, 0.0])
+                entry[0] += 1
+                entry[1] += time.perf_counter() - started
+        return wrapper
+
+    # ---------- Отчёт ----------
+    def _write(self, mode: str) -> List[str]:
+        os.makedirs(self.out_dir, exist_ok=True)
+        prefix = os.path.join(self.out_dir, f"profile-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}-{mode}")
+        collapsed = prefix + '.collapsed'
+        with open(collapsed, 'w', encoding='utf-8') as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        slowest = prefix + '-slowest.txt'
+        elapsed = time.perf_counter() - self._started_at
+        with open(slowest, 'w', encoding='utf-8') as f:
+            f.write(f"Режим {mode}, {elapsed:.1f} с, апдейтов: {self._updates}, сэмплов: {sum(self._stacks.values())}\n")
+            f.write("Самые медленные апдейты (время в database.py – включительно, вложенные вызовы считаются дважды):\n\n")
+            for duration, _, label, breakdown in sorted(self._slowest, reverse=True):
+                f.write(f"{duration * 1000:8.1f} мс  {label}\n")
+                for name, (calls, seconds) in sorted(breakdown.items(), key=lambda item: -item[1][1]):
+                    f.write(f"           {seconds * 1000:8.1f} мс  {calls:>3}×  db.{name}\n")
+                if not breakdown:
+                    f.write("           без обращений к database.py\n")
+                f.write("\n")
+        return [collapsed, slowest]
@@ -0,0 +1,79 @@
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Ключ сортировки совпадает с get_top_macacos: вес по убыванию, затем уровень; macaco_id – для однозначности
+RankKey = Tuple[int, int, int]
+
+
+def rank_key(macaco_id: int, weight: int, level: int) -> RankKey:
+    return -weight, -level, macaco_id
+
+
+class RankIndex:
+    """Отсортированный список макак (по одной – активной – на пользователя): место ищется бинарным поиском."""
+
+    def __init__(self):
+        self._keys: List[RankKey] = []
+        self._key_by_macaco: Dict[int, RankKey] = {}
+        self._macaco_by_user: Dict[int, int] = {}
+        self._user_by_macaco: Dict[int, int] = {}
+
+    def load(self, rows: Iterable[Tuple[int, int, int, int]]):
+        """Полная пересборка из (macaco_id, user_id, weight, level)."""
+        key_by_macaco, macaco_by_user = {}, {}
+        for macaco_id, user_id, weight, level in rows:
+            key_by_macaco[macaco_id] = rank_key(macaco_id, weight, level)
+            macaco_by_user[user_id] = macaco_id
+        self._keys = sorted(key_by_macaco.values())
+        self._key_by_macaco = key_by_macaco
+        self._macaco_by_user = macaco_by_user
+        self._user_by_macaco = {m: u for u, m in macaco_by_user.items()}
+
+    def update(self, macaco_id: int, user_id: int, weight: int, level: int):
+        current = self._macaco_by_user.get(user_id)
+        if current is not None and current != macaco_id:
+            return  # в рейтинге участвует только активная макака пользователя, сменить её – activate()
+        self.activate(macaco_id, user_id, weight, level)
+
+    def activate(self, macaco_id: int, user_id: int, weight: int, level: int):
+        current = self._macaco_by_user.get(user_id)
+        if current is not None and current != macaco_id:
+            self.remove(current)
+        self._discard_key(macaco_id)
+        key = rank_key(macaco_id, weight, level)
+        insort(self._keys, key)
+        self._key_by_macaco[macaco_id] = key
+        self._macaco_by_user[user_id] = macaco_id
+        self._user_by_macaco[macaco_id] = user_id
+
+    def remove(self, macaco_id: int):
+        self._discard_key(macaco_id)
+        user_id = self._user_by_macaco.pop(macaco_id, None)
+        if user_id is not None:
+            del self._macaco_by_user[user_id]
+
+    def _discard_key(self, macaco_id: int):
+        key = self._key_by_macaco.pop(macaco_id, None)
+        if key is not None:
+            del self._keys[bisect_left(self._keys, key)]
+
+    def macaco_of(self, user_id: int) -> Optional[int]:
+        return self._macaco_by_user.get(user_id)
+
+    def rank(self, macaco_id: int) -> Optional[int]:
+        """Место с единицы."""
+        key = self._key_by_macaco.get(macaco_id)
+        if key is None:
+            return None
+        return bisect_left(self._keys, key) + 1
+
+    def around(self, macaco_id: int, radius: int = 1) -> List[Tuple[int, int]]:
+        """[(место, macaco_id)] для макаки и её соседей сверху и снизу."""
+        rank = self.rank(macaco_id)
+        if rank is None:
+            return []
+        start = max(0, rank - 1 - radius)
+        return [(i + 1, self._keys[i][2]) for i in range(start, min(len(self._keys), rank + radius))]
+
+    def __len__(self) -> int:
+        return len(self._keys)
@@ -0,0 +1,142 @@
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+import callbacks as cb
+
+logger = logging.getLogger(__name__)
+
+# Запись входящих апдейтов для loadtest.py: RECORD_UPDATES=updates.jsonl.gz в окружении бота – каждый апдейт,
+# обезличенный, дописывается строкой {"t": unix-время, "u": апдейт} в gzip-JSONL.
+# Отдельно от loadtest.py, чтобы бот не тянул за собой заглушки Bot API и aiohttp-сервер.
+
+
+# ---------- Обезличивание ----------
+_PERSONAL_FIELDS = ('last_name', 'bio', 'description', 'phone_number', 'invite_link', 'photo', 'contact', 'location')
+_DEEP_LINK = re.compile(r'fight_\d+')  # payload'ы /start, которые бот разбирает (bot.start_command)
+RECORD_QUEUE_SIZE = 10000
+RECORD_FLUSH_SECONDS = 1.0
+
+
+def pseudonym(value: int, key: bytes) -> int:
+    """Стабильная замена id пользователя или чата; знак сохраняется (группы отрицательные)."""
+    digest = hmac.new(key, str(abs(value)).encode(), hashlib.sha256).digest()
+    pseudo = int.from_bytes(digest[:4], 'big') % 2_000_000_000 + 1
+    return -pseudo if value < 0 else pseudo
+
+
+def _anonymize_callback(data: str, key: bytes) -> str:
+    decoded = cb.decode(data)
+    if decoded is None:
+        return data
+    return cb.encode(decoded.action.name, pseudonym(decoded.owner_id, key), *decoded.args)
+
+
+def _mask_text(text: str) -> str:
+    # Для маршрутизации нужна только сама команда и известные deep link вроде fight_<id>; остальной текст,
+    # в том числе аргументы команд, маскируется. Длина сохраняется: от неё зависят entities и проверки имени в /rename
+    if not text.startswith('/'):
+        return 'x' * len(text)
+    command, sep, args = text.partition(' ')
+    if _DEEP_LINK.fullmatch(args):
+        return text
+    return command + sep + 'x' * len(args)
+
+
+def anonymize(value: Any, key: bytes) -> Any:
+    if isinstance(value, list):
+        return [anonymize(item, key) for item in value]
+    if not isinstance(value, dict):
+        return value
+    result = {}
+    # Пользователь или чат: числовой id и is_bot / type
+    is_peer = isinstance(value.get('id'), int) and ('is_bot' in value or 'type' in value)
+    for name, item in value.items():
+        if name in _PERSONAL_FIELDS:
+            continue
+        if is_peer and name == 'id':
+            result[name] = pseudonym(item, key)
+        elif is_peer and name == 'username':
+            result[name] = f"u{abs(pseudonym(value['id'], key))}"
+        elif is_peer and name in ('first_name', 'title'):
+            result[name] = 'Anon'
+        elif name in ('text', 'caption', 'query') and isinstance(item, str):
+            result[name] = _mask_text(item)
+        elif name in ('data', 'callback_data') and isinstance(item, str):
+            result[name] = _anonymize_callback(item, key)
+        else:
+            result[name] = anonymize(item, key)
+    return result
+
+
+# ---------- Запись ----------
+class UpdateRecorder(BaseMiddleware):
+    """
+    Outer-middleware: пишет каждый апдейт до троттлинга и очередей, то есть весь входящий поток.
+    В event loop – только model_dump и постановка в очередь; обезличивание, сжатие и запись – в отдельном потоке.
+    """
+
+    def __init__(self, path: str, salt: Optional[str] = None):
+        self.path = path
+        # Без RECORD_SALT соответствие id меняется при каждом запуске – логи разных запусков не связать
+        self._key = (salt or os.urandom(16).hex()).encode()
+        self._queue: queue.Queue = queue.Queue(RECORD_QUEUE_SIZE)
+        self._thread: Optional[threading.Thread] = None
+        self.recorded = 0
+        self.dropped = 0
+
+    async def __call__(self, handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        try:
+            self.write(event)
+        except Exception as e:
+            logger.warning("Запись апдейта не удалась: %s", e)
+        return await handler(event, data)
+
+    def write(self, update: Update):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='update-recorder', daemon=True)
+            self._thread.start()
+        raw = update.model_dump(mode='json', exclude_none=True, by_alias=True)
+        try:
+            self._queue.put_nowait((round(time.time(), 3), raw))
+        except queue.Full:
+            self.dropped += 1  # поток записи не успевает – теряем апдейт, а не задерживаем loop
+
+    def _run(self):
+        # Каждое открытие на дозапись – новый gzip-член, gzip.open читает их подряд
+        with gzip.open(self.path, 'at', encoding='utf-8') as f:
+            flushed_at = time.monotonic()
+            while True:
+                try:
+                    item = self._queue.get(timeout=RECORD_FLUSH_SECONDS)
+                except queue.Empty:
+                    item = ()
+                if item is None:
+                    break
+                if item:
+                    t, raw = item
+                    f.write(json.dumps({'t': t, 'u': anonymize(raw, self._key)}, ensure_ascii=False,
+                                       separators=(',', ':')) + '\n')
+                    self.recorded += 1
+                # Сброс в файл раз в RECORD_FLUSH_SECONDS: при падении теряется не больше этого хвоста
+                if time.monotonic() - flushed_at >= RECORD_FLUSH_SECONDS:
+                    f.flush()
+                    flushed_at = time.monotonic()
+
+    def close(self):
+        """Дописывает очередь и закрывает файл."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
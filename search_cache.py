@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Generic, List, Optional, TypeVar
+
+Row = TypeVar('Row')
+
+
+class _Entry(Generic[Row]):
+    __slots__ = ('rows', 'complete', 'expires_at')
+
+    def __init__(self, rows: List[Row], complete: bool, expires_at: float):
+        self.rows = rows
+        self.complete = complete
+        self.expires_at = expires_at
+
+
+class PrefixCache(Generic[Row]):
+    """
+    Кэш поиска по подстроке. Если для запроса p база вернула меньше limit строк, это все совпадения,
+    а совпадения любого запроса, начинающегося с p, – их подмножество: его отбираем в памяти без запроса к базе.
+    """
+
+    def __init__(self, match: Callable[[Row, str], bool], limit: int = 50, ttl: float = 30.0, max_entries: int = 5000):
+        self.match = match
+        self.limit = limit
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[str, _Entry[Row]]' = OrderedDict()
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+
+    def get(self, query: str) -> Optional[List[Row]]:
+        now = time.monotonic()
+        entry = self._fresh(query, now)
+        if entry is not None:
+            self.hits += 1
+            return entry.rows
+        for end in range(len(query) - 1, 0, -1):
+            entry = self._fresh(query[:end], now)
+            if entry is not None and entry.complete:
+                rows = [row for row in entry.rows if self.match(row, query)]
+                # Срок жизни наследуется: отфильтрованные строки не свежее исходных
+                self._store(query, _Entry(rows, True, entry.expires_at))
+                self.prefix_hits += 1
+                return rows
+        self.misses += 1
+        return None
+
+    def put(self, query: str, rows: List[Row]):
+        self._store(query, _Entry(rows, len(rows) < self.limit, time.monotonic() + self.ttl))
+
+    def _fresh(self, query: str, now: float) -> Optional[_Entry[Row]]:
+        entry = self._entries.get(query)
+        if entry is None:
+            return None
+        if entry.expires_at <= now:
+            del self._entries[query]
+            return None
+        self._entries.move_to_end(query)
+        return entry
+
+    def _store(self, query: str, entry: _Entry[Row]):
+        self._entries[query] = entry
+        self._entries.move_to_end(query)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'prefix_hits': self.prefix_hits, 'misses': self.misses, 'entries': len(self._entries)}
@@ -0,0 +1,229 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+import config as cfg
+
+# Офлайн-симулятор баланса: те же константы и формулы, что и у бота (config.py).
+# Распад, как и в database.py, применяется лениво – только когда игрок заходит в бота.
+
+# Всё состояние макаки – одна строка int16: зашедшие за час макаки читаются и пишутся одной операцией
+FIELDS = (
+    'weight', 'health', 'hunger', 'happiness', 'level', 'experience', 'last_fed', 'last_daily',
+    'last_happiness_decay', 'last_hunger_decay', 'last_health_decay',
+)
+INITIAL = {'weight': 10, 'health': 100, 'happiness': 50, 'level': 1}
+MAX_HOURS = np.iinfo(np.int16).max
+
+
+class Season:
+    def __init__(self, macacos: int, seed: int, activity: float, fight_rate: float, walk_rate: float,
+                 foods: Sequence[cfg.Food]):
+        self.rng = np.random.default_rng(seed)
+        self.n = macacos
+        self.fight_rate = fight_rate
+        self.walk_rate = walk_rate
+        # Активность игроков неоднородна: у большинства редкие заходы, у немногих – частые
+        self.activity = np.clip(self.rng.exponential(activity, macacos), 0.005, 1).astype(np.float32)
+
+        # Игрок выбирает самую «тяжёлую» еду, у которой прошёл КД (как в can_feed_food: строго больше).
+        # best_food[часов с кормления] -> индекс еды, последний индекс – «кормить нечем»
+        self.max_cooldown = max(f.cooldown_hours for f in foods)
+        self.best_food = np.full(self.max_cooldown + 2, len(foods), np.int16)
+        for hours in range(self.max_cooldown + 2):
+            ready = [i for i, f in enumerate(foods) if hours > f.cooldown_hours]
+            if ready:
+                self.best_food[hours] = max(ready, key=lambda i: foods[i].weight_gain)
+        self.food_weight = np.array([f.weight_gain for f in foods] + [0], np.int16)
+        self.food_hunger = np.array([f.hunger_decrease for f in foods] + [0], np.int16)
+        self.food_health = np.array([f.health_gain for f in foods] + [0], np.int16)
+        self.table = np.zeros((macacos, len(FIELDS)), np.int16)
+        for name, value in INITIAL.items():
+            self.table[:, FIELDS.index(name)] = value
+        # last_fed = NULL: любая еда доступна сразу
+        self.table[:, FIELDS.index('last_fed')] = -self.max_cooldown - 1
+        self._rows = self.table.view(np.dtype((np.void, self.table.strides[0]))).ravel()
+
+        self.bets = np.array(cfg.FIGHT_BETS, np.int16)
+        self.counters = {'feeds': 0, 'dailies': 0, 'walks': 0, 'fights': 0}
+        self._roll = np.empty(macacos, np.float32)
+
+    # ---------- Шаги, повторяющие database.py ----------
+    # m – срез состояния зашедших в этот час макак; все операции идут по маскам на плотных массивах
+    def apply_decay(self, m: Dict[str, np.ndarray], t: int):
+        m['happiness'] = cfg.happiness_after_decay(m['happiness'], t - m['last_happiness_decay'], np.maximum)
+        m['last_happiness_decay'] = np.full_like(m['last_happiness_decay'], t)
+
+        m['hunger'], consumed = cfg.hunger_after_decay(m['hunger'], t - m['last_hunger_decay'], np.minimum)
+        m['last_hunger_decay'] = m['last_hunger_decay'] + consumed
+
+        # Как в apply_health_decay: отсчёт идёт от last_health_decay, который не двигается, пока макака сыта
+        starving = m['hunger'] >= 100
+        decayed = cfg.health_after_decay(m['health'], t - m['last_health_decay'], np.maximum)
+        m['health'] = np.where(starving, decayed, m['health'])
+        m['last_health_decay'] = np.where(starving, t, m['last_health_decay'])
+
+    def walk(self, m: Dict[str, np.ndarray]):
+        sad = (m['happiness'] < 30) & (self.rng.random(len(m['happiness']), dtype=np.float32) < self.walk_rate)
+        m['happiness'] = np.where(sad, 100, m['happiness'])
+        self.counters['walks'] += int(sad.sum())
+
+    def feed(self, m: Dict[str, np.ndarray], t: int):
+        # Макака с нулевым настроением отказывается есть
+        food = self.best_food[np.minimum(t - m['last_fed'], self.max_cooldown + 1)]
+        food[m['happiness'] <= 0] = len(self.food_weight) - 1
+        fed = food < len(self.food_weight) - 1
+        m['last_fed'] = np.where(fed, t, m['last_fed'])
+        m['hunger'] = np.maximum(0, m['hunger'] - self.food_hunger[food])
+        m['weight'] = m['weight'] + self.food_weight[food]
+        m['health'] = np.where(fed, np.minimum(100, m['health'] + self.food_health[food]), m['health'])
+        self.counters['feeds'] += int(fed.sum())
+
+    def daily(self, m: Dict[str, np.ndarray], t: int):
+        due = t // 24 > m['last_daily'] // 24
+        m['weight'] = m['weight'] + due * cfg.DAILY_WEIGHT
+        m['happiness'] = np.where(due, np.minimum(100, m['happiness'] + cfg.DAILY_HAPPINESS), m['happiness'])
+        m['health'] = np.where(due, np.minimum(100, m['health'] + cfg.DAILY_HEALTH), m['health'])
+        m['last_daily'] = np.where(due, t, m['last_daily'])
+        self.counters['dailies'] += int(due.sum())
+
+    def fight(self, m: Dict[str, np.ndarray]):
+        able = (m['health'] > 0) & (100 - m['hunger'] > cfg.FIGHT_MIN_SATIETY)
+        able &= self.rng.random(len(able), dtype=np.float32) < self.fight_rate
+        able = self.rng.permutation(np.flatnonzero(able))
+        half = len(able) // 2
+        challenger, opponent = able[:half], able[half:2 * half]
+        bet = self.rng.choice(self.bets, half)
+        weight = m['weight']
+        ok = (weight[challenger] >= bet) & (weight[opponent] >= bet)
+        challenger, opponent, bet = challenger[ok], opponent[ok], bet[ok]
+
+        challenger_won = self.rng.random(len(bet), dtype=np.float32) < 0.5
+        winner = np.where(challenger_won, challenger, opponent)
+        loser = np.where(challenger_won, opponent, challenger)
+
+        m['happiness'][loser] = np.maximum(0, m['happiness'][loser] - cfg.FIGHT_LOSER_HAPPINESS_LOSS)
+        m['health'][loser] = np.maximum(0, m['health'][loser] - cfg.FIGHT_LOSER_HEALTH_LOSS)
+        weight[winner] += bet
+        weight[loser] = np.maximum(1, weight[loser] - bet)
+        # Как в accept_fight_callback: опыт получает только победитель, WIN_EXP – если победил инициатор
+        gain = np.where(challenger_won, cfg.FIGHT_WIN_EXP, cfg.FIGHT_LOSE_EXP)
+        m['level'][winner], m['experience'][winner] = cfg.level_after_experience(
+            m['level'][winner], m['experience'][winner], gain
+        )
+        self.counters['fights'] += len(bet)
+
+    # ---------- Сезон ----------
+    @property
+    def state(self) -> Dict[str, np.ndarray]:
+        return {name: self.table[:, i] for i, name in enumerate(FIELDS)}
+
+    def gather(self, idx: np.ndarray) -> Dict[str, np.ndarray]:
+        block = self._rows.take(idx).view(np.int16).reshape(-1, len(FIELDS)).T.copy()
+        return dict(zip(FIELDS, block))
+
+    def scatter(self, idx: np.ndarray, m: Dict[str, np.ndarray]):
+        block = np.stack([m[name] for name in FIELDS], axis=1, dtype=np.int16)
+        self._rows[idx] = block.view(self._rows.dtype).ravel()
+
+    def step(self, t: int):
+        self.rng.random(out=self._roll, dtype=np.float32)
+        active = np.flatnonzero(self._roll < self.activity)
+        m = self.gather(active)
+        self.apply_decay(m, t)
+        self.walk(m)
+        self.feed(m, t)
+        self.daily(m, t)
+        self.fight(m)
+        self.scatter(active, m)
+
+    def top(self, k: int) -> np.ndarray:
+        # Порядок get_top_macacos: вес, затем уровень
+        state = self.state
+        score = state['weight'].astype(np.int64) * 10_000 + state['level']
+        return np.argpartition(score, -k)[-k:]
+
+    def run(self, days: int, top_k: int) -> Dict:
+        churn = []
+        previous_top = self.top(top_k)
+        for t in range(1, days * 24 + 1):
+            self.step(t)
+            if t % 24 == 0:
+                current_top = self.top(top_k)
+                churn.append(1 - len(np.intersect1d(previous_top, current_top, assume_unique=True)) / top_k)
+                previous_top = current_top
+        # Итоговое состояние – как его увидели бы игроки, зайдя в последний час сезона
+        everyone = np.arange(self.n)
+        m = self.gather(everyone)
+        self.apply_decay(m, days * 24)
+        self.scatter(everyone, m)
+        return {'churn': churn}
+
+
+def describe(name: str, values: np.ndarray) -> str:
+    p10, p50, p90, p99 = np.percentile(values, [10, 50, 90, 99])
+    return (f"{name:<10} mean {values.mean():8.1f} | p10 {p10:7.0f} | p50 {p50:7.0f} | "
+            f"p90 {p90:7.0f} | p99 {p99:7.0f} | max {values.max():7d}")
+
+
+async def _foods_from_db() -> Tuple[cfg.Food, ...]:
+    import database as db
+    try:
+        return await db.get_foods()
+    finally:
+        await (await db.get_pool()).close()
+
+
+def load_foods(source: Optional[str]) -> Tuple[cfg.Food, ...]:
+    """Еда, как у работающего бота: food_types из DATABASE_URL, JSON-выгрузка таблицы или seed – начальное наполнение."""
+    if source == 'seed':
+        return cfg.seed_foods()
+    if source:
+        with open(source, encoding='utf-8') as f:
+            return tuple(cfg.Food(*(row[field] for field in cfg.Food._fields)) for row in json.load(f))
+    return asyncio.run(_foods_from_db())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Симуляция баланса Боевых Макак")
+    parser.add_argument('--macacos', type=int, default=1_000_000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--activity', type=float, default=0.1, help="средняя вероятность захода за час")
+    parser.add_argument('--fight-rate', type=float, default=0.3, help="доля зашедших, готовых драться")
+    parser.add_argument('--walk-rate', type=float, default=0.5, help="вероятность выгула грустной макаки")
+    parser.add_argument('--top', type=int, default=100, help="размер топа для подсчёта оборота")
+    parser.add_argument('--foods', help="JSON-выгрузка food_types (\\copy (SELECT json_agg(f) FROM food_types f) TO foods.json) "
+                                        "или seed – начальное наполнение; по умолчанию – таблица из DATABASE_URL")
+    args = parser.parse_args()
+    if args.days * 24 > MAX_HOURS:
+        parser.error(f"сезон не длиннее {MAX_HOURS // 24} дней")
+    if args.foods is None and not os.getenv('DATABASE_URL'):
+        parser.error("нужен DATABASE_URL или --foods: баланс считается по текущей таблице food_types")
+    foods = load_foods(args.foods)
+    print(f"🍽 Еда: {', '.join(f.name for f in foods)}")
+
+    started = time.perf_counter()
+    season = Season(args.macacos, args.seed, args.activity, args.fight_rate, args.walk_rate, foods)
+    result = season.run(args.days, args.top)
+    elapsed = time.perf_counter() - started
+
+    print(f"🐒 {args.macacos:,} макак, {args.days} дн., {elapsed:.1f} с")
+    state = season.state
+    print(describe("Вес", state['weight']))
+    print(describe("Уровень", state['level']))
+    print(describe("Здоровье", state['health']))
+    print(f"Здоровье = 0: {np.mean(state['health'] == 0):.1%}, настроение = 0: {np.mean(state['happiness'] == 0):.1%}")
+    print("Действия: " + ", ".join(f"{k} {v:,}" for k, v in season.counters.items()))
+    churn = result['churn']
+    print(f"Оборот топ-{args.top} за день: средний {np.mean(churn):.1%}, "
+          f"первая неделя {np.mean(churn[:7]):.1%}, последняя {np.mean(churn[-7:]):.1%}")
+
+
+if __name__ == "__main__":
+    main()
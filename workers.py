@@ -0,0 +1,194 @@
+import asyncio
+import json
+import logging
+import multiprocessing as mp
+import os
+import signal
+import zlib
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+import callbacks as cb
+import logs
+
+logger = logging.getLogger(__name__)
+
+# Режим вебхука для ingress-процесса (если WEBHOOK_URL не задан – long polling)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
+POLLING_TIMEOUT = 30
+
+# Типы апдейтов, в которых есть инициатор (from / user)
+_USER_EVENT_KEYS = (
+    'message', 'edited_message', 'callback_query', 'inline_query',
+    'chosen_inline_result', 'my_chat_member', 'chat_member',
+    'chat_join_request', 'shipping_query', 'pre_checkout_query',
+    'poll_answer', 'message_reaction',
+)
+
+
+# ---------- Ключ партиционирования ----------
+def challenge_owner_id(callback_data: str) -> Optional[int]:
+    # Ответ на вызов должен попасть в воркер инициатора: там живёт active_challenges
+    decoded = cb.decode(callback_data)
+    if decoded is None or decoded.action.owner_only:
+        return None
+    return decoded.owner_id
+
+
+def partition_key(update: Dict) -> Optional[int]:
+    callback = update.get('callback_query')
+    if callback and callback.get('data'):
+        owner_id = challenge_owner_id(callback['data'])
+        if owner_id is not None:
+            return owner_id
+    for key in _USER_EVENT_KEYS:
+        event = update.get(key)
+        if not event:
+            continue
+        user = event.get('from') or event.get('user')
+        if user:
+            return user['id']
+    return None
+
+
+def worker_for(user_id: Optional[int], workers: int) -> int:
+    if user_id is None:
+        return 0
+    return zlib.crc32(str(user_id).encode()) % workers
+
+
+# ---------- Воркер ----------
+def _worker_main(index: int, queue) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.run(_worker_loop(index, queue))
+    finally:
+        # multiprocessing завершает дочерний процесс через os._exit – atexit не сработает, очередь логов дописываем сами
+        logs.stop_logging()
+
+
+async def _worker_loop(index: int, queue) -> None:
+    import bot as app  # импорт внутри процесса: бот и диспетчер создаются заново в каждом воркере
+
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    async def process(update: Dict):
+        try:
+            await app.dp.feed_raw_update(app.bot, update)
+        except Exception as e:
+            logger.error("Воркер %s: ошибка обработки апдейта %s: %s", index, update.get('update_id'), e)
+
+    logger.info("✅ Воркер %s запущен (pid %s)", index, os.getpid())
+    await app.dp.emit_startup(bot=app.bot)
+    while True:
+        update = await loop.run_in_executor(None, queue.get)
+        if update is None:
+            break
+        task = asyncio.create_task(process(update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    await app.dp.emit_shutdown(bot=app.bot)
+    await app.bot.session.close()
+    logger.info("🛑 Воркер %s остановлен", index)
+
+
+# ---------- Ingress ----------
+class UpdateRouter:
+    def __init__(self, workers: int):
+        ctx = mp.get_context('spawn')
+        self.queues = [ctx.Queue() for _ in range(workers)]
+        self.processes = [
+            ctx.Process(target=_worker_main, args=(i, q), name=f"macaco-worker-{i}", daemon=True)
+            for i, q in enumerate(self.queues)
+        ]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def route(self, update: Dict):
+        index = worker_for(partition_key(update), len(self.queues))
+        self.queues[index].put(update)
+
+    def stop(self, timeout: float = 30):
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+
+async def _poll_updates(bot, router: UpdateRouter, allowed_updates: List[str]):
+    # Сырой getUpdates: ingress не разбирает апдейты в модели aiogram, это делают воркеры
+    url = bot.session.api.api_url(token=bot.token, method='getUpdates')
+    offset = None
+    timeout = aiohttp.ClientTimeout(total=POLLING_TIMEOUT + 10)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        while True:
+            params = {'timeout': POLLING_TIMEOUT, 'allowed_updates': allowed_updates}
+            if offset is not None:
+                params['offset'] = offset
+            try:
+                async with session.post(url, json=params) as resp:
+                    payload = await resp.json(loads=json.loads)
+                if not isinstance(payload, dict):
+                    raise ValueError(f"неожиданный ответ: {type(payload).__name__}")
+            # ValueError – обрезанный или не JSON ответ (прокси, обрыв соединения): тот же повтор, что и при сетевой ошибке
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.warning("getUpdates: %s", e)
+                await asyncio.sleep(1)
+                continue
+            if not payload.get('ok'):
+                logger.error("getUpdates вернул ошибку: %s", payload.get('description'))
+                await asyncio.sleep(payload.get('parameters', {}).get('retry_after', 5))
+                continue
+            for update in payload['result']:
+                router.route(update)
+                offset = update['update_id'] + 1
+
+
+async def _serve_webhook(bot, router: UpdateRouter, allowed_updates: List[str]):
+    async def handle(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        router.route(await request.json(loads=json.loads))
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=allowed_updates)
+    logger.info("🌐 Вебхук слушает %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_ingress(bot, dp, workers: int):
+    router = UpdateRouter(workers)
+    router.start()
+    logger.info("🚀 Запущено воркеров: %s", workers)
+    allowed_updates = dp.resolve_used_update_types()
+    try:
+        if WEBHOOK_URL:
+            await _serve_webhook(bot, router, allowed_updates)
+        else:
+            await bot.delete_webhook()
+            await _poll_updates(bot, router, allowed_updates)
+    finally:
+        await asyncio.get_running_loop().run_in_executor(None, router.stop)